@@ -8,6 +8,9 @@ import numpy as np
 from datetime import datetime
 from openai import OpenAI
 from dotenv import load_dotenv
+import sys
+import importlib
+from pathlib import Path
 load_dotenv()
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 # --- Additional imports for GraphRAG ---
@@ -23,6 +26,19 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Comptabilité des tokens partagée avec src/generation/utils.py
+# Import du package src.generation : la racine du dépôt est ajoutée en fin de
+# sys.path pour ne pas masquer le package utils de l'app. Le module reste dans
+# sys.modules et n'est pas ré-exécuté à chaque rerun
+repo_root = str(Path(__file__).parent.parent.parent)
+if repo_root not in sys.path:
+    sys.path.append(repo_root)
+generation_utils = importlib.import_module("src.generation.utils")
+llm_usage = generation_utils.llm_usage
+# Ordonnanceurs partagés (concurrence adaptative, retries sur 429, disjoncteur)
+llm_scheduler = generation_utils.llm_scheduler
+embedding_scheduler = generation_utils.embedding_scheduler
+
 # Apply custom CSS and add logos/icons (if available)
 from utils.helpers import apply_custom_css, add_logo_and_icons
 apply_custom_css()
@@ -44,21 +60,21 @@ driver = GraphDatabase.driver(uri, auth=(user, password))
 # Define the name of your vector index (this must already exist in your Neo4j instance)
 INDEX_NAME = "vector-index-actors"
 
-# Create an embedder (using OpenAI embeddings)
-embedder = OpenAIEmbeddings(model="text-embedding-3-large")
+# Create an embedder (using OpenAI embeddings); retries are handled by the schedulers
+embedder = OpenAIEmbeddings(model="text-embedding-3-large", max_retries=0)
 
 # Initialize the vector retriever (this will query your vector index)
 retriever = VectorRetriever(driver, INDEX_NAME, embedder)
 
 # Instantiate the LLM; adjust model_name and parameters as needed.
-llm = OpenAILLM(model_name="gpt-4o-mini", model_params={"temperature": 0})
+llm = OpenAILLM(model_name="gpt-4o-mini", model_params={"temperature": 0}, max_retries=0)
 
 # Instantiate the GraphRAG pipeline
 rag = GraphRAG(retriever=retriever, llm=llm)
 
 # --- Initialize the embedder and LLM ---
-embedder = OpenAIEmbeddings(model="text-embedding-3-large")
-llm = OpenAILLM(model_name="gpt-4o-mini", model_params={"temperature": 0})
+embedder = OpenAIEmbeddings(model="text-embedding-3-large", max_retries=0)
+llm = OpenAILLM(model_name="gpt-4o-mini", model_params={"temperature": 0}, max_retries=0)
 
 # --- Load CSV file and compute embeddings ---
 @st.cache_data
@@ -71,7 +87,11 @@ def load_csv_and_compute_embeddings(csv_path: str):
     # Ensure the CSV has a column named "content"
     texts = df["n"].tolist()
     # Compute embeddings for each text (this may take some time for large CSVs)
-    embeddings = [embedder.embed_query(text) for text in texts]
+    embeddings = []
+    for text in texts:
+        with llm_usage.track("kg.embeddings", "text-embedding-3-large") as call:
+            call["prompt"] = str(text)
+            embeddings.append(embedding_scheduler.call(embedder.embed_query, text))
     return df, np.array(embeddings)
 
 csv_path = "src/knowledge-graph/export.csv"  # Ensure this CSV file exists in your working directory
@@ -211,7 +231,15 @@ if st.button("Submit Question"):
             try:
                 # Use GraphRAG to search the graph using the natural language question.
                 # The retriever_config can be adjusted (e.g. top_k for number of results)
-                response = rag.search(query_text=user_question, retriever_config={"top_k": 5})
+                # rag.search (embedding de la question + appel LLM) passe par l'ordonnanceur du chat
+                with llm_usage.track("graphrag.search", "gpt-4o-mini") as call:
+                    response = llm_scheduler.call(rag.search, query_text=user_question,
+                                                  retriever_config={"top_k": 5}, return_context=True)
+                    # Estimation : question + contexte récupéré + réponse
+                    call["prompt"] = user_question + "".join(
+                        str(item.content) for item in response.retriever_result.items
+                    )
+                    call["completion"] = response.answer
                 print("Response:",response)
                 st.markdown("#### GraphRAG Answer")
                 st.write(response.answer)
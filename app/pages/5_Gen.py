@@ -9,25 +9,32 @@ st.set_page_config(
 
 import sys
 from pathlib import Path
-import importlib.util
+import importlib
 from datetime import datetime
 import json
 import pickle
+import time
 
-# Import direct depuis src/generation/utils.py
-generation_path = Path(__file__).parent.parent.parent / "src" / "generation" / "utils.py"
-spec = importlib.util.spec_from_file_location("generation_utils", generation_path)
-generation_utils = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(generation_utils)
+# Import du package src.generation : la racine du dépôt est ajoutée en fin de
+# sys.path pour ne pas masquer le package utils de l'app. Le module reste dans
+# sys.modules et n'est pas ré-exécuté à chaque rerun
+repo_root = str(Path(__file__).parent.parent.parent)
+if repo_root not in sys.path:
+    sys.path.append(repo_root)
+generation_utils = importlib.import_module("src.generation.utils")
 
 from utils.helpers import apply_custom_css, add_logo_and_icons
 
 # Utiliser les fonctions importées depuis generation_utils uniquement
 load_enron_emails_from_csv = generation_utils.load_enron_emails_from_csv
 build_user_style_profile = generation_utils.build_user_style_profile
+profile_store = generation_utils.profile_store
+build_style_index = generation_utils.build_style_index
 style_profile_to_instructions = generation_utils.style_profile_to_instructions
 llm = generation_utils.llm
-style_juridique = generation_utils.style_juridique
+user_style_email_messages = generation_utils.user_style_email_messages
+legal_email_messages = generation_utils.legal_email_messages
+generate_emails_concurrently = generation_utils.generate_emails_concurrently
 get_user_descriptions_by_date = generation_utils.get_user_descriptions_by_date
 
 # Charger les données avant la mise en page
@@ -59,6 +66,74 @@ def load_data(csv_path):
         st.error(f"Error loading CSV data: {str(e)}")
         return {}
 
+def stream_email(messages, call_site, state_key):
+    """
+    Affiche l'email au fil des tokens puis le garde dans st.session_state[state_key]
+    (délai du premier token et durée totale dans state_key + "_timing").
+    """
+    stats = {}
+    st.session_state[state_key] = st.write_stream(llm.stream(messages, call_site=call_site, stats=stats))
+    st.session_state[f"{state_key}_timing"] = {key: stats.get(key) for key in ("ttft_s", "total_s", "cached")}
+
+def show_timing(state_key):
+    timing = st.session_state.get(f"{state_key}_timing")
+    if not timing:
+        return
+    if timing["cached"]:
+        st.caption("Served from cache")
+    elif timing["ttft_s"] is not None:
+        st.caption(f"First token after {timing['ttft_s']:.2f}s, complete in {timing['total_s']:.2f}s")
+    elif timing["total_s"] is not None:
+        st.caption(f"Generated in {timing['total_s']:.2f}s")
+
+# Variantes du mode compare : clé de session -> (titre, messages, call_site)
+EMAIL_VARIANTS = {
+    "generated_email": (
+        "User-style email",
+        lambda: user_style_email_messages(st.session_state["style_instructions"], st.session_state["facts"]),
+        "generation.user_style"
+    ),
+    "generated_email_legal": (
+        "Legal email",
+        lambda: legal_email_messages(st.session_state["facts"]),
+        "generation.legal"
+    ),
+}
+
+def generate_variants(keys, use_cache=True):
+    """
+    Génère les variantes demandées en parallèle ; chaque résultat (ou erreur)
+    est affiché et gardé dans st.session_state dès qu'il arrive.
+    use_cache=False force de nouveaux appels au modèle (régénération).
+    """
+    if not keys:
+        return
+    columns = st.columns(len(keys))
+    placeholders = {}
+    for key, col in zip(keys, columns):
+        with col:
+            st.markdown(f"**{EMAIL_VARIANTS[key][0]}**")
+            placeholders[key] = st.empty()
+            placeholders[key].info("Generating...")
+    variants = {key: (EMAIL_VARIANTS[key][1](), EMAIL_VARIANTS[key][2]) for key in keys}
+    start = time.perf_counter()
+    for key, response, error, elapsed in generate_emails_concurrently(variants, use_cache=use_cache):
+        st.session_state[key] = None if response is None else response.content
+        st.session_state[f"{key}_error"] = None if error is None else str(error)
+        # Réponse du cache : disponible d'un bloc, comme dans stream ; sinon pas de premier token mesuré
+        cached = response is not None and bool(response.response_metadata.get("cached"))
+        st.session_state[f"{key}_timing"] = {"ttft_s": elapsed if cached else None, "total_s": elapsed, "cached": cached}
+        if error is None:
+            placeholders[key].write(response.content)
+        else:
+            placeholders[key].error(f"Generation failed: {error}")
+    st.caption(f"{len(keys)} styles generated in {time.perf_counter() - start:.2f}s")
+
+@st.cache_resource
+def load_style_index(_user_emails_map):
+    # Encode seulement les emails jamais vus, l'index est persisté sur disque
+    return build_style_index(_user_emails_map)
+
 # Charger les données avant l'interface utilisateur
 user_emails_map = load_data(CSV_PATH)
 all_users = sorted(list(user_emails_map.keys()))
@@ -173,18 +248,48 @@ with st.container():
             if st.button("🎯 Generate Profile", use_container_width=True):
                 with st.spinner("Generating profile..."):
                     emails = user_emails_map[selected_user]
-                    style_profile = build_user_style_profile(selected_user, emails)
+                    style_profile, profile_status = profile_store.get_or_build(selected_user, emails)
                     instructions = style_profile_to_instructions(style_profile)
                     
                     st.session_state["selected_user"] = selected_user
+                    st.session_state["profile_status"] = profile_status
                     st.session_state["style_profile"] = style_profile
                     st.session_state["style_instructions"] = instructions
+                    st.session_state["similar_users"] = None
                     st.session_state.funnel_state["profile_generated"] = True
                     st.rerun()
 
             if st.session_state.get("style_profile"):
+                if st.session_state.get("profile_status") == "stale":
+                    st.info("This user's emails changed: showing the last stored profile while it is refreshed in the background.")
                 st.json(st.session_state["style_profile"])
 
+                profile_metrics = profile_store.latest_metrics(st.session_state["selected_user"])
+                if profile_metrics:
+                    with st.expander("⏱️ Profile timing breakdown"):
+                        timings = profile_metrics["timings_s"]
+                        st.bar_chart({
+                            name: seconds for name, seconds in timings.items()
+                            if name not in ("total", "finalize")
+                        })
+                        st.caption(f"Total: {timings.get('total', 0.0):.1f}s")
+                        st.table([
+                            {"Counter": name, "Value": value}
+                            for name, value in sorted(profile_metrics["counters"].items())
+                        ])
+
+                if st.button("🔎 Find Senders With a Similar Style", use_container_width=True):
+                    with st.spinner("Searching similar styles..."):
+                        style_index = load_style_index(user_emails_map)
+                        st.session_state["similar_users"] = style_index.search_user(
+                            st.session_state["selected_user"], k=5
+                        )
+                if st.session_state.get("similar_users"):
+                    st.table([
+                        {"User": user, "Style similarity": f"{score:.3f}"}
+                        for user, score in st.session_state["similar_users"]
+                    ])
+
         # Step 2: Generate Facts
         if st.session_state.funnel_state["profile_generated"]:
             with st.expander("Step 2: Generate Facts", expanded=not st.session_state.funnel_state["facts_generated"]):
@@ -241,63 +346,11 @@ with st.container():
                                             st.session_state.get("generated_email_legal"))
                         
                         if need_generation:
-                            with st.spinner('Generating both email styles...'):
-                                if not st.session_state.get("generated_email"):
-                                    # Generate user-style email
-                                    system_prompt = f"""
-                                    You are a professional AI writing assistant.
-                                    You will receive some style instructions and some facts.
-                                    Your task is to produce an email in the style described by the instructions.
-
-                                    Style Instructions:
-                                    {st.session_state["style_instructions"]}
-
-                                    Constraints:
-                                    1. Follow the style instructions carefully.
-                                    2. Use the facts provided to shape the content of the email.
-                                    3. Write in English.
-                                    """
-
-                                    user_prompt = f"""
-                                    Please write an email using the following facts:
-
-                                    {st.session_state["facts"]}
-                                    """
-
-                                    with st.spinner('Generating user-style email...'):
-                                        response = llm.invoke([
-                                            ("system", system_prompt),
-                                            ("human", user_prompt)
-                                        ])
-                                        st.session_state["generated_email"] = response.content
-                                
-                                if not st.session_state.get("generated_email_legal"):
-                                    # Generate legal-style email
-                                    inst = style_juridique()
-                                    system_prompt_legal = f"""
-                                    You are an AI assistant specialized in drafting legal emails.
-
-                                    Below are the defining characteristics of a proper legal-style email:
-                                    {inst}
-
-                                    Constraints:
-                                    1. Carefully follow the listed characteristics for a legal email.
-                                    2. Use the facts provided below to shape the content of the email.
-                                    3. Write the email in English, in a formal and professional tone.
-                                    """
-
-                                    user_prompt_legal = f"""
-                                    Here are the facts to include in the legal email:
-
-                                    {st.session_state["facts"]}
-                                    """
-
-                                    with st.spinner('Generating legal email...'):
-                                        response_legal = llm.invoke([
-                                            ("system", system_prompt_legal),
-                                            ("human", user_prompt_legal)
-                                        ])
-                                        st.session_state["generated_email_legal"] = response_legal.content
+                            # Les variantes manquantes sont générées en parallèle
+                            with view_col1:
+                                generate_variants([
+                                    key for key in EMAIL_VARIANTS if not st.session_state.get(key)
+                                ])
                             
                         # Marquer comme complété si au moins un email existe
                         if st.session_state.get("generated_email") or st.session_state.get("generated_email_legal"):
@@ -306,6 +359,11 @@ with st.container():
                             
                     st.session_state["view_mode"] = view_mode.lower()
 
+                if st.session_state["view_mode"] == "compare":
+                    if st.button("🔁 Regenerate All Styles", use_container_width=True):
+                        generate_variants(list(EMAIL_VARIANTS), use_cache=False)
+                        st.rerun()
+
                 # Generation buttons (only show in single mode)
                 if st.session_state["view_mode"] == "single":
                     email_col1, email_col2 = st.columns(2)
@@ -313,68 +371,21 @@ with st.container():
                         if st.button("✉️ Generate User-Style Email", use_container_width=True):
                             st.session_state.funnel_state["email_generated"] = True
                             st.session_state["generated_email_legal"] = None  # Clear other generation
-            
-                            system_prompt = f"""
-                            You are a professional AI writing assistant.
-                            You will receive some style instructions and some facts.
-                            Your task is to produce an email in the style described by the instructions.
-
-                            Style Instructions:
-                            {st.session_state["style_instructions"]}
-
-                            Constraints:
-                            1. Follow the style instructions carefully.
-                            2. Use the facts provided to shape the content of the email.
-                            3. Write in English.
-                            """
-
-                            user_prompt = f"""
-                            Please write an email using the following facts:
-
-                            {st.session_state["facts"]}
-                            """
-
-                            with st.spinner('Generating user-style email...'):
-                                response = llm.invoke([
-                                    ("system", system_prompt),
-                                    ("human", user_prompt)
-                                ])
-                                st.session_state["generated_email"] = response.content
-                            
-                            st.session_state["generation_in_progress"] = False
+                            stream_email(
+                                user_style_email_messages(st.session_state["style_instructions"], st.session_state["facts"]),
+                                "generation.user_style", "generated_email"
+                            )
+                            st.rerun()
                 
                     with email_col2:
                         if st.button("⚖️ Generate Legal Email", use_container_width=True):
                             st.session_state.funnel_state["email_generated"] = True
                             st.session_state["generated_email"] = None  # Clear other generation
-            
-                            inst = style_juridique()
-                            system_prompt_legal = f"""
-                            You are an AI assistant specialized in drafting legal emails.
-
-                            Below are the defining characteristics of a proper legal-style email:
-                            {inst}
-
-                            Constraints:
-                            1. Carefully follow the listed characteristics for a legal email.
-                            2. Use the facts provided below to shape the content of the email.
-                            3. Write the email in English, in a formal and professional tone.
-                            """
-
-                            user_prompt_legal = f"""
-                            Here are the facts to include in the legal email:
-
-                            {st.session_state["facts"]}
-                            """
-
-                            with st.spinner('Generating legal email...'):
-                                response_legal = llm.invoke([
-                                    ("system", system_prompt_legal),
-                                    ("human", user_prompt_legal)
-                                ])
-                                st.session_state["generated_email_legal"] = response_legal.content
-                            
-                            st.session_state["generation_in_progress"] = False
+                            stream_email(
+                                legal_email_messages(st.session_state["facts"]),
+                                "generation.legal", "generated_email_legal"
+                            )
+                            st.rerun()
 
                 # Display emails based on view mode
                 if st.session_state.get("generated_email") or st.session_state.get("generated_email_legal"):
@@ -389,6 +400,9 @@ with st.container():
                             """, unsafe_allow_html=True)
                             if st.session_state.get("generated_email"):
                                 st.write(st.session_state["generated_email"])
+                                show_timing("generated_email")
+                            elif st.session_state.get("generated_email_error"):
+                                st.error(f"Generation failed: {st.session_state['generated_email_error']}")
                             else:
                                 st.info("No user-style email generated yet")
                             st.markdown("</div></div>", unsafe_allow_html=True)
@@ -401,6 +415,9 @@ with st.container():
                             """, unsafe_allow_html=True)
                             if st.session_state.get("generated_email_legal"):
                                 st.write(st.session_state["generated_email_legal"])
+                                show_timing("generated_email_legal")
+                            elif st.session_state.get("generated_email_legal_error"):
+                                st.error(f"Generation failed: {st.session_state['generated_email_legal_error']}")
                             else:
                                 st.info("No legal-style email generated yet")
                             st.markdown("</div></div>", unsafe_allow_html=True)
@@ -413,6 +430,7 @@ with st.container():
                                     <div style='background-color: #2A2D4C; padding: 1rem; border-radius: 8px;'>
                             """, unsafe_allow_html=True)
                             st.write(st.session_state["generated_email"])
+                            show_timing("generated_email")
                             st.markdown("</div></div>", unsafe_allow_html=True)
 
                         if st.session_state.get("generated_email_legal"):
@@ -422,6 +440,7 @@ with st.container():
                                     <div style='background-color: #2A2D4C; padding: 1rem; border-radius: 8px;'>
                             """, unsafe_allow_html=True)
                             st.write(st.session_state["generated_email_legal"])
+                            show_timing("generated_email_legal")
                             st.markdown("</div></div>", unsafe_allow_html=True)
 
 # Add reset button at the bottom
@@ -435,8 +454,37 @@ if any(st.session_state.funnel_state.values()):
         st.session_state["facts"] = None
         st.session_state["generated_email"] = None
         st.session_state["generated_email_legal"] = None
+        st.session_state["generated_email_error"] = None
+        st.session_state["generated_email_legal_error"] = None
+        st.session_state["similar_users"] = None
         st.rerun()
 
+# Consommation LLM du processus (tous les appels passent par llm_usage)
+usage_rows = generation_utils.llm_usage.summary()
+if usage_rows:
+    with st.sidebar.expander("LLM usage"):
+        st.table([
+            {
+                "Call site": row["call_site"],
+                "Calls": row["calls"],
+                "Cached": row["cached"],
+                "Tokens": row["total_tokens"],
+                "Avg latency (s)": f"{row['avg_latency_s']:.2f}"
+            }
+            for row in usage_rows
+        ])
+        st.table([
+            {
+                "Scheduler": stats["name"],
+                "In flight": stats["in_flight"],
+                "Queued": stats["queued"],
+                "Throttled": stats["throttled"],
+                "Limit": stats["limit"],
+                "Circuit": stats["circuit"]
+            }
+            for stats in (generation_utils.llm_scheduler.stats(), generation_utils.embedding_scheduler.stats())
+        ])
+
 # Styles supplémentaires
 st.markdown("""
     <style>
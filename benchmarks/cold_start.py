@@ -0,0 +1,96 @@
+"""
+Cold-start benchmark of src/generation/utils.py (and the modules it imports)
+
+Mesure, dans des processus Python neufs :
+    - le temps d'import du module
+    - le temps de premier usage de chaque modèle du registre (--first-use)
+
+--ref permet de comparer avec une autre révision git de src/generation.
+
+Usage:
+    python benchmarks/cold_start.py --repeat 5
+    python benchmarks/cold_start.py --ref HEAD~1 --first-use
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = """
+import json, sys, time
+sys.path.insert(0, {path!r})
+start = time.perf_counter()
+from src.generation import utils
+result = {{"import_s": time.perf_counter() - start}}
+if {first_use!r} and hasattr(utils, "models"):
+    for name in ("nlp", "sentiment_classifier", "style_embedding_model", "chat_model"):
+        start = time.perf_counter()
+        utils.models.get(name)
+        result[name + "_s"] = time.perf_counter() - start
+print(json.dumps(result))
+"""
+
+
+def run_once(root_dir, first_use):
+    """
+    Importe src.generation.utils depuis root_dir dans un nouveau processus.
+    """
+    code = IMPORT_SNIPPET.format(path=root_dir, first_use=first_use)
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        # Depuis la racine mesurée : aucun module de l'arbre de travail n'est importable à plat
+        cwd=root_dir,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def checkout_module(ref, target_dir):
+    """
+    Extrait le package src.generation (modules Python) à la révision ref
+    dans target_dir.
+    """
+    archive = subprocess.run(
+        ["git", "archive", "--format=tar", ref, "src/__init__.py", "src/generation"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        check=True
+    ).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target_dir, members=[member for member in tar.getmembers() if member.name.endswith(".py")])
+
+
+def summarize(label, runs):
+    print(f"\n{label}")
+    for key in runs[0]:
+        values = [run[key] for run in runs]
+        print(f"  {key:<28} median={statistics.median(values):.3f}s  min={min(values):.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--first-use", action="store_true", help="time the first load of each model")
+    parser.add_argument("--ref", default=None, help="git revision to compare against")
+    args = parser.parse_args()
+
+    summarize("working tree", [run_once(REPO_ROOT, args.first_use) for _ in range(args.repeat)])
+
+    if args.ref:
+        with tempfile.TemporaryDirectory() as tmp:
+            checkout_module(args.ref, tmp)
+            summarize(args.ref, [run_once(tmp, args.first_use) for _ in range(args.repeat)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+Benchmark of the style-profiling pipeline of src/generation/utils.py
+
+Chaque étape (anonymisation, parsing SpaCy, formalité, sentiment, chacune
+des mesures, profil complet) est exécutée sur les emails d'un CSV
+(sample_graph.csv par défaut). Pour chaque étape : temps médian sur
+--repeat exécutions, emails/s et pic mémoire Python (tracemalloc, passe
+séparée pour ne pas fausser les temps).
+
+Le LLM est remplacé par StubChatModel, déterministe et sans réseau
+(--llm-latency simule la latence d'un appel), et le cache LLM est ignoré.
+SpaCy et le modèle de sentiment sont les vrais modèles, chargés avant les
+mesures ; --stub-models les remplace aussi (pipeline SpaCy vide avec
+sentencizer, sentiment déterministe) pour un relevé sans les modèles lourds.
+
+Les résultats sont comparés à benchmarks/baselines/profile_pipeline.json
+(--save-baseline pour le réécrire) : une étape plus lente que la baseline
+de plus de --tolerance fait échouer la commande. Sans baseline, le run est
+enregistré comme baseline. La baseline versionnée a été relevée avec
+--stub-models ; elle n'est comparée qu'aux runs faits avec les mêmes
+modèles (stubs ou réels).
+
+Usage:
+    python benchmarks/profile_pipeline.py --repeat 5
+    python benchmarks/profile_pipeline.py --stub-models --save-baseline
+    python benchmarks/profile_pipeline.py --no-compare
+    python benchmarks/profile_pipeline.py --stages parse syntax profile --llm-latency 0.2
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GENERATION_DIR = os.path.join(REPO_ROOT, "src", "generation")
+sys.path.insert(0, REPO_ROOT)
+
+from src.generation import utils
+from langchain_core.messages import AIMessage
+
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "baselines", "profile_pipeline.json")
+PARSED_MEASURES = ["attitude", "vocabulary", "syntax", "recurrence", "rhythm"]
+
+
+class StubChatModel:
+    """
+    Remplaçant local et déterministe de ChatOpenAI.
+
+    La réponse ne dépend que des messages : un label de formalité pour les
+    prompts de classification, un court email sinon. usage_metadata compte
+    les mots comme des tokens.
+    """
+
+    model_name = "stub-chat"
+    temperature = 0.0
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, messages, config=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        serialized = utils._serialize_messages(messages)
+        digest = hashlib.sha256(json.dumps(serialized).encode("utf-8")).hexdigest()
+        if serialized[0][1] == utils.FORMALITY_SYSTEM_PROMPT:
+            content = "FORMAL" if int(digest[:8], 16) % 2 else "INFORMAL"
+        else:
+            content = f"Hello,\n\nThis is a generated email ({digest[:8]}).\n\nBest regards"
+        return AIMessage(content=content, usage_metadata={
+            "input_tokens": sum(len(text.split()) for _, text in serialized),
+            "output_tokens": len(content.split()),
+            "total_tokens": sum(len(text.split()) for _, text in serialized) + len(content.split())
+        })
+
+
+class StubSentimentClassifier:
+    """
+    Remplaçant déterministe du pipeline de sentiment : un label
+    nlptown ("1 star" ... "5 stars") tiré du hash de chaque texte.
+    """
+
+    def __call__(self, texts, **kwargs):
+        return [{"label": f"{int(utils.email_hash(text)[:8], 16) % 5 + 1} stars", "score": 1.0} for text in texts]
+
+
+def stub_nlp():
+    # Tokenizer et découpage en phrases seulement ; le sentencizer prend le nom
+    # du parser pour rester actif dans les mesures qui en dépendent (MEASURE_COMPONENTS)
+    import spacy
+    nlp = spacy.blank("en")
+    nlp.add_pipe("sentencizer", name="parser")
+    return nlp
+
+
+def install_stubs(llm_latency, stub_models=False):
+    stub = StubChatModel(latency=llm_latency)
+    utils.models.override("chat_model", stub)
+    if stub_models:
+        utils.models.override("nlp", stub_nlp())
+        utils.models.override("sentiment_classifier", StubSentimentClassifier())
+    utils.llm_cache.bypass = True
+    return stub
+
+
+def clear_caches():
+    with utils._anonymization_lock:
+        utils._anonymization_cache.clear()
+
+
+def build_stages(user_emails):
+    """
+    (nom, fonction) de chaque étape ; les entrées (emails anonymisés, Docs)
+    sont préparées une fois pour que chaque mesure soit chronométrée seule.
+    """
+    emails = [email for user_list in user_emails.values() for email in user_list]
+    clear_caches()
+    anonymized = utils.anonymize_emails(emails)
+    docs = utils.parse_emails(anonymized, measures=PARSED_MEASURES)
+
+    def anonymize():
+        clear_caches()
+        utils.anonymize_emails(emails)
+
+    def profile():
+        clear_caches()
+        for user_id, user_list in user_emails.items():
+            utils.build_user_style_profile(user_id, user_list)
+
+    return emails, [
+        ("anonymize", anonymize),
+        ("parse", lambda: utils.parse_emails(anonymized, measures=PARSED_MEASURES)),
+        ("formality", lambda: utils.classify_formality_batch([email[:2000] for email in anonymized])),
+        ("sentiment", lambda: utils.detect_emotions(anonymized)),
+        ("attitude", lambda: [utils.detect_attitude(email, doc=doc) for email, doc in zip(anonymized, docs)]),
+        ("vocabulary", lambda: utils.measure_vocabulary(anonymized, docs=docs)),
+        ("structure", lambda: utils.measure_structure(anonymized)),
+        ("syntax", lambda: utils.measure_syntax(anonymized, docs=docs)),
+        ("recurrence", lambda: utils.measure_recurrence(anonymized, docs=docs)),
+        ("politeness", lambda: utils.measure_politeness(anonymized)),
+        ("rhythm", lambda: utils.measure_rhythm_cadence(anonymized, docs=docs)),
+        ("profile", profile),
+    ]
+
+
+def time_stage(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(args):
+    stub = install_stubs(args.llm_latency, stub_models=args.stub_models)
+    user_emails = utils.load_enron_emails_from_csv(args.csv, user_column=args.user_column, body_column=args.body_column)
+
+    # Chargement des modèles hors mesures
+    for name in ("nlp", "sentiment_classifier"):
+        utils.models.get(name)
+
+    emails, stages = build_stages(user_emails)
+    if args.stages:
+        stages = [(name, fn) for name, fn in stages if name in args.stages]
+
+    results = {}
+    for name, fn in stages:
+        fn()  # échauffement
+        calls_before = stub.calls
+        seconds = time_stage(fn, args.repeat)
+        results[name] = {
+            "seconds": seconds,
+            "emails_per_s": len(emails) / (seconds + 1e-9),
+            "llm_calls": (stub.calls - calls_before) // args.repeat,
+        }
+        if not args.no_memory:
+            results[name]["peak_mib"] = peak_memory(fn) / 2 ** 20
+
+    return {
+        "csv": os.path.relpath(os.path.abspath(args.csv), REPO_ROOT),
+        "n_users": len(user_emails),
+        "n_emails": len(emails),
+        "repeat": args.repeat,
+        "llm_latency": args.llm_latency,
+        "stub_models": args.stub_models,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "model_load_s": dict(utils.models.load_times),
+        "max_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": results,
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"{report['n_emails']} emails, {report['n_users']} users, median of {report['repeat']} runs")
+    for name, seconds in report["model_load_s"].items():
+        print(f"  model load {name:<22} {seconds:.2f}s")
+    header = f"\n{'stage':<12}{'seconds':>10}{'emails/s':>11}{'peak MiB':>10}{'LLM calls':>11}"
+    if baseline:
+        header += f"{'vs base':>10}"
+    print(header)
+    for name, stage in report["stages"].items():
+        line = (f"{name:<12}{stage['seconds']:>10.3f}{stage['emails_per_s']:>11.1f}"
+                f"{stage.get('peak_mib', float('nan')):>10.1f}{stage['llm_calls']:>11}")
+        base = (baseline or {}).get("stages", {}).get(name)
+        if base:
+            line += f"{stage['seconds'] / (base['seconds'] + 1e-9):>9.2f}x"
+        print(line)
+    print(f"\nmax RSS {report['max_rss_mib']:.0f} MiB")
+
+
+def regressions(report, baseline, tolerance, min_delta):
+    slower = []
+    for name, stage in report["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base and stage["seconds"] > base["seconds"] * (1 + tolerance) and stage["seconds"] - base["seconds"] > min_delta:
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", default=os.path.join(GENERATION_DIR, "sample_graph.csv"))
+    parser.add_argument("--user-column", default="Full_Name")
+    parser.add_argument("--body-column", default="body")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", nargs="*", default=None, help="limiter à ces étapes")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="latence simulée d'un appel LLM (s)")
+    parser.add_argument("--stub-models", action="store_true",
+                        help="remplace aussi SpaCy et le modèle de sentiment par des stubs")
+    parser.add_argument("--no-memory", action="store_true", help="ne pas mesurer le pic mémoire")
+    parser.add_argument("--output", default=None, help="écrit aussi le rapport JSON ici")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="remplace la baseline par ce run")
+    parser.add_argument("--no-compare", action="store_true", help="relevé seul, sans comparaison à la baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="ralentissement relatif toléré par étape avant d'échouer")
+    parser.add_argument("--min-delta", type=float, default=0.005,
+                        help="écart absolu (s) en dessous duquel une étape n'est pas signalée")
+    args = parser.parse_args()
+
+    report = run(args)
+
+    baseline = None
+    if not (args.save_baseline or args.no_compare):
+        if not os.path.exists(args.baseline):
+            print(f"no baseline at {args.baseline}, recording one")
+            args.save_baseline = True
+        else:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+            if baseline.get("stub_models", False) != args.stub_models:
+                print(f"baseline {args.baseline} was recorded with stub_models={baseline.get('stub_models', False)}, "
+                      f"not comparing (use --save-baseline to replace it)")
+                baseline = None
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+    elif baseline:
+        slower = regressions(report, baseline, args.tolerance, args.min_delta)
+        if slower:
+            print(f"\nslower than baseline by more than {args.tolerance:.0%}: {', '.join(slower)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
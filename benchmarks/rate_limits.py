@@ -0,0 +1,258 @@
+"""
+Rate-limit harness for RequestScheduler (src/generation/request_scheduler.py)
+
+Démarre un faux serveur local compatible avec l'API chat completions
+d'OpenAI, qui limite le débit (--rps requêtes/s, --max-concurrent appels
+simultanés) en répondant 429 avec un en-tête retry-after, et peut injecter
+des erreurs 503 (--error-rate, --outage). Des classifications de formalité
+(classify_formality_llama) sont ensuite envoyées depuis --threads threads
+via utils.llm, donc via un RequestScheduler.
+
+Le rapport donne le débit obtenu, les appels réussis / en échec, les 429
+renvoyés par le serveur et les compteurs du scheduler ; --no-scheduler
+montre le même run sans lui.
+
+Le client est un petit client urllib ; --openai utilise ChatOpenAI
+(langchain_openai) pointé sur le faux serveur.
+
+Usage:
+    python benchmarks/rate_limits.py --requests 300 --threads 32 --rps 40
+    python benchmarks/rate_limits.py --outage 3 --reset-timeout 1
+    python benchmarks/rate_limits.py --no-scheduler
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from src.generation import utils
+from langchain_core.messages import AIMessage
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """
+    Faux /v1/chat/completions : seau de jetons (rps) + plafond d'appels
+    simultanés, 429 avec retry-after au-delà, 503 pendant outage secondes
+    puis avec la probabilité error_rate.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, rps, max_concurrent, latency, retry_after, error_rate, outage, seed=0):
+        super().__init__(("127.0.0.1", 0), FakeOpenAIHandler)
+        self.rps = rps
+        self.max_concurrent = max_concurrent
+        self.latency = latency
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.outage_until = time.monotonic() + outage
+        self.tokens = float(rps)
+        self.refilled_at = time.monotonic()
+        self.active = 0
+        self.counts = {"ok": 0, "429": 0, "503": 0}
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def admit(self):
+        """
+        Code HTTP de la prochaine requête (200, 429 ou 503).
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.outage_until or self.random.random() < self.error_rate:
+                self.counts["503"] += 1
+                return 503
+            self.tokens = min(self.rps, self.tokens + (now - self.refilled_at) * self.rps)
+            self.refilled_at = now
+            if self.tokens < 1 or self.active >= self.max_concurrent:
+                self.counts["429"] += 1
+                return 429
+            self.tokens -= 1
+            self.active += 1
+            return 200
+
+    def done(self):
+        with self.lock:
+            self.active -= 1
+            self.counts["ok"] += 1
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path != "/v1/chat/completions":
+            self.send_json(404, {"error": {"message": f"Unknown URL {self.path}", "type": "invalid_request_error"}})
+            return
+        status = self.server.admit()
+        if status == 429:
+            headers = [("retry-after", str(self.server.retry_after))] if self.server.retry_after else []
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                           "code": "rate_limit_exceeded"}}, headers)
+            return
+        if status == 503:
+            self.send_json(503, {"error": {"message": "Service unavailable", "type": "server_error"}})
+            return
+        try:
+            time.sleep(self.server.latency)
+            prompt = " ".join(message["content"] for message in request["messages"])
+            content = "FORMAL" if len(prompt) % 2 else "INFORMAL"
+            self.send_json(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": 1,
+                          "total_tokens": len(prompt.split()) + 1},
+            })
+        finally:
+            self.server.done()
+
+
+class HTTPChatModel:
+    """
+    Client chat completions minimal (urllib) : les erreurs HTTP remontent en
+    urllib.error.HTTPError (code, headers), comprises par RequestScheduler.
+    """
+
+    model_name = "fake-gpt"
+    temperature = 0.0
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def invoke(self, messages, config=None, **kwargs):
+        roles = {"human": "user", "ai": "assistant"}
+        body = json.dumps({
+            "model": self.model_name,
+            "messages": [{"role": roles.get(role, role), "content": content}
+                         for role, content in utils._serialize_messages(messages)],
+        }).encode("utf-8")
+        request = urllib.request.Request(f"{self.base_url}/chat/completions", data=body,
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            data = json.loads(response.read())
+        usage = data["usage"]
+        return AIMessage(content=data["choices"][0]["message"]["content"], usage_metadata={
+            "input_tokens": usage["prompt_tokens"],
+            "output_tokens": usage["completion_tokens"],
+            "total_tokens": usage["total_tokens"]
+        })
+
+
+def make_client(args, base_url):
+    if args.openai:
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(model="gpt-4o-mini", base_url=base_url, api_key="fake", temperature=0.0, max_retries=0)
+    return HTTPChatModel(base_url)
+
+
+def monitor(scheduler, samples, stop, interval=0.1):
+    while not stop.wait(interval):
+        stats = scheduler.stats()
+        samples.append((stats["limit"], stats["in_flight"], stats["queued"]))
+
+
+def run(args):
+    server = FakeOpenAIServer(args.rps, args.max_concurrent, args.latency, args.retry_after,
+                              args.error_rate, args.outage, seed=args.seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    utils.models.override("chat_model", make_client(args, server.url))
+    utils.llm_cache.bypass = True
+    scheduler = None
+    if not args.no_scheduler:
+        scheduler = utils.RequestScheduler("fake", initial_concurrency=args.initial_concurrency,
+                                           max_concurrency=args.threads, reset_timeout=args.reset_timeout)
+    utils.llm.scheduler = scheduler
+
+    outcomes = {"ok": 0, "failed": 0, "rejected": 0}
+    lock = threading.Lock()
+
+    def classify(i):
+        try:
+            utils.classify_formality_llama(f"Email number {i}: please find the report attached.")
+            outcome = "ok"
+        except utils.CircuitOpen:
+            outcome = "rejected"
+        except Exception:
+            outcome = "failed"
+        with lock:
+            outcomes[outcome] += 1
+
+    samples, stop = [], threading.Event()
+    if scheduler is not None:
+        threading.Thread(target=monitor, args=(scheduler, samples, stop), daemon=True).start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(classify, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    server.shutdown()
+
+    print(f"{args.requests} requests from {args.threads} threads, server limit {args.rps} req/s "
+          f"and {args.max_concurrent} concurrent, scheduler {'off' if scheduler is None else 'on'}")
+    print(f"wall time {elapsed:.2f}s, {outcomes['ok'] / elapsed:.1f} successful req/s")
+    print(f"client: {outcomes['ok']} ok, {outcomes['failed']} failed, {outcomes['rejected']} rejected (circuit open)")
+    print(f"server: {server.counts['ok']} served, {server.counts['429']} x 429, {server.counts['503']} x 503")
+    if scheduler is not None:
+        print(f"scheduler: {scheduler.stats()}")
+        if samples:
+            limits = [limit for limit, _, _ in samples]
+            print(f"concurrency limit: min {min(limits):.1f}, max {max(limits):.1f}, "
+                  f"mean {sum(limits) / len(limits):.1f}; max queued {max(q for _, _, q in samples)}")
+    return outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rps", type=float, default=40, help="débit maximal du faux serveur")
+    parser.add_argument("--max-concurrent", type=int, default=8, help="appels simultanés acceptés par le serveur")
+    parser.add_argument("--latency", type=float, default=0.05, help="latence d'une réponse (s)")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="retry-after des 429 (0 : sans en-tête)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probabilité d'une 503")
+    parser.add_argument("--outage", type=float, default=0.0, help="503 pendant les N premières secondes")
+    parser.add_argument("--initial-concurrency", type=int, default=4)
+    parser.add_argument("--reset-timeout", type=float, default=30.0, help="durée d'ouverture du disjoncteur (s)")
+    parser.add_argument("--no-scheduler", action="store_true", help="appels directs, sans RequestScheduler")
+    parser.add_argument("--openai", action="store_true", help="client ChatOpenAI au lieu du client urllib")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    outcomes = run(args)
+    if outcomes["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Recall / latency benchmark of StyleVectorIndex (src/generation/vector_index.py)
+
+Compare la recherche IVF à la recherche exacte (produit scalaire sur tous
+les vecteurs) pour plusieurs valeurs de n_probe. Les vecteurs sont soit
+synthétiques (gaussiennes autour de --clusters centres), soit lus depuis
+un fichier de vecteurs moyens écrit par build_profiles.py --embeddings.
+
+Usage:
+    python benchmarks/style_index.py --n 20000 --dim 384
+    python benchmarks/style_index.py --centroids src/generation/profiles.centroids.npz
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from src.generation import utils
+
+
+def synthetic_vectors(n, dim, clusters, noise, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(clusters, size=n)] + noise * rng.normal(size=(n, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def brute_force(vectors, query, k):
+    scores = vectors @ query
+    top = np.argpartition(-scores, k)[:k + 1]
+    return top[np.argsort(-scores[top])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=20000, help="nombre de vecteurs synthétiques")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=2.0)
+    parser.add_argument("--centroids", default=None, help="fichier .npz utilisateur -> vecteur")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--n-probe", type=int, nargs="*", default=[0, 4, 16, 64],
+                        help="valeurs de n_probe (0 : valeur par défaut de l'index)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.centroids:
+        with np.load(args.centroids) as data:
+            ids = list(data.files)
+            vectors = np.stack([data[user] for user in ids]).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-9
+    else:
+        vectors = synthetic_vectors(args.n, args.dim, args.clusters, args.noise, args.seed)
+        ids = [f"user_{i}" for i in range(len(vectors))]
+
+    # Insertion incrémentale, comme dans build_style_index
+    index = utils.StyleVectorIndex()
+    start = time.perf_counter()
+    for user_id, vector in zip(ids, vectors):
+        index.add(user_id, vector)
+    build_s = time.perf_counter() - start
+    n_lists = 0 if index.centers is None else len(index.centers)
+    print(f"{len(index)} vectors, dim={vectors.shape[1]}, {n_lists} lists, built in {build_s:.2f}s")
+
+    rng = np.random.default_rng(args.seed + 1)
+    query_rows = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+    k = min(args.k, len(vectors) - 1)
+
+    exact = {}
+    latencies = []
+    for row in query_rows:
+        start = time.perf_counter()
+        top = brute_force(vectors, vectors[row], k)
+        latencies.append(time.perf_counter() - start)
+        exact[row] = {ids[i] for i in [i for i in top if i != row][:k]}
+    print(f"\n{'method':<16}{'recall@' + str(k):>12}{'median ms':>12}{'p95 ms':>12}")
+    print(f"{'brute force':<16}{1.0:>12.3f}{statistics.median(latencies) * 1000:>12.3f}"
+          f"{np.percentile(latencies, 95) * 1000:>12.3f}")
+
+    for n_probe in args.n_probe:
+        recalls, latencies = [], []
+        for row in query_rows:
+            start = time.perf_counter()
+            found = index.search_user(ids[row], k=k, n_probe=n_probe or None)
+            latencies.append(time.perf_counter() - start)
+            recalls.append(len({user for user, _ in found} & exact[row]) / len(exact[row]))
+        print(f"{'ivf n_probe=' + (str(n_probe) if n_probe else 'auto'):<16}{statistics.mean(recalls):>12.3f}"
+              f"{statistics.median(latencies) * 1000:>12.3f}{np.percentile(latencies, 95) * 1000:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Batch jobs : classification de formalité et extraction d'entités en masse
+
+Les requêtes sont écrites dans un job (llm_batch.BatchJob, un dossier sous
+--job-dir), soumises à un backend de lots puis fusionnées par id quand
+les lots sont terminés. Le backend "openai" utilise l'API Batch (moins
+chère, résultats sous 24 h) ; "local" traite les lots sur place avec le
+chat model courant, pour les tests.
+
+Relancer la même commande reprend le job : rien n'est soumis en double,
+seules les requêtes sans réponse le sont. Avec --no-wait, la commande
+soumet, fusionne les lots déjà terminés et rend la main. --token-budget
+borne les tokens des lots soumis par la commande.
+
+formality : label de chaque email du CSV (anonymisé et tronqué comme dans
+build_user_style_profile). Les réponses sont écrites dans le cache LLM,
+donc les profils calculés ensuite ne rappellent pas le LLM.
+
+extract : entités de chaque email (intentions, public_acts, ...), écrites
+dans <output-dir>/extracted_<kind>.json au format de data/extraction_data.
+
+Usage:
+    python batch_jobs.py formality --csv sample_graph.csv --backend openai --no-wait
+    python batch_jobs.py extract --kinds intentions norms --backend local
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+
+import pandas as pd
+
+if not __package__:
+    # Lancé comme script (python batch_jobs.py) : src.generation est importé comme
+    # package depuis la racine du dépôt
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from src.generation import utils
+
+EXTRACTION_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "extraction_data")
+
+# Schéma JSON attendu pour chaque type d'entité (celui des fichiers extracted_*.json)
+EXTRACTION_SCHEMAS = {
+    "intentions": '{"intentions": [{"description": str, "date": str or null, "context": str, '
+                  '"confidence": "HIGH" | "MEDIUM" | "LOW"}]}',
+    "public_acts": '{"public_acts": [{"description": str, "date": str or null, "actors": [str], "context": str, '
+                   '"confidence": "HIGH" | "MEDIUM" | "LOW"}]}',
+    "public_bodies": '{"public_bodies": [{"name": str, "context": str, "confidence": "HIGH" | "MEDIUM" | "LOW"}]}',
+    "norms": '{"norms": [{"text": str, "type": str, "source": str, "context": str, '
+             '"confidence": "HIGH" | "MEDIUM" | "LOW"}]}',
+    "subjective_entities": '{"subjective_entities": [{"id": str, "type": str, "holder": str, "content": str, '
+                           '"properties": {"confidence_level": str, "sentiment": str, "intensity": str}}]}',
+}
+
+
+def extraction_messages(kind, email):
+    """
+    Messages d'extraction d'un type d'entité dans un email.
+    """
+    system_prompt = f"""You are an expert in legal and business document analysis.
+    Extract all {kind.replace("_", " ")} from the email below.
+    Respond ONLY with a JSON object following this schema:
+    {EXTRACTION_SCHEMAS[kind]}
+    Use an empty list if there is nothing to extract.
+    """
+    return [("system", system_prompt), ("human", f"Email:\n{email}\n")]
+
+
+def parse_extraction(kind, content):
+    """
+    JSON de la réponse (éventuellement entre ```), {kind: []} si illisible.
+    """
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", content.strip())
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        logging.warning(f"Unreadable {kind} extraction: {content[:80]!r}")
+        return {kind: []}
+    return data if isinstance(data, dict) else {kind: data}
+
+
+def email_body(message):
+    """
+    Corps d'un message brut (en-têtes retirés).
+    """
+    return message.split("\n\n", 1)[1].strip() if "\n\n" in message else message
+
+
+def make_backend(args):
+    if args.backend == "openai":
+        return utils.OpenAIBatchBackend()
+    return utils.LocalBatchBackend(utils.llm.load_model, complete_after=args.complete_after,
+                                   scheduler=utils.llm_scheduler)
+
+
+def make_job(args, name):
+    """
+    Job name sous --job-dir, dont les réponses vont dans le cache et le registre de tokens du pipeline.
+    """
+    budget = utils.TokenBudget(args.token_budget, degrade=()) if args.token_budget else None
+    return utils.BatchJob(os.path.join(args.job_dir, name), make_backend(args), chunk_size=args.chunk_size,
+                          cache=utils.llm_cache, ledger=utils.llm_usage, budget=budget)
+
+
+def run_job(job, args):
+    if args.no_wait:
+        job.submit()
+        running = job.poll()
+        logging.info(f"{len(job.results())}/{len(job.request_ids())} results, {running} chunks still running")
+        return job.results()
+    return job.run(poll_interval=args.poll_interval)
+
+
+def formality_job(args):
+    user_emails = utils.load_enron_emails_from_csv(args.csv, user_column=args.user_column, body_column=args.body_column)
+    emails = [email for user_list in user_emails.values() for email in user_list]
+    # Même texte que dans build_user_style_profile : réponses réutilisées via le cache
+    texts = {utils.email_hash(email): anonymized[:utils.FORMALITY_MAX_CHARS]
+             for email, anonymized in zip(emails, utils.anonymize_emails(emails))}
+
+    job = make_job(args, "formality")
+    added = job.add({digest: utils.formality_messages(text) for digest, text in texts.items()})
+    logging.info(f"{len(texts)} emails, {added} new requests")
+    results = run_job(job, args)
+
+    output = args.output or "formality_labels.jsonl"
+    with open(output, "w", encoding="utf-8") as f:
+        for digest in texts:
+            if digest in results:
+                f.write(json.dumps({"email_hash": digest, "label": utils.parse_formality_label(results[digest])}) + "\n")
+    logging.info(f"{sum(digest in results for digest in texts)} labels written to {output}")
+
+
+def extraction_job(args):
+    df = pd.read_csv(args.csv)
+    emails = {str(row[args.id_column]): email_body(row[args.message_column]) for _, row in df.iterrows()}
+
+    job = make_job(args, "extraction")
+    added = job.add({
+        f"{kind}|{email_id}": extraction_messages(kind, body)
+        for kind in args.kinds for email_id, body in emails.items()
+    })
+    logging.info(f"{len(emails)} emails x {len(args.kinds)} kinds, {added} new requests")
+    results = run_job(job, args)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for kind in args.kinds:
+        records = [
+            {"email_id": int(email_id) if email_id.isdigit() else email_id,
+             "extracted_data": parse_extraction(kind, results[f"{kind}|{email_id}"])}
+            for email_id in emails if f"{kind}|{email_id}" in results
+        ]
+        path = os.path.join(args.output_dir, f"extracted_{kind}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False, indent=4)
+        logging.info(f"{len(records)} emails written to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["local", "openai"], default="local")
+    parser.add_argument("--job-dir", default=utils.BATCH_JOBS_DIR, help="dossier des jobs")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="requêtes par lot soumis")
+    parser.add_argument("--poll-interval", type=float, default=60.0, help="secondes entre deux polls")
+    parser.add_argument("--complete-after", type=float, default=0.0, help="backend local : délai avant traitement (s)")
+    parser.add_argument("--no-wait", action="store_true", help="soumet, fusionne ce qui est prêt et s'arrête")
+    parser.add_argument("--token-budget", type=int, default=None, help="tokens maximum des lots soumis")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    formality = subparsers.add_parser("formality", help="label FORMAL / INFORMAL de chaque email")
+    formality.add_argument("--csv", default="sample_graph.csv")
+    formality.add_argument("--user-column", default="Full_Name")
+    formality.add_argument("--body-column", default="body")
+    formality.add_argument("--output", default=None, help="labels JSONL (formality_labels.jsonl par défaut)")
+
+    extract = subparsers.add_parser("extract", help="entités de chaque email, fichiers extracted_<kind>.json")
+    extract.add_argument("--csv", default=os.path.join(EXTRACTION_DATA_DIR, "sample.csv"))
+    extract.add_argument("--id-column", default="id")
+    extract.add_argument("--message-column", default="message")
+    extract.add_argument("--kinds", nargs="*", choices=list(EXTRACTION_SCHEMAS), default=list(EXTRACTION_SCHEMAS))
+    extract.add_argument("--output-dir", default=EXTRACTION_DATA_DIR)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "formality":
+        formality_job(args)
+    else:
+        extraction_job(args)
+    utils.llm_usage.log()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Batch job : construit les profils stylistiques de tous les utilisateurs d'un CSV
+
+Les utilisateurs sont répartis sur un pool de processus, chaque profil est
+écrit dans un fichier JSONL (une ligne par utilisateur) dès qu'il est prêt.
+Par défaut, un processus pour deux coeurs, chacun limité à --torch-threads
+threads de calcul (1).
+Relancer la commande reprend là où elle s'était arrêtée : les utilisateurs
+déjà présents dans le fichier de sortie sont ignorés.
+
+Usage:
+    python build_profiles.py --csv sample_graph.csv --output profiles.jsonl
+    python build_profiles.py --csv enron.csv --user-column from --workers 8 --llm-concurrency 16
+    python build_profiles.py --csv enron.csv --sampled --strata-column folder --sample-max 2000
+    python build_profiles.py --csv enron.csv --embeddings
+    python build_profiles.py --csv enron.csv --token-budget 200000 --budget-degrade truncate sample
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+if not __package__:
+    # Lancé comme script (python build_profiles.py) : src.generation est importé comme
+    # package depuis la racine du dépôt
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from src.generation import utils
+
+
+def load_done_users(output_path, key="user_id"):
+    """
+    Valeurs de key (utilisateurs par défaut) déjà écrites dans le fichier
+    de sortie, pour la reprise.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if content and not content.endswith("\n"):
+        # Dernière ligne tronquée : on termine la ligne pour que les ajouts restent du JSONL valide
+        with open(output_path, "a", encoding="utf-8") as f:
+            f.write("\n")
+    for line in content.splitlines():
+        if line:
+            try:
+                done.add(json.loads(line)[key])
+            except (json.JSONDecodeError, KeyError):
+                # Ligne tronquée par une interruption : l'élément sera recalculé
+                continue
+    return done
+
+
+def init_worker(llm_semaphore, formality_concurrency, torch_threads):
+    """
+    Partage le sémaphore LLM global avec le processus worker et limite ses
+    threads de calcul (torch, OpenMP, MKL) : sans cela, chaque worker lance
+    un thread par coeur et N workers se partagent N x N threads.
+    """
+    utils.llm.set_semaphore(llm_semaphore)
+    utils.FORMALITY_MAX_CONCURRENCY = formality_concurrency
+    # Lus au chargement de torch (importé au premier usage du modèle de sentiment)
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(torch_threads)
+    if "torch" in sys.modules:
+        # Déjà importé par le processus parent (fork)
+        sys.modules["torch"].set_num_threads(torch_threads)
+
+
+def profile_user(user_id, emails, spacy_batch_size, formality_mode, sampled=False, strata=None, sample_max=None,
+                 token_budget=None, budget_degrade=()):
+    start = time.perf_counter()
+    budget = utils.TokenBudget(token_budget, degrade=budget_degrade) if token_budget else None
+    kwargs = dict(
+        batch_size=spacy_batch_size,
+        max_concurrency=utils.FORMALITY_MAX_CONCURRENCY,
+        formality_mode=formality_mode,
+        budget=budget
+    )
+    metrics = utils.PipelineMetrics()
+    if sampled:
+        profile = utils.build_user_style_profile_sampled(
+            user_id, emails, strata=strata, max_size=sample_max, metrics=metrics, **kwargs
+        )
+    else:
+        profile = utils.build_user_style_profile(user_id, emails, metrics=metrics, **kwargs)
+    return {
+        "user_id": user_id,
+        "n_emails": len(emails),
+        "elapsed_s": time.perf_counter() - start,
+        "metrics": metrics.to_dict(),
+        "budget": budget.to_dict() if budget is not None else None,
+        "profile": profile
+    }
+
+
+def write_centroids(user_emails, output_path):
+    """
+    Encode les emails de chaque utilisateur (sans ré-encoder ceux déjà dans
+    utils.style_embeddings) et écrit les vecteurs moyens dans output_path (.npz).
+    """
+    centroids = {}
+    if os.path.exists(output_path):
+        with np.load(output_path) as data:
+            centroids = {user: data[user] for user in data.files}
+    start = time.perf_counter()
+    for user, emails in user_emails.items():
+        if user not in centroids:
+            centroids[user] = utils.style_embeddings.centroid(emails)
+    tmp_path = f"{output_path}.tmp.npz"
+    np.savez(tmp_path, **centroids)
+    os.replace(tmp_path, output_path)
+    logging.info(f"{len(centroids)} style centroids written to {output_path} in {time.perf_counter() - start:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csv", default="sample_graph.csv", help="CSV des emails (load_enron_emails_from_csv)")
+    parser.add_argument("--output", default="profiles.jsonl", help="fichier JSONL de sortie")
+    parser.add_argument("--user-column", default="Full_Name")
+    parser.add_argument("--body-column", default="body")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2), help="nombre de processus")
+    parser.add_argument("--torch-threads", type=int, default=1,
+                        help="threads torch / OpenMP par processus (workers x torch-threads <= nombre de coeurs)")
+    parser.add_argument("--llm-concurrency", type=int, default=8,
+                        help="nombre maximal d'appels LLM simultanés, tous processus confondus")
+    parser.add_argument("--spacy-batch-size", type=int, default=utils.SPACY_BATCH_SIZE)
+    parser.add_argument("--formality-mode", choices=["llm", "tiered"], default="llm",
+                        help="tiered : modèle local de formalité, LLM pour les cas incertains")
+    parser.add_argument("--users", nargs="*", default=None, help="limiter à ces utilisateurs")
+    parser.add_argument("--sampled", action="store_true",
+                        help="profil sur un échantillon stratifié, arrêté quand les décisions sont stables")
+    parser.add_argument("--sample-max", type=int, default=None, help="taille maximale de l'échantillon")
+    parser.add_argument("--strata-column", default=None,
+                        help="colonne de stratification (dossier, date, ...) en plus de la longueur")
+    parser.add_argument("--token-budget", type=int, default=None, help="budget de tokens LLM par utilisateur")
+    parser.add_argument("--budget-degrade", nargs="*", choices=["truncate", "local", "sample"],
+                        default=["truncate", "local", "sample"],
+                        help="stratégies quand le budget serait dépassé (aucune : l'utilisateur échoue)")
+    parser.add_argument("--embeddings", action="store_true",
+                        help="écrit aussi le vecteur de style moyen de chaque utilisateur (<output>.centroids.npz)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    user_emails = utils.load_enron_emails_from_csv(args.csv, user_column=args.user_column, body_column=args.body_column)
+    if args.users:
+        user_emails = {user: user_emails[user] for user in args.users if user in user_emails}
+
+    user_strata = {}
+    if args.sampled and args.strata_column:
+        user_strata = utils.load_email_strata_from_csv(
+            args.csv, args.strata_column, user_column=args.user_column, body_column=args.body_column
+        )
+
+    done = load_done_users(args.output)
+    todo = [user for user in user_emails if user not in done]
+    # Les plus gros utilisateurs d'abord pour équilibrer le pool
+    todo.sort(key=lambda user: len(user_emails[user]), reverse=True)
+    logging.info(f"{len(user_emails)} users, {len(done)} already done, {len(todo)} to profile")
+
+    llm_semaphore = multiprocessing.BoundedSemaphore(args.llm_concurrency)
+    start = time.perf_counter()
+    failures = 0
+    with open(args.output, "a", encoding="utf-8") as out, ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=init_worker,
+        initargs=(llm_semaphore, args.llm_concurrency, args.torch_threads)
+    ) as executor:
+        futures = {
+            executor.submit(
+                profile_user, user, user_emails[user], args.spacy_batch_size, args.formality_mode,
+                args.sampled, user_strata.get(user), args.sample_max, args.token_budget, args.budget_degrade
+            ): user
+            for user in todo
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            user = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                failures += 1
+                logging.error(f"[{i}/{len(todo)}] {user}: failed ({e})")
+                continue
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            timings = {name: t for name, t in record["metrics"]["timings_s"].items() if name != "total"}
+            slowest = max(timings, key=timings.get) if timings else "-"
+            logging.info(
+                f"[{i}/{len(todo)}] {user}: {record['n_emails']} emails in {record['elapsed_s']:.1f}s "
+                f"({record['n_emails'] / (record['elapsed_s'] + 1e-9):.1f} emails/s, slowest stage: {slowest})"
+            )
+
+    logging.info(f"Done in {time.perf_counter() - start:.1f}s, {failures} failures")
+
+    if args.embeddings:
+        # Dans le processus principal : un seul écrivain pour le store de vecteurs
+        write_centroids(user_emails, os.path.splitext(args.output)[0] + ".centroids.npz")
+
+
+if __name__ == "__main__":
+    main()
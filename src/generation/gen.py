@@ -2,12 +2,21 @@ import streamlit as st
 import pandas as pd
 import json
 import pickle
+import os
+import sys
 from datetime import datetime
-from utils import (
+
+if not __package__:
+    # Lancé comme script (streamlit run gen.py) : src.generation est importé comme
+    # package depuis la racine du dépôt
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from src.generation.utils import (
     load_enron_emails_from_csv,
-    build_user_style_profile,
+    profile_store,
     style_profile_to_instructions,
-    llm, style_juridique
+    llm,
+    user_style_email_messages, legal_email_messages
 )
 
 #####################################
@@ -62,20 +71,6 @@ user_emails_map = load_data(CSV_PATH)
 #####################################
 st.title("Application de génération d'e-mails selon le style d'utilisateur")
 
-# Définition des instructions pour le style juridique
-
-LEGAL_STYLE_INSTRUCTIONS = """
-Characteristics of a legal email:
-
-1. The email must contain a clear and concise subject line.
-2. Use a professional salutation, such as 'Dear Sir/Madam,' 'Hello Mr. X,' or 'Maître Y' if relevant.
-3. Favor a medium-length structure: avoid bullet points, organize content into paragraphs and line breaks.
-4. Body: adopt a formal, direct tone; use sophisticated or technical language; optionally cite laws/articles (GREEN FLAG); avoid emotional expressions.
-5. Use formal valedictions such as 'Kind regards,' or 'Yours sincerely.'
-6. Include a complete signature.
-7. Employ abbreviations and acronyms to indicate professionalism (e.g., references to codes, articles, or legal citations).
-"""
-
 # Initialisation de l'état
 if "style_profile" not in st.session_state:
     st.session_state["style_profile"] = None
@@ -103,8 +98,10 @@ selected_user = st.selectbox("Sélectionnez un utilisateur :", all_users)
 #####################################
 if st.button("Générer la carte ID"):
     emails = user_emails_map[selected_user]
-    style_profile = build_user_style_profile(selected_user, emails)
+    style_profile, profile_status = profile_store.get_or_build(selected_user, emails)
     instructions = style_profile_to_instructions(style_profile)
+    if profile_status == "stale":
+        st.info("Les e-mails de cet utilisateur ont changé : ancienne carte ID affichée, mise à jour en arrière-plan.")
 
     # Sauvegarde dans la session
     st.session_state["style_profile"] = style_profile
@@ -134,77 +131,38 @@ if st.session_state["facts"] is not None:
 #####################################
 # 7) Boutons : Générer les e-mails
 #####################################
+def stream_email(messages, call_site, state_key):
+    """
+    Affiche l'e-mail au fil des tokens, puis le garde dans st.session_state[state_key].
+    """
+    stats = {}
+    st.session_state[state_key] = st.write_stream(llm.stream(messages, call_site=call_site, stats=stats))
+    st.session_state[f"{state_key}_timing"] = {key: stats.get(key) for key in ("ttft_s", "total_s", "cached")}
+    st.rerun()
+
+def show_timing(state_key):
+    timing = st.session_state.get(f"{state_key}_timing")
+    if timing and timing["cached"]:
+        st.caption("Réponse servie depuis le cache")
+    elif timing and timing["ttft_s"] is not None:
+        st.caption(f"Premier token après {timing['ttft_s']:.2f}s, e-mail complet en {timing['total_s']:.2f}s")
+
 if st.session_state["facts"] is not None:
     col1, col2 = st.columns(2)
 
     with col1:
         if st.button("Générer l'e-mail style utilisateur"):
-            system_prompt = f"""
-            You are a professional AI writing assistant.
-            You will receive some style instructions and some facts.
-            Your task is to produce an email in the style described by the instructions.
-
-            Style Instructions:
-            {st.session_state["style_instructions"]}
-
-            Constraints:
-            1. Follow the style instructions carefully.
-            2. Use the facts provided to shape the content of the email.
-            3. Write in English.
-            """
-
-            user_prompt = f"""
-            Please write an email using the following facts:
-
-            {st.session_state["facts"]}
-            """
-
-            response = llm.invoke([
-                ("system", system_prompt),
-                ("human", user_prompt)
-            ])
-
-            st.session_state["generated_email"] = response.content
+            stream_email(
+                user_style_email_messages(st.session_state["style_instructions"], st.session_state["facts"]),
+                "generation.user_style", "generated_email"
+            )
 
     with col2:
         if st.button("Générer l'e-mail juridique (EN)"):
-            system_prompt_legal2 = f"""
-            You are an AI assistant specialized in drafting legal emails.
-
-            Below are the defining characteristics of a proper legal-style email:
-            {LEGAL_STYLE_INSTRUCTIONS}
-
-            Constraints:
-            1. Carefully follow the listed characteristics for a legal email.
-            2. Use the facts provided below to shape the content of the email.
-            3. Write the email in English, in a formal and professional tone.
-            """
-            
-            inst = style_juridique()
-            system_prompt_legal = f"""
-            You are an AI assistant specialized in drafting legal emails.
-
-            Below are the defining characteristics of a proper legal-style email:
-            {inst}
-
-            Constraints:
-            1. Carefully follow the listed characteristics for a legal email.
-            2. Use the facts provided below to shape the content of the email.
-            3. Write the email in English, in a formal and professional tone.
-            """
-
-            user_prompt_legal = f"""
-            Here are the facts to include in the legal email:
-
-            {st.session_state["facts"]}
-            """
-
-            response_legal = llm.invoke([
-                ("system", system_prompt_legal),
-                ("human", user_prompt_legal)
-            ])
-
-            st.session_state["generated_email_legal"] = response_legal.content
+            stream_email(
+                legal_email_messages(st.session_state["facts"]),
+                "generation.legal", "generated_email_legal"
+            )
 
 #####################################
 # 8) Affichage des e-mails générés
@@ -212,7 +170,9 @@ if st.session_state["facts"] is not None:
 if st.session_state.get("generated_email") is not None:
     st.subheader("E-mail généré (style utilisateur)")
     st.write(st.session_state["generated_email"])
+    show_timing("generated_email")
 
 if st.session_state.get("generated_email_legal") is not None:
     st.subheader("E-mail généré (juridique)")
     st.write(st.session_state["generated_email_legal"])
+    show_timing("generated_email_legal")
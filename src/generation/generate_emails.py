@@ -0,0 +1,210 @@
+"""
+Batch job : génère les e-mails de tous les utilisateurs à partir de leur timeline de faits
+
+Pour chaque utilisateur de --users-pkl (sample_users_graph.pkl) et chaque
+style (style utilisateur, style juridique), un e-mail est généré à partir
+de la timeline de extracted_facts.json. Les profils viennent de --profiles
+(JSONL écrit par build_profiles.py) ou, à défaut, de utils.profile_store.
+
+Les éléments tournent en asyncio, au plus --concurrency à la fois, dans
+un pool de --concurrency threads : le profil de style (calculé s'il est
+absent du store) puis l'appel LLM. Chaque e-mail est écrit dans le fichier
+JSONL de sortie dès qu'il est prêt : relancer la commande ne régénère que
+les éléments absents.
+
+--token-budget borne les tokens LLM du run (profils calculés compris) :
+une fois le budget atteint, les éléments restants sont ignorés (et seront
+générés par une relance).
+
+Usage:
+    python generate_emails.py --output generated_emails.jsonl
+    python generate_emails.py --profiles profiles.jsonl --styles legal --concurrency 16
+    python generate_emails.py --token-budget 200000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+if not __package__:
+    # Lancé comme script (python generate_emails.py) : src.generation est importé comme
+    # package depuis la racine du dépôt
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from src.generation import utils
+from src.generation.build_profiles import load_done_users
+
+STYLES = ["user_style", "legal"]
+
+
+def load_profiles(profiles_path):
+    """
+    Profils d'un fichier JSONL de build_profiles.py, par utilisateur.
+    """
+    profiles = {}
+    with open(profiles_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                profiles[record["user_id"]] = record["profile"]
+    return profiles
+
+
+def build_items(users, facts, styles):
+    """
+    Un élément par (utilisateur, style) : id, timeline et call_site. Les
+    messages sont préparés par la tâche de l'élément (item_messages).
+    """
+    items = []
+    for user in users:
+        timeline = utils.format_fact_timeline(utils.get_user_descriptions_by_date(facts, user))
+        if not timeline:
+            logging.warning(f"{user}: no facts, skipped")
+            continue
+        for style in styles:
+            items.append({
+                "id": f"{user}|{style}",
+                "user_id": user,
+                "style": style,
+                "facts": timeline,
+                "call_site": f"generation.{style}",
+            })
+    return items
+
+
+def item_messages(item, get_profile):
+    """
+    Messages de l'élément, ou None si l'utilisateur n'a pas de profil de style.
+    """
+    if item["style"] == "legal":
+        return utils.legal_email_messages(item["facts"])
+    profile = get_profile(item["user_id"])
+    if profile is None:
+        return None
+    return utils.user_style_email_messages(utils.style_profile_to_instructions(profile), item["facts"])
+
+
+async def generate_all(items, out, concurrency, get_profile):
+    """
+    Génère les éléments avec au plus concurrency tâches simultanées et
+    écrit chaque résultat dès qu'il arrive.
+
+    Profils et appels LLM tournent dans un pool dédié de concurrency threads
+    (l'exécuteur par défaut d'asyncio plafonne à min(32, coeurs + 4)).
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {"done": 0, "failed": 0, "skipped": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    async def generate(item, executor):
+        async with semaphore:
+            try:
+                messages = await loop.run_in_executor(executor, item_messages, item, get_profile)
+                if messages is None:
+                    logging.warning(f"{item['user_id']}: no style profile, user_style skipped")
+                    return
+                start = time.perf_counter()
+                response = await loop.run_in_executor(
+                    executor, partial(utils.llm.invoke, messages, call_site=item["call_site"])
+                )
+            except utils.BudgetExceeded:
+                stats["skipped"] += 1
+                return
+            except Exception as e:
+                stats["failed"] += 1
+                logging.error(f"{item['id']}: failed ({e})")
+                return
+            elapsed = time.perf_counter() - start
+        cached = bool(response.response_metadata.get("cached"))
+        # Une réponse servie par le cache ne consomme aucun token
+        prompt_tokens, completion_tokens, estimated = (
+            (0, 0, False) if cached else utils.response_tokens(response, messages)
+        )
+        out.write(json.dumps({
+            "id": item["id"],
+            "user_id": item["user_id"],
+            "style": item["style"],
+            "facts": item["facts"],
+            "email": response.content,
+            "elapsed_s": elapsed,
+            "cached": cached,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tokens_estimated": estimated,
+        }, ensure_ascii=False) + "\n")
+        out.flush()
+        stats["done"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        logging.info(f"[{stats['done'] + stats['failed']}/{len(items)}] {item['id']}: {elapsed:.1f}s")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*(generate(item, executor) for item in items))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users-pkl", default="sample_users_graph.pkl", help="liste pickle des utilisateurs")
+    parser.add_argument("--facts", default="extracted_facts.json", help="timelines de faits par utilisateur")
+    parser.add_argument("--csv", default="sample_graph.csv", help="emails (profils absents du store)")
+    parser.add_argument("--profiles", default=None, help="profils JSONL de build_profiles.py")
+    parser.add_argument("--output", default="generated_emails.jsonl", help="fichier JSONL de sortie")
+    parser.add_argument("--styles", nargs="*", choices=STYLES, default=STYLES)
+    parser.add_argument("--concurrency", type=int, default=8, help="nombre maximal d'appels LLM simultanés")
+    parser.add_argument("--token-budget", type=int, default=None, help="tokens LLM maximum pour le run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.token_budget:
+        utils.llm.budget = utils.TokenBudget(args.token_budget, degrade=())
+
+    with open(args.users_pkl, "rb") as f:
+        users = pickle.load(f)
+    with open(args.facts, "r", encoding="utf-8") as f:
+        facts = json.load(f)
+
+    if args.profiles:
+        profiles = load_profiles(args.profiles)
+        get_profile = profiles.get
+    else:
+        user_emails = utils.load_enron_emails_from_csv(args.csv)
+
+        def get_profile(user):
+            if user not in user_emails:
+                return None
+            # Profil du store, calculé maintenant s'il est absent ou périmé
+            profile, _ = utils.profile_store.get_or_build(user, user_emails[user], background=False)
+            return profile
+
+    done = load_done_users(args.output, key="id")
+    todo = [item for item in build_items(users, facts, args.styles) if item["id"] not in done]
+    logging.info(f"{len(done)} emails already generated, {len(todo)} to generate")
+
+    start = time.perf_counter()
+    with open(args.output, "a", encoding="utf-8") as out:
+        stats = asyncio.run(generate_all(todo, out, args.concurrency, get_profile))
+    elapsed = time.perf_counter() - start
+
+    total_tokens = stats["prompt_tokens"] + stats["completion_tokens"]
+    logging.info(
+        f"Done in {elapsed:.1f}s: {stats['done']} emails ({stats['done'] / (elapsed + 1e-9):.2f} emails/s), "
+        f"{stats['failed']} failures, {stats['skipped']} skipped (token budget), {stats['prompt_tokens']}+{stats['completion_tokens']} tokens "
+        f"({total_tokens / (elapsed + 1e-9):.0f} tokens/s)"
+    )
+    utils.llm_usage.log()
+    utils.llm_scheduler.log()
+
+
+if __name__ == "__main__":
+    main()
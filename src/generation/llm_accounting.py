@@ -0,0 +1,174 @@
+"""
+Comptabilité des tokens LLM : estimation, registre des appels (LLMUsageLedger)
+et budget de tokens (TokenBudget)
+"""
+
+import json
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from .llm_cache import _serialize_messages
+
+
+def estimate_tokens(text):
+    """
+    Estimation grossière (4 caractères par token) quand l'API ne renvoie pas l'usage.
+    """
+    return math.ceil(len(text) / 4)
+
+def response_tokens(response, messages=None):
+    """
+    (prompt_tokens, completion_tokens, estimated) d'une réponse LangChain.
+
+    Utilise usage_metadata si présent, sinon estime depuis les messages.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0), False
+    prompt = sum(estimate_tokens(content) for _, content in _serialize_messages(messages or []))
+    return prompt, estimate_tokens(getattr(response, "content", "") or ""), True
+
+
+class LLMUsageLedger:
+    """
+    Comptabilité centrale des appels LLM : appels, tokens et latence par
+    (call_site, modèle).
+
+    Les réponses servies par le cache sont comptées à part (sans tokens).
+    Si path est fourni, chaque appel est aussi ajouté en JSONL, ce qui
+    permet d'agréger plusieurs processus.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._usage = {}
+
+    def record(self, call_site, model, prompt_tokens=0, completion_tokens=0, latency_s=0.0,
+               cached=False, estimated=False):
+        with self._lock:
+            entry = self._usage.setdefault((call_site, model), Counter())
+            entry["cached" if cached else "calls"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["estimated_calls"] += int(estimated)
+            entry["latency_s"] += latency_s
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({
+                        "time": time.time(), "call_site": call_site, "model": model,
+                        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                        "latency_s": latency_s, "cached": cached, "estimated": estimated
+                    }) + "\n")
+
+    def record_response(self, call_site, model, response, messages=None, latency_s=0.0):
+        prompt_tokens, completion_tokens, estimated = response_tokens(response, messages)
+        self.record(call_site, model, prompt_tokens, completion_tokens, latency_s, estimated=estimated)
+
+    @contextmanager
+    def track(self, call_site, model):
+        """
+        Chronomètre un appel fait hors de LangChain (OpenAI, neo4j_graphrag, ...).
+
+        Le bloc remplit le dict produit : prompt_tokens / completion_tokens
+        s'ils sont connus, sinon prompt / completion (textes) pour une estimation.
+        """
+        call = {}
+        start = time.perf_counter()
+        try:
+            yield call
+        finally:
+            estimated = "prompt_tokens" not in call
+            self.record(
+                call_site, model,
+                call.get("prompt_tokens", estimate_tokens(call.get("prompt", ""))),
+                call.get("completion_tokens", estimate_tokens(call.get("completion", ""))),
+                time.perf_counter() - start,
+                estimated=estimated
+            )
+
+    def summary(self):
+        """
+        Une ligne par (call_site, modèle), triée par tokens décroissants.
+        """
+        with self._lock:
+            rows = [
+                {"call_site": call_site, "model": model,
+                 **{key: entry[key] for key in ("calls", "cached", "prompt_tokens", "completion_tokens",
+                                                "estimated_calls", "latency_s")},
+                 "total_tokens": entry["prompt_tokens"] + entry["completion_tokens"],
+                 "avg_latency_s": entry["latency_s"] / entry["calls"] if entry["calls"] else 0.0}
+                for (call_site, model), entry in self._usage.items()
+            ]
+        return sorted(rows, key=lambda row: -row["total_tokens"])
+
+    def total_tokens(self):
+        return sum(row["total_tokens"] for row in self.summary())
+
+    def reset(self):
+        with self._lock:
+            self._usage.clear()
+
+    def log(self):
+        for row in self.summary():
+            logging.info(
+                f"LLM {row['call_site']} [{row['model']}]: {row['calls']} calls, {row['cached']} cached, "
+                f"{row['prompt_tokens']}+{row['completion_tokens']} tokens, {row['avg_latency_s']:.2f}s/call"
+            )
+
+
+class BudgetExceeded(RuntimeError):
+    pass
+
+
+class TokenBudget:
+    """
+    Budget de tokens LLM d'un profil ou d'un batch (partageable entre profils).
+
+    Appliqué par CachedChatModel (argument budget ou attribut budget) à
+    tous les appels qui passent par utils.llm (formalité, génération
+    d'emails avec generate_emails.py --token-budget) et par BatchJob à la
+    soumission des lots (batch_jobs.py --token-budget). Chaque appel est
+    refusé si l'estimation de son prompt (4 caractères par token) ne tient
+    plus dans le budget, puis les tokens réels (usage_metadata) sont
+    imputés : des appels simultanés peuvent donc dépasser le budget de leur
+    réponse. Les appels de neo4j_graphrag (page Knowledge Graph) ne passent
+    pas par utils.llm : ils sont comptés dans le LLMUsageLedger mais pas
+    budgétés.
+
+    Pour la formalité, degrade liste, dans l'ordre, les stratégies essayées
+    quand les appels prévus dépasseraient le budget restant :
+        - "truncate" : emails tronqués plus court
+        - "local" : modèle local de formalité, sans LLM
+        - "sample" : seul un échantillon des emails passe par le LLM
+    Avec degrade=() un dépassement lève BudgetExceeded.
+    """
+
+    def __init__(self, max_tokens, degrade=("truncate", "local", "sample")):
+        self.max_tokens = max_tokens
+        self.degrade = tuple(degrade)
+        self.used = 0
+        self.degradations = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        return max(0, self.max_tokens - self.used)
+
+    def fits(self, tokens):
+        return self.used + tokens <= self.max_tokens
+
+    def charge(self, tokens):
+        with self._lock:
+            self.used += tokens
+
+    def to_dict(self):
+        return {
+            "max_tokens": self.max_tokens,
+            "used": self.used,
+            "degradations": dict(self.degradations)
+        }
@@ -0,0 +1,431 @@
+"""
+Jobs de requêtes LLM en masse (API Batch d'OpenAI ou backend local), reprenables
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+from .llm_accounting import estimate_tokens, response_tokens
+from .llm_cache import _serialize_messages, chat_model_name
+
+
+BATCH_JOBS_DIR = os.getenv("BATCH_JOBS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".batch_jobs"))
+
+# Statuts finaux d'un lot côté backend (les autres : en cours)
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Rôles LangChain -> rôles de l'API OpenAI (system est identique)
+OPENAI_ROLES = {"human": "user", "ai": "assistant"}
+LANGCHAIN_ROLES = {role: langchain_role for langchain_role, role in OPENAI_ROLES.items()}
+
+def batch_request_line(request_id, messages, model, temperature=0.0):
+    """
+    Requête au format JSONL de l'API Batch d'OpenAI (/v1/chat/completions).
+    """
+    return {
+        "custom_id": request_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "temperature": temperature,
+            "messages": [{"role": OPENAI_ROLES.get(role, role), "content": content}
+                         for role, content in _serialize_messages(messages)]
+        }
+    }
+
+def batch_request_messages(record):
+    """
+    Messages LangChain d'une requête écrite par batch_request_line (rôles
+    human / ai) : ceux dont CachedChatModel dérive sa clé de cache.
+    """
+    return [(LANGCHAIN_ROLES.get(message["role"], message["role"]), message["content"])
+            for message in record["body"]["messages"]]
+
+def parse_batch_output_line(record):
+    """
+    (custom_id, contenu ou None, usage, erreur) d'une ligne de sortie de l'API Batch.
+    """
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    if record.get("error") or response.get("status_code", 200) != 200 or not body.get("choices"):
+        error = record.get("error") or body.get("error") or {"message": f"status {response.get('status_code')}"}
+        return record["custom_id"], None, {}, error
+    return record["custom_id"], body["choices"][0]["message"]["content"], body.get("usage") or {}, None
+
+
+class LocalBatchBackend:
+    """
+    Backend de lots local, au format de l'API Batch d'OpenAI, pour tester
+    les jobs sans compte ni attente de 24 h.
+
+    Un lot soumis est copié sous root/<id>/ ; il est traité au premier
+    poll après complete_after secondes, avec le chat model load_model(),
+    via scheduler (RequestScheduler) s'il est fourni. Comme pour OpenAI,
+    une soumission avec une clé déjà vue renvoie le lot existant.
+    """
+
+    def __init__(self, load_model, root=os.path.join(BATCH_JOBS_DIR, "local_backend"), complete_after=0.0,
+                 max_workers=8, scheduler=None):
+        self.root = root
+        self.complete_after = complete_after
+        self.max_workers = max_workers
+        self.load_model = load_model
+        self.scheduler = scheduler
+        os.makedirs(root, exist_ok=True)
+
+    def _dir(self, batch_id):
+        return os.path.join(self.root, batch_id)
+
+    def submit(self, path, key, not_before=None):
+        batch_id = "local_" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        batch_dir = self._dir(batch_id)
+        if not os.path.exists(os.path.join(batch_dir, "meta.json")):
+            os.makedirs(batch_dir, exist_ok=True)
+            with open(path, "r", encoding="utf-8") as src, open(os.path.join(batch_dir, "input.jsonl"), "w", encoding="utf-8") as dst:
+                dst.write(src.read())
+            with open(os.path.join(batch_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump({"key": key, "submitted_at": time.time()}, f)
+        return batch_id
+
+    def _process(self, batch_id):
+        from concurrent.futures import ThreadPoolExecutor
+        with open(os.path.join(self._dir(batch_id), "input.jsonl"), "r", encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+
+        def run(request):
+            messages = batch_request_messages(request)
+            try:
+                if self.scheduler is None:
+                    response = self.load_model().invoke(messages)
+                else:
+                    response = self.scheduler.call(self.load_model().invoke, messages)
+            except Exception as e:
+                return {"custom_id": request["custom_id"], "response": None, "error": {"message": str(e)}}
+            prompt_tokens, completion_tokens, _ = response_tokens(response, messages)
+            return {"custom_id": request["custom_id"], "error": None, "response": {"status_code": 200, "body": {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": response.content}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+            }}}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            outputs = list(executor.map(run, requests))
+        output_path = os.path.join(self._dir(batch_id), "output.jsonl")
+        with open(output_path + ".tmp", "w", encoding="utf-8") as f:
+            for output in outputs:
+                f.write(json.dumps(output, ensure_ascii=False) + "\n")
+        os.replace(output_path + ".tmp", output_path)
+
+    def poll(self, batch_id):
+        if os.path.exists(os.path.join(self._dir(batch_id), "output.jsonl")):
+            return "completed"
+        with open(os.path.join(self._dir(batch_id), "meta.json"), "r", encoding="utf-8") as f:
+            submitted_at = json.load(f)["submitted_at"]
+        if time.time() - submitted_at < self.complete_after:
+            return "in_progress"
+        self._process(batch_id)
+        return "completed"
+
+    def results(self, batch_id):
+        with open(os.path.join(self._dir(batch_id), "output.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield parse_batch_output_line(json.loads(line))
+
+
+class OpenAIBatchBackend:
+    """
+    API Batch d'OpenAI : tarif réduit, résultats sous completion_window.
+
+    La clé de soumission est stockée dans les métadonnées du lot : une
+    soumission répétée (reprise après une interruption) retrouve le lot
+    existant au lieu d'en créer un second. La recherche parcourt toutes
+    les pages de batches.list (du plus récent au plus ancien) jusqu'à
+    not_before, l'heure à laquelle le lot a été préparé.
+    """
+
+    def __init__(self, client=None, completion_window="24h"):
+        self._client = client
+        self.completion_window = completion_window
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._client
+
+    def find(self, key, not_before=None):
+        """
+        Id du lot actif soumis avec key, ou None.
+        """
+        page = self.client.batches.list(limit=100)
+        while True:
+            for batch in page.data:
+                if not_before is not None and batch.created_at < not_before:
+                    return None
+                if (batch.metadata or {}).get("job_chunk") == key and batch.status not in ("failed", "expired", "cancelled"):
+                    return batch.id
+            if not page.has_next_page():
+                return None
+            page = page.get_next_page()
+
+    def submit(self, path, key, not_before=None):
+        batch_id = self.find(key, not_before)
+        if batch_id is not None:
+            return batch_id
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+            metadata={"job_chunk": key}
+        )
+        return batch.id
+
+    def poll(self, batch_id):
+        status = self.client.batches.retrieve(batch_id).status
+        return "cancelled" if status == "cancelling" else status
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        # Un lot expiré garde les réponses déjà produites
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                for line in self.client.files.content(file_id).text.splitlines():
+                    if line.strip():
+                        yield parse_batch_output_line(json.loads(line))
+
+
+class BatchJob:
+    """
+    Job de requêtes LLM en masse, sur fichiers, reprenable.
+
+    Dans root :
+        - requests.jsonl : toutes les requêtes (format API Batch), par id
+        - chunks/NNNN.jsonl : les lots soumis au backend
+        - state.json : lots, identifiant backend et statut
+        - results.jsonl : réponses reçues, par id
+
+    add() n'ajoute que les ids absents, submit() n'envoie que les requêtes
+    sans réponse ni lot en cours, poll() fusionne les lots terminés. Un lot
+    est inscrit dans state.json avant d'être soumis, et le backend
+    reconnaît sa clé : relancer après une interruption ne soumet rien en
+    double. Les requêtes en échec sont renvoyées au submit suivant, au plus
+    max_attempts fois.
+
+    Les réponses fusionnées sont aussi écrites dans cache (LLMResponseCache,
+    pour model / temperature) et comptées dans ledger (LLMUsageLedger) sous
+    "batch.<name>", s'ils sont fournis.
+
+    Avec un budget (TokenBudget), un nouveau lot n'est soumis que si
+    l'estimation de ses prompts tient dans le budget restant (moins les
+    lots soumis par ce submit) ; sinon submit s'arrête, over_budget passe à
+    True et run rend la main. Les tokens réels sont imputés à la fusion.
+    """
+
+    def __init__(self, root, backend, name=None, model="gpt-4o-mini", temperature=0.0, chunk_size=50000,
+                 max_attempts=3, cache=None, ledger=None, budget=None):
+        self.root = root
+        self.backend = backend
+        self.name = name or os.path.basename(os.path.normpath(root))
+        self.model = model
+        self.temperature = temperature
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.cache = cache
+        self.ledger = ledger
+        self.budget = budget
+        self.over_budget = False
+        os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+        self._requests_path = os.path.join(root, "requests.jsonl")
+        self._results_path = os.path.join(root, "results.jsonl")
+        self._state_path = os.path.join(root, "state.json")
+        self.state = self._read_state()
+
+    def _read_state(self):
+        if os.path.exists(self._state_path):
+            with open(self._state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {"job_id": hashlib.sha256(os.path.abspath(self.root).encode("utf-8")).hexdigest()[:12]
+                + f"-{int(time.time())}", "chunks": []}
+
+    def _write_state(self):
+        tmp_path = f"{self._state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self._state_path)
+
+    @staticmethod
+    def _read_jsonl(path):
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # Ligne tronquée par une interruption
+                        continue
+
+    def request_ids(self):
+        return [record["custom_id"] for record in self._read_jsonl(self._requests_path)]
+
+    def results(self):
+        """
+        id -> contenu de la réponse, pour les requêtes terminées.
+        """
+        return {record["id"]: record["content"] for record in self._read_jsonl(self._results_path)}
+
+    def add(self, requests):
+        """
+        Ajoute des requêtes (id -> messages) ; les ids déjà présents sont ignorés.
+
+        Returns:
+            int: nombre de requêtes ajoutées
+        """
+        known = set(self.request_ids())
+        added = 0
+        with open(self._requests_path, "a", encoding="utf-8") as f:
+            for request_id, messages in requests.items():
+                if request_id not in known:
+                    known.add(request_id)
+                    f.write(json.dumps(batch_request_line(request_id, messages, self.model, self.temperature),
+                                       ensure_ascii=False) + "\n")
+                    added += 1
+        return added
+
+    def _chunk_ids(self, chunk):
+        return [record["custom_id"] for record in self._read_jsonl(os.path.join(self.root, chunk["file"]))]
+
+    def pending_ids(self):
+        """
+        Ids sans réponse, ni lot en cours, et avec des tentatives restantes.
+        """
+        done = set(self.results())
+        in_flight, attempts = set(), Counter()
+        for chunk in self.state["chunks"]:
+            ids = self._chunk_ids(chunk)
+            attempts.update(ids)
+            if chunk["status"] not in BATCH_TERMINAL_STATUSES | {"merged"}:
+                in_flight.update(ids)
+        return [request_id for request_id in self.request_ids()
+                if request_id not in done and request_id not in in_flight and attempts[request_id] < self.max_attempts]
+
+    def submit(self):
+        """
+        Soumet les requêtes en attente par lots de chunk_size (et termine
+        les soumissions interrompues). Renvoie le nombre de requêtes soumises.
+        """
+        submitted = reserved = 0
+        pending = set(self.pending_ids())
+        if pending:
+            lines = [record for record in self._read_jsonl(self._requests_path) if record["custom_id"] in pending]
+            for start in range(0, len(lines), self.chunk_size):
+                if self.budget is not None:
+                    cost = sum(estimate_tokens(content) for record in lines[start:start + self.chunk_size]
+                               for _, content in batch_request_messages(record))
+                    if not self.budget.fits(reserved + cost):
+                        self.over_budget = True
+                        logging.warning(f"Batch job {self.name}: token budget reached, "
+                                        f"{len(lines) - start} requests not submitted")
+                        break
+                    reserved += cost
+                index = len(self.state["chunks"])
+                chunk = {"file": os.path.join("chunks", f"{index:04d}.jsonl"), "key": f"{self.state['job_id']}:{index}",
+                         "status": "submitting", "batch_id": None, "n_requests": len(lines[start:start + self.chunk_size]),
+                         "created_at": time.time()}
+                with open(os.path.join(self.root, chunk["file"]), "w", encoding="utf-8") as f:
+                    for record in lines[start:start + self.chunk_size]:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                # Inscrit avant la soumission : une reprise resoumet avec la même clé
+                self.state["chunks"].append(chunk)
+                self._write_state()
+        for chunk in self.state["chunks"]:
+            if chunk["status"] == "submitting":
+                # Marge d'une minute pour un éventuel décalage d'horloge avec le backend
+                chunk["batch_id"] = self.backend.submit(os.path.join(self.root, chunk["file"]), chunk["key"],
+                                                        not_before=chunk.get("created_at", 0) - 60)
+                chunk["status"] = "submitted"
+                chunk["submitted_at"] = time.time()
+                self._write_state()
+                submitted += chunk["n_requests"]
+                logging.info(f"Batch job {self.name}: chunk {chunk['file']} ({chunk['n_requests']} requests) "
+                             f"submitted as {chunk['batch_id']}")
+        return submitted
+
+    def _merge(self, chunk):
+        messages_by_id = {
+            record["custom_id"]: batch_request_messages(record)
+            for record in self._read_jsonl(os.path.join(self.root, chunk["file"]))
+        }
+        done = set(self.results())
+        model_name = chat_model_name(self.model, self.temperature)
+        merged = failed = 0
+        with open(self._results_path, "a", encoding="utf-8") as f:
+            for request_id, content, usage, error in self.backend.results(chunk["batch_id"]):
+                if error is not None or request_id not in messages_by_id:
+                    failed += 1
+                    continue
+                if request_id in done:
+                    continue
+                done.add(request_id)
+                f.write(json.dumps({"id": request_id, "content": content, "usage": usage}, ensure_ascii=False) + "\n")
+                if self.cache is not None:
+                    # Messages LangChain (human / ai) et nom de modèle de CachedChatModel :
+                    # llm.invoke sur les mêmes messages est servi par le cache
+                    serialized = _serialize_messages(messages_by_id[request_id])
+                    self.cache.put(self.cache.make_key(model_name, serialized), model_name, serialized, content)
+                if self.ledger is not None:
+                    self.ledger.record(f"batch.{self.name}", model_name, usage.get("prompt_tokens", 0),
+                                       usage.get("completion_tokens", 0))
+                if self.budget is not None:
+                    self.budget.charge(usage.get("prompt_tokens", 0) + usage.get("completion_tokens", 0))
+                merged += 1
+        return merged, failed
+
+    def poll(self):
+        """
+        Interroge les lots en cours et fusionne ceux qui sont terminés.
+
+        Returns:
+            int: nombre de lots encore en cours
+        """
+        running = 0
+        for chunk in self.state["chunks"]:
+            if chunk["status"] != "submitted":
+                continue
+            status = self.backend.poll(chunk["batch_id"])
+            if status not in BATCH_TERMINAL_STATUSES:
+                running += 1
+                continue
+            merged, failed = self._merge(chunk) if status in ("completed", "expired") else (0, chunk["n_requests"])
+            chunk["status"] = "merged" if status == "completed" else status
+            chunk["merged"], chunk["failed"] = merged, failed
+            self._write_state()
+            logging.info(f"Batch job {self.name}: chunk {chunk['file']} {status}, {merged} merged, {failed} failed")
+        return running
+
+    def run(self, poll_interval=60.0):
+        """
+        Soumet, attend et fusionne jusqu'à ce qu'il ne reste rien à soumettre.
+
+        Returns:
+            dict: id -> contenu des réponses
+        """
+        while True:
+            self.submit()
+            while self.poll():
+                time.sleep(poll_interval)
+            if self.over_budget or not self.pending_ids():
+                break
+        results = self.results()
+        missing = len(set(self.request_ids()) - set(results))
+        logging.info(f"Batch job {self.name}: {len(results)} results" + (f", {missing} failed" if missing else ""))
+        return results
@@ -0,0 +1,166 @@
+"""
+Cache disque (SQLite) des réponses LLM et sérialisation des messages LangChain
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class LLMResponseCache:
+    """
+    Cache disque (SQLite) des réponses du LLM, indexé par modèle + hash des messages.
+
+    - max_entries : nombre maximal de réponses conservées (LRU au-delà)
+    - max_age_seconds : âge maximal d'une réponse avant d'être évincée
+    - bypass : si True, le cache n'est ni lu ni écrit
+
+    Le fichier SQLite n'est ouvert (et créé) qu'au premier accès, pas à la
+    construction : importer utils ne crée aucun fichier.
+    """
+
+    def __init__(self, path, max_entries=50000, max_age_seconds=30 * 24 * 3600, bypass=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._created = False
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                if not self._created:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS responses ("
+                        "key TEXT PRIMARY KEY, model TEXT, messages TEXT, content TEXT, "
+                        "created_at REAL, accessed_at REAL)"
+                    )
+                    self._created = True
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(model_name, messages):
+        payload = json.dumps([model_name, messages], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Retourne le contenu en cache pour key, ou None.
+        """
+        if self.bypass:
+            return None
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT content, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.max_age_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else row[0]
+
+    def put(self, key, model_name, messages, content):
+        """
+        Enregistre une réponse puis applique l'éviction (âge puis taille).
+        """
+        if self.bypass:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, json.dumps(messages, ensure_ascii=False), content, now, now)
+            )
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age_seconds,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def contains(self, key):
+        """
+        True si une réponse non expirée est en cache (sans toucher aux compteurs).
+        """
+        if self.bypass:
+            return False
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM responses WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.max_age_seconds)
+            ).fetchone()
+        return row is not None
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def iter_entries(self, model_prefix=""):
+        """
+        Parcourt les réponses stockées : (model, messages, content).
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT model, messages, content FROM responses WHERE model LIKE ?",
+                (model_prefix + "%",)
+            ).fetchall()
+        for model_name, messages, content in rows:
+            yield model_name, json.loads(messages), content
+
+    def stats(self):
+        """
+        Compteurs de hits / misses et nombre d'entrées stockées.
+        """
+        with self._connect() as conn:
+            size = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": size
+        }
+
+
+def _serialize_messages(messages):
+    """
+    Convertit des messages LangChain (tuples ou BaseMessage) en liste JSON.
+    """
+    serialized = []
+    for message in messages:
+        if isinstance(message, (tuple, list)):
+            role, content = message
+        else:
+            role, content = message.type, message.content
+        serialized.append([role, content])
+    return serialized
+
+
+def chat_model_name(model, temperature):
+    """
+    Nom de modèle des clés de cache : une même requête envoyée par
+    CachedChatModel ou par un BatchJob tombe sur la même entrée.
+    """
+    return f"{model}|temperature={temperature}"
+
+
+def _cached_message(content):
+    from langchain_core.messages import AIMessage
+    return AIMessage(content=content, response_metadata={"cached": True})
@@ -0,0 +1,207 @@
+"""
+Chat model avec cache des réponses, comptabilité des tokens, budget et
+ordonnanceur de requêtes
+"""
+
+import contextlib
+import time
+from collections import OrderedDict
+
+from .llm_accounting import BudgetExceeded, estimate_tokens, response_tokens
+from .llm_cache import _cached_message, _serialize_messages, chat_model_name
+
+
+class CachedChatModel:
+    """
+    Enveloppe un chat model LangChain et sert les réponses déjà vues depuis le cache.
+
+    invoke / batch acceptent use_cache=False pour forcer un appel au modèle.
+    Les autres attributs sont délégués au modèle enveloppé, obtenu via
+    load_model() au premier usage.
+
+    Si un sémaphore est fourni (set_semaphore), chaque appel réel au modèle
+    le prend : il peut être partagé entre processus pour borner la
+    concurrence globale.
+
+    Chaque appel (et chaque réponse servie par le cache) est enregistré dans
+    ledger sous call_site (argument de invoke / batch).
+
+    Si un scheduler (RequestScheduler) est fourni, les appels réels passent
+    par lui : concurrence adaptative, retries sur 429 et disjoncteur.
+
+    Si un budget (TokenBudget) est fourni (argument budget de invoke /
+    batch / stream, sinon l'attribut budget), chaque appel réel est refusé
+    (BudgetExceeded) quand l'estimation de son prompt ne tient plus dans le
+    budget restant, puis les tokens réellement consommés (usage_metadata)
+    y sont imputés. Les réponses du cache ne coûtent rien.
+    """
+
+    def __init__(self, load_model, cache, ledger=None, scheduler=None, budget=None):
+        self.load_model = load_model
+        self.cache = cache
+        self.ledger = ledger
+        self.scheduler = scheduler
+        self.budget = budget
+        self.semaphore = None
+
+    def set_semaphore(self, semaphore):
+        self.semaphore = semaphore
+
+    def _invoke_model(self, messages, config=None, **kwargs):
+        if self.semaphore is None:
+            return self.model.invoke(messages, config=config, **kwargs)
+        with self.semaphore:
+            return self.model.invoke(messages, config=config, **kwargs)
+
+    def _call_model(self, messages, config=None, call_site="default", budget=None, **kwargs):
+        start = time.perf_counter()
+        if self.scheduler is None:
+            response = self._invoke_model(messages, config=config, **kwargs)
+        else:
+            response = self.scheduler.call(self._invoke_model, messages, config=config, **kwargs)
+        if self.ledger is not None:
+            self.ledger.record_response(call_site, self._model_name(), response, messages,
+                                        latency_s=time.perf_counter() - start)
+        if budget is not None:
+            prompt_tokens, completion_tokens, _ = response_tokens(response, messages)
+            budget.charge(prompt_tokens + completion_tokens)
+        return response
+
+    def _check_budget(self, budget, inputs, call_site):
+        """
+        Lève BudgetExceeded si les prompts de inputs (estimés) ne tiennent
+        pas dans le budget restant.
+        """
+        if budget is None:
+            return
+        tokens = sum(estimate_tokens(content) for messages in inputs for _, content in _serialize_messages(messages))
+        if not budget.fits(tokens):
+            raise BudgetExceeded(f"{call_site}: ~{tokens} prompt tokens, {budget.remaining} left in the token budget")
+
+    def _record_cached(self, call_site, model_name):
+        if self.ledger is not None:
+            self.ledger.record(call_site, model_name, cached=True)
+
+    def is_cached(self, messages):
+        return self.cache.contains(self.cache.make_key(self._model_name(), _serialize_messages(messages)))
+
+    @property
+    def model(self):
+        return self.load_model()
+
+    def _model_name(self):
+        name = getattr(self.model, "model_name", None) or getattr(self.model, "model", "")
+        return chat_model_name(name, getattr(self.model, "temperature", None))
+
+    def invoke(self, messages, config=None, use_cache=True, call_site="default", budget=None, **kwargs):
+        budget = budget or self.budget
+        model_name = self._model_name()
+        serialized = _serialize_messages(messages)
+        key = self.cache.make_key(model_name, serialized)
+        if use_cache:
+            content = self.cache.get(key)
+            if content is not None:
+                self._record_cached(call_site, model_name)
+                return _cached_message(content)
+        self._check_budget(budget, [messages], call_site)
+        response = self._call_model(messages, config=config, call_site=call_site, budget=budget, **kwargs)
+        if use_cache:
+            self.cache.put(key, model_name, serialized, response.content)
+        return response
+
+    def stream(self, messages, config=None, use_cache=True, call_site="default", stats=None, budget=None, **kwargs):
+        """
+        Génère la réponse morceau par morceau (texte), via model.stream.
+
+        Une réponse en cache est renvoyée en un seul morceau. La réponse
+        complète est mise en cache et comptée dans ledger une fois le flux
+        terminé. Si stats (dict) est fourni, il reçoit ttft_s (délai avant
+        le premier morceau), total_s, cached et text.
+        """
+        stats = {} if stats is None else stats
+        budget = budget or self.budget
+        start = time.perf_counter()
+        model_name = self._model_name()
+        serialized = _serialize_messages(messages)
+        key = self.cache.make_key(model_name, serialized)
+        content = self.cache.get(key) if use_cache else None
+        if content is not None:
+            self._record_cached(call_site, model_name)
+            stats.update(cached=True, ttft_s=time.perf_counter() - start, text=content)
+            yield content
+            stats["total_s"] = time.perf_counter() - start
+            return
+
+        stats["cached"] = False
+        self._check_budget(budget, [messages], call_site)
+        final = None
+        parts = []
+        semaphore = self.semaphore if self.semaphore is not None else contextlib.nullcontext()
+        with semaphore:
+            if self.scheduler is None:
+                chunks = self.model.stream(messages, config=config, **kwargs)
+            else:
+                chunks = self.scheduler.iterate(self.model.stream, messages, config=config, **kwargs)
+            for chunk in chunks:
+                final = chunk if final is None else final + chunk
+                if chunk.content:
+                    if not parts:
+                        stats["ttft_s"] = time.perf_counter() - start
+                    parts.append(chunk.content)
+                    yield chunk.content
+        stats["total_s"] = time.perf_counter() - start
+        stats["text"] = "".join(parts)
+        if self.ledger is not None and final is not None:
+            self.ledger.record_response(call_site, model_name, final, messages, latency_s=stats["total_s"])
+        if budget is not None and final is not None:
+            prompt_tokens, completion_tokens, _ = response_tokens(final, messages)
+            budget.charge(prompt_tokens + completion_tokens)
+        if use_cache:
+            self.cache.put(key, model_name, serialized, stats["text"])
+
+    def batch(self, inputs, config=None, use_cache=True, call_site="default", budget=None, **kwargs):
+        """
+        invoke sur plusieurs entrées, en parallèle (config["max_concurrency"]).
+
+        Les entrées identiques d'un même lot ne donnent qu'un appel : les
+        doublons reçoivent la réponse comme une réponse du cache. config
+        (callbacks, tags, ...) est transmis à chaque appel du modèle. Le
+        budget est vérifié pour l'ensemble des appels avant le premier.
+        """
+        budget = budget or self.budget
+        model_name = self._model_name()
+        results = [None] * len(inputs)
+        # Clé -> (messages, indices) des entrées absentes du cache
+        missing = OrderedDict()
+        for i, messages in enumerate(inputs):
+            serialized = _serialize_messages(messages)
+            key = self.cache.make_key(model_name, serialized)
+            content = self.cache.get(key) if use_cache and key not in missing else None
+            if content is not None:
+                self._record_cached(call_site, model_name)
+                results[i] = _cached_message(content)
+            else:
+                missing.setdefault(key, (serialized, []))[1].append(i)
+        if missing:
+            self._check_budget(budget, [inputs[indices[0]] for _, indices in missing.values()], call_site)
+            from concurrent.futures import ThreadPoolExecutor
+            max_concurrency = (config or {}).get("max_concurrency") or len(missing)
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                responses = list(executor.map(
+                    lambda indices: self._call_model(inputs[indices[0]], config=config, call_site=call_site,
+                                                     budget=budget, **kwargs),
+                    [indices for _, indices in missing.values()]
+                ))
+            for (key, (serialized, indices)), response in zip(missing.items(), responses):
+                if use_cache:
+                    self.cache.put(key, model_name, serialized, response.content)
+                results[indices[0]] = response
+                for i in indices[1:]:
+                    self._record_cached(call_site, model_name)
+                    results[i] = _cached_message(response.content)
+        return results
+
+    def __getattr__(self, name):
+        if name in ("load_model", "cache", "ledger", "scheduler", "budget"):
+            raise AttributeError(name)
+        return getattr(self.model, name)
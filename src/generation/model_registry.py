@@ -0,0 +1,46 @@
+"""
+Registre des modèles lourds (SpaCy, transformers, SentenceTransformer, chat
+model), chargés au premier usage
+"""
+
+import logging
+import threading
+import time
+
+
+class ModelRegistry:
+    """
+    Charge chaque modèle lourd au premier usage, une seule fois par processus.
+
+    register(name, factory) déclare un chargeur, get(name) renvoie l'instance
+    (en la chargeant si besoin) et override(name, instance) remplace un modèle,
+    par exemple par un stub local pour les benchmarks.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+        self.load_times = {}
+
+    def register(self, name, factory):
+        self._factories[name] = factory
+
+    def get(self, name):
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        with self._lock:
+            if name not in self._instances:
+                start = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                self.load_times[name] = time.perf_counter() - start
+                logging.info(f"Model '{name}' loaded in {self.load_times[name]:.2f}s")
+            return self._instances[name]
+
+    def override(self, name, instance):
+        with self._lock:
+            self._instances[name] = instance
+
+    def is_loaded(self, name):
+        return name in self._instances
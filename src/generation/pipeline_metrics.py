@@ -0,0 +1,85 @@
+"""
+Temps par étape et compteurs d'un calcul de profil
+"""
+
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class PipelineMetrics:
+    """
+    Temps par étape et compteurs d'un calcul de profil.
+
+    span(name) chronomètre un bloc (les durées d'un même nom s'additionnent),
+    incr(name, n) incrémente un compteur (appels LLM, tokens, Docs SpaCy,
+    lots, ...). to_dict() donne la version JSON, log() l'écrit dans les logs.
+    """
+
+    def __init__(self):
+        self.timings = Counter()
+        self.span_counts = Counter()
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[name] += elapsed
+                self.span_counts[name] += 1
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def merge(self, other):
+        with self._lock:
+            self.timings.update(other.timings)
+            self.span_counts.update(other.span_counts)
+            self.counters.update(other.counters)
+        return self
+
+    def to_dict(self):
+        return {
+            "timings_s": dict(self.timings),
+            "span_counts": dict(self.span_counts),
+            "counters": dict(self.counters)
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        metrics = cls()
+        metrics.timings.update(data.get("timings_s", {}))
+        metrics.span_counts.update(data.get("span_counts", {}))
+        metrics.counters.update(data.get("counters", {}))
+        return metrics
+
+    def log(self, prefix="profile"):
+        for name, seconds in sorted(self.timings.items(), key=lambda item: -item[1]):
+            logging.info(f"{prefix} {name}: {seconds:.3f}s ({self.span_counts[name]} spans)")
+        for name, value in sorted(self.counters.items()):
+            logging.info(f"{prefix} {name}: {value}")
+
+
+def record_llm_usage(metrics, responses):
+    """
+    Compte les appels LLM, les réponses servies par le cache et les tokens
+    (usage_metadata de LangChain) d'une liste de réponses.
+    """
+    if metrics is None:
+        return
+    for response in responses:
+        if getattr(response, "response_metadata", {}).get("cached"):
+            metrics.incr("llm_cache_hits")
+            continue
+        metrics.incr("llm_calls")
+        usage = getattr(response, "usage_metadata", None) or {}
+        metrics.incr("prompt_tokens", usage.get("input_tokens", 0))
+        metrics.incr("completion_tokens", usage.get("output_tokens", 0))
@@ -0,0 +1,232 @@
+"""
+Ordonnancement des requêtes vers une API limitée en débit : concurrence
+adaptative, retries sur 429 et disjoncteur
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+
+class CircuitOpen(RuntimeError):
+    pass
+
+
+# Codes HTTP réessayés (429 : limite de débit, les autres : erreurs transitoires)
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+def _http_error(exc):
+    """
+    (exception, code HTTP) : exc ou sa première cause portant un code
+    (openai : status_code, urllib : code, httpx : response.status_code).
+
+    neo4j_graphrag enveloppe les erreurs openai, d'où le parcours des causes.
+    """
+    while exc is not None:
+        for value in (getattr(exc, "status_code", None), getattr(exc, "code", None),
+                      getattr(getattr(exc, "response", None), "status_code", None)):
+            if isinstance(value, int):
+                return exc, value
+        exc = exc.__cause__
+    return None, None
+
+def _retry_after(exc):
+    """
+    Délai (s) demandé par le serveur via l'en-tête retry-after / retry-after-ms, sinon None.
+    """
+    exc, _ = _http_error(exc)
+    headers = getattr(exc, "headers", None) or getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        # retry-after au format date HTTP : ignoré, backoff exponentiel
+        pass
+    return None
+
+
+class RequestScheduler:
+    """
+    Ordonnanceur partagé des requêtes vers une API limitée en débit (OpenAI).
+
+    - Concurrence adaptative AIMD : la limite d'appels simultanés augmente
+      d'environ 1 par fenêtre d'appels réussis et est multipliée par
+      decrease à chaque 429 (une fois par épisode : les appels partis avant
+      la dernière baisse ne la déclenchent pas à nouveau).
+    - Retries avec backoff exponentiel à jitter complet ; le retry-after du
+      serveur est respecté et suspend tous les appels jusqu'à son échéance.
+    - Disjoncteur : après failure_threshold échecs consécutifs, les appels
+      échouent immédiatement (CircuitOpen) pendant reset_timeout secondes,
+      puis un seul appel test décide de la réouverture.
+
+    call(fn, ...) exécute fn sous ces règles ; iterate(fn, ...) fait de même
+    pour un générateur (streaming), réessayé seulement avant son premier
+    élément. stats() donne in_flight, queued, throttled, ...
+    """
+
+    def __init__(self, name, initial_concurrency=4, min_concurrency=1, max_concurrency=16, decrease=0.5,
+                 max_retries=6, base_delay=0.5, max_delay=30.0, failure_threshold=10, reset_timeout=30.0,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.name = name
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.sleep = sleep
+        self.clock = clock
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.queued = 0
+        self.counters = Counter()
+        self.state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._paused_until = 0.0
+        self._last_decrease = float("-inf")
+
+    def _acquire(self):
+        with self._cond:
+            self.queued += 1
+            try:
+                while True:
+                    now = self.clock()
+                    if self.state == "open":
+                        if now - self._opened_at < self.reset_timeout:
+                            self.counters["rejected"] += 1
+                            raise CircuitOpen(f"{self.name}: circuit open after "
+                                              f"{self._consecutive_failures} consecutive failures")
+                        self.state = "half_open"
+                    if self.state == "half_open":
+                        if not self._probing and self.in_flight == 0:
+                            self._probing = True
+                            break
+                    elif now >= self._paused_until and self.in_flight < int(self.limit):
+                        break
+                    pause = self._paused_until - now
+                    self._cond.wait(pause if pause > 0 else None)
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+            return self.clock()
+
+    def _release(self, started, outcome, delay=0.0, retry_after=None):
+        with self._cond:
+            self.in_flight -= 1
+            now = self.clock()
+            if outcome in ("success", "error"):
+                # Erreur non réessayable (400, ...) : l'API a répondu, le circuit se referme
+                self._consecutive_failures = 0
+                self.state = "closed"
+                if outcome == "success":
+                    self.counters["succeeded"] += 1
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                else:
+                    self.counters["errors"] += 1
+            else:
+                self.counters[outcome] += 1
+                self._consecutive_failures += 1
+                if outcome == "throttled":
+                    if started >= self._last_decrease:
+                        self.limit = max(self.min_concurrency, self.limit * self.decrease)
+                        self._last_decrease = now
+                    if retry_after:
+                        self._paused_until = max(self._paused_until, now + retry_after)
+                if self.state == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                    if self.state != "open":
+                        logging.warning(f"{self.name}: circuit opened for {self.reset_timeout:.0f}s "
+                                        f"({self._consecutive_failures} consecutive failures)")
+                    self.state = "open"
+                    self._opened_at = now
+            self._probing = False
+            self._cond.notify_all()
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _classify(self, exc):
+        """
+        "throttled" (429), "failed" (erreur transitoire) ou "error" (non réessayable).
+        """
+        error, status = _http_error(exc)
+        if status == 429:
+            # Quota épuisé : réessayer ne sert à rien
+            return "error" if getattr(error, "code", None) == "insufficient_quota" else "throttled"
+        if status in RETRYABLE_STATUS_CODES or (status is not None and status >= 500):
+            return "failed"
+        if status is None and (isinstance(exc, (TimeoutError, ConnectionError))
+                               or type(exc).__name__ in ("APIConnectionError", "APITimeoutError")):
+            return "failed"
+        return "error"
+
+    def call(self, fn, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            started = self._acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                outcome, retry_after = self._classify(e), _retry_after(e)
+                self._release(started, outcome, retry_after=retry_after)
+                self._wait_before_retry(e, outcome, attempt, retry_after)
+                continue
+            self._release(started, "success")
+            return result
+
+    def iterate(self, fn, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            started = self._acquire()
+            outcome, retry_after, error = "success", None, None
+            first = True
+            try:
+                for item in fn(*args, **kwargs):
+                    first = False
+                    yield item
+            except Exception as e:
+                outcome, retry_after, error = self._classify(e), _retry_after(e), e
+                if not first:
+                    raise
+            finally:
+                self._release(started, outcome, retry_after=retry_after)
+            if error is None:
+                return
+            self._wait_before_retry(error, outcome, attempt, retry_after)
+
+    def _wait_before_retry(self, exc, outcome, attempt, retry_after):
+        if outcome == "error" or attempt == self.max_retries or self.state == "open":
+            raise exc
+        with self._cond:
+            self.counters["retries"] += 1
+        self.sleep(self._backoff(attempt, retry_after))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "name": self.name,
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "circuit": self.state,
+                **{key: self.counters[key] for key in ("succeeded", "throttled", "failed", "errors",
+                                                       "retries", "rejected")}
+            }
+
+    def log(self):
+        stats = self.stats()
+        logging.info(
+            f"Scheduler {stats['name']}: {stats['succeeded']} succeeded, {stats['throttled']} throttled, "
+            f"{stats['failed']} failed, {stats['retries']} retries, {stats['rejected']} rejected, "
+            f"concurrency limit {stats['limit']}, circuit {stats['circuit']}"
+        )
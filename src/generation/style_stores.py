@@ -0,0 +1,366 @@
+"""
+Stockage persistant des profils stylistiques et des vecteurs de style
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+from .pipeline_metrics import PipelineMetrics
+
+
+def email_hash(email):
+    return hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+def email_set_hash(emails):
+    """
+    Hash de l'ensemble des emails d'un utilisateur (indépendant de l'ordre).
+    """
+    digests = sorted(email_hash(email) for email in emails)
+    return hashlib.sha256("\n".join(digests).encode("utf-8")).hexdigest()
+
+STYLE_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Nombre d'emails encodés ensemble par le SentenceTransformer
+STYLE_EMBEDDING_BATCH_SIZE = 256
+
+class StyleEmbeddingStore:
+    """
+    Vecteurs de style (style_embedding_model) persistés sur disque, indexés
+    par email_hash : un email déjà vu n'est jamais ré-encodé.
+
+    Les vecteurs (float32, normalisés) sont ajoutés à la suite dans
+    vectors.f32 et relus par np.memmap ; index.json associe chaque hash à
+    sa ligne. Un répertoire par modèle. Un seul processus écrivain à la fois.
+
+    load_model() renvoie le SentenceTransformer, chargé seulement quand un
+    email absent du store doit être encodé.
+    """
+
+    def __init__(self, root, load_model, model_name=STYLE_EMBEDDING_MODEL):
+        self.root = os.path.join(root, model_name.replace("/", "__"))
+        self.load_model = load_model
+        self.model_name = model_name
+        self._vectors_path = os.path.join(self.root, "vectors.f32")
+        self._index_path = os.path.join(self.root, "index.json")
+        self._lock = threading.Lock()
+        self._matrix = None
+        # Le dossier n'est créé qu'à la première écriture (_append)
+        self._index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"dim": None, "rows": {}}
+        # Lignes écrites après la dernière sauvegarde de l'index : ignorées
+        # (elles seront ré-encodées et réécrites à la suite)
+        if data["dim"] and os.path.exists(self._vectors_path):
+            n_rows = os.path.getsize(self._vectors_path) // (4 * data["dim"])
+            data["rows"] = {digest: row for digest, row in data["rows"].items() if row < n_rows}
+        return data
+
+    def _write_index(self):
+        tmp_path = f"{self._index_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+
+    @property
+    def dim(self):
+        return self._index["dim"]
+
+    def __len__(self):
+        return len(self._index["rows"])
+
+    def __contains__(self, email):
+        return email_hash(email) in self._index["rows"]
+
+    def _vectors(self):
+        if self._matrix is None:
+            n_rows = os.path.getsize(self._vectors_path) // (4 * self.dim)
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(n_rows, self.dim))
+        return self._matrix
+
+    def _append(self, digests, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self._index["dim"] = int(vectors.shape[1])
+        # Les lignes sont comptées depuis la taille du fichier : une écriture
+        # interrompue ne décale pas les suivantes
+        os.makedirs(self.root, exist_ok=True)
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        first_row = size // (4 * self.dim)
+        with open(self._vectors_path, "r+b" if size else "wb") as f:
+            f.seek(first_row * 4 * self.dim)
+            f.write(vectors.tobytes())
+        for offset, digest in enumerate(digests):
+            self._index["rows"][digest] = first_row + offset
+        self._matrix = None
+        self._write_index()
+
+    def encode(self, emails, batch_size=STYLE_EMBEDDING_BATCH_SIZE):
+        """
+        Vecteurs de style des emails, en n'encodant que ceux absents du store.
+
+        Params:
+            emails (List[str]): emails à encoder
+            batch_size (int): taille des batches du SentenceTransformer
+
+        Returns:
+            np.ndarray: matrice (len(emails), dim) float32, dans l'ordre des emails
+        """
+        digests = [email_hash(email) for email in emails]
+        with self._lock:
+            missing = {}
+            for digest, email in zip(digests, emails):
+                if digest not in self._index["rows"]:
+                    missing.setdefault(digest, email)
+            if missing:
+                vectors = self.load_model().encode(
+                    list(missing.values()),
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False
+                )
+                self._append(list(missing), vectors)
+            if not digests:
+                return np.zeros((0, self.dim or 0), dtype=np.float32)
+            rows = [self._index["rows"][digest] for digest in digests]
+            return np.array(self._vectors()[rows])
+
+    def centroid(self, emails, batch_size=STYLE_EMBEDDING_BATCH_SIZE):
+        """
+        Vecteur de style moyen d'un ensemble d'emails, renormalisé (norme 1).
+        """
+        vectors = self.encode(emails, batch_size=batch_size)
+        if not len(vectors):
+            return None
+        mean = vectors.mean(axis=0)
+        return (mean / (np.linalg.norm(mean) + 1e-9)).astype(np.float32)
+
+class StyleProfileStore:
+    """
+    Stockage persistant des profils stylistiques, adressé par contenu.
+
+    Chaque profil est enregistré sous sha256(user_id, hash des emails,
+    version). Un utilisateur inchangé est servi depuis le disque ;
+    si ses emails ont changé, le dernier profil connu est servi pendant
+    qu'un nouveau profil est calculé en arrière-plan.
+
+    L'état des accumulateurs est stocké avec chaque profil : quand des
+    emails sont seulement ajoutés, seuls les nouveaux sont traités.
+
+    Le calcul est fourni par l'appelant : accumulate(emails, metrics=...,
+    **kwargs) renvoie un accumulateur (finalize, to_dict) et update(user_id,
+    state, new_emails, metrics=..., **kwargs) renvoie (profil, état). Les
+    profils enregistrés sous une autre version que version ne sont plus
+    servis. embeddings (StyleEmbeddingStore) calcule les vecteurs moyens.
+    """
+
+    def __init__(self, root, accumulate, update, version, embeddings=None, max_workers=1):
+        self.root = root
+        self.accumulate = accumulate
+        self.update = update
+        self.version = version
+        self.embeddings = embeddings
+        self._index_path = os.path.join(root, "index.json")
+        self._lock = threading.Lock()
+        self._executor = None
+        self._max_workers = max_workers
+        self._pending = {}
+
+    def profile_key(self, user_id, emails):
+        payload = json.dumps([user_id, email_set_hash(emails), self.version])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _profile_path(self, key):
+        return os.path.join(self.root, "profiles", f"{key}.json")
+
+    def _state_path(self, key):
+        return os.path.join(self.root, "profiles", f"{key}.state.json")
+
+    def _metrics_path(self, key):
+        return os.path.join(self.root, "profiles", f"{key}.metrics.json")
+
+    def _centroid_path(self, key):
+        return os.path.join(self.root, "profiles", f"{key}.centroid.npy")
+
+    def _read_json(self, path, default):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default
+
+    def _write_json(self, path, data):
+        # Dossiers créés à la première écriture, pas à la construction
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, key):
+        return self._read_json(self._profile_path(key), None)
+
+    def latest(self, user_id):
+        """
+        Dernier profil enregistré pour user_id avec la version courante, ou None.
+        """
+        entry = self._read_json(self._index_path, {}).get(user_id)
+        if entry is None or entry.get("profiler_version") != self.version:
+            return None
+        return self.load(entry["key"])
+
+    def latest_state(self, user_id):
+        """
+        État (accumulateurs + hashes des emails) du dernier profil de user_id, ou None.
+        """
+        entry = self._read_json(self._index_path, {}).get(user_id)
+        if entry is None or entry.get("profiler_version") != self.version:
+            return None
+        return self._read_json(self._state_path(entry["key"]), None)
+
+    def centroid(self, user_id, emails, embeddings=None):
+        """
+        Vecteur de style moyen de user_id, enregistré à côté de son profil.
+
+        Calculé depuis embeddings (self.embeddings par défaut) au premier
+        appel pour cet ensemble d'emails, puis relu depuis le disque.
+        """
+        path = self._centroid_path(self.profile_key(user_id, emails))
+        if os.path.exists(path):
+            return np.load(path)
+        vector = (embeddings or self.embeddings).centroid(emails)
+        if vector is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp.npy"
+            np.save(tmp_path, vector)
+            os.replace(tmp_path, path)
+        return vector
+
+    def latest_centroid(self, user_id):
+        """
+        Vecteur de style moyen du dernier profil de user_id, ou None s'il n'a pas été calculé.
+        """
+        entry = self._read_json(self._index_path, {}).get(user_id)
+        if entry is None or entry.get("profiler_version") != self.version:
+            return None
+        path = self._centroid_path(entry["key"])
+        return np.load(path) if os.path.exists(path) else None
+
+    def latest_metrics(self, user_id):
+        """
+        Temps par étape et compteurs (PipelineMetrics.to_dict) du dernier calcul
+        du profil de user_id, ou None.
+        """
+        entry = self._read_json(self._index_path, {}).get(user_id)
+        if entry is None or entry.get("profiler_version") != self.version:
+            return None
+        return self._read_json(self._metrics_path(entry["key"]), None)
+
+    def save(self, user_id, emails, profile, state=None, metrics=None):
+        key = self.profile_key(user_id, emails)
+        self._write_json(self._profile_path(key), profile)
+        if metrics is not None:
+            self._write_json(self._metrics_path(key), metrics.to_dict())
+        if state is not None:
+            self._write_json(self._state_path(key), {
+                "email_hashes": dict(Counter(email_hash(email) for email in emails)),
+                "accumulator": state
+            })
+        with self._lock:
+            index = self._read_json(self._index_path, {})
+            index[user_id] = {
+                "key": key,
+                "email_set_hash": email_set_hash(emails),
+                "profiler_version": self.version,
+                "n_emails": len(emails),
+                "updated_at": datetime.now().isoformat()
+            }
+            self._write_json(self._index_path, index)
+        return key
+
+    def build(self, user_id, emails, **kwargs):
+        """
+        Calcule et enregistre le profil de user_id.
+
+        Si les emails du dernier profil sont tous encore présents, seuls les
+        emails ajoutés sont traités et fusionnés avec l'état stocké. Les temps
+        et compteurs du calcul sont enregistrés avec le profil.
+        """
+        metrics = kwargs.pop("metrics", None) or PipelineMetrics()
+        previous = self.latest_state(user_id)
+        if previous is not None:
+            remaining = Counter(previous["email_hashes"])
+            new_emails = []
+            for email in emails:
+                digest = email_hash(email)
+                if remaining[digest] > 0:
+                    remaining[digest] -= 1
+                else:
+                    new_emails.append(email)
+            if not +remaining:
+                with metrics.span("total"):
+                    profile, state = self.update(
+                        user_id, previous["accumulator"], new_emails, metrics=metrics, **kwargs
+                    )
+                self.save(user_id, emails, profile, state, metrics=metrics)
+                return profile
+
+        with metrics.span("total"):
+            accumulator = self.accumulate(emails, metrics=metrics, **kwargs)
+            profile = accumulator.finalize(user_id)
+        self.save(user_id, emails, profile, accumulator.to_dict(), metrics=metrics)
+        return profile
+
+    def _refresh(self, user_id, emails):
+        try:
+            return self.build(user_id, emails)
+        finally:
+            with self._lock:
+                self._pending.pop(user_id, None)
+
+    def refresh_in_background(self, user_id, emails):
+        """
+        Planifie le recalcul du profil (une seule tâche en cours par utilisateur).
+        """
+        with self._lock:
+            if user_id in self._pending:
+                return self._pending[user_id]
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+            future = self._executor.submit(self._refresh, user_id, emails)
+            self._pending[user_id] = future
+            return future
+
+    def is_refreshing(self, user_id):
+        with self._lock:
+            return user_id in self._pending
+
+    def get_or_build(self, user_id, emails, background=True):
+        """
+        Retourne (profil, statut) :
+            - "fresh" : profil à jour lu depuis le store
+            - "stale" : ancien profil servi, recalcul lancé en arrière-plan
+            - "built" : profil calculé maintenant (utilisateur jamais vu)
+        """
+        profile = self.load(self.profile_key(user_id, emails))
+        if profile is not None:
+            return profile, "fresh"
+
+        previous = self.latest(user_id)
+        if previous is not None and background:
+            self.refresh_in_background(user_id, emails)
+            return previous, "stale"
+
+        return self.build(user_id, emails), "built"
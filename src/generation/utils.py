@@ -11,56 +11,161 @@ Utils functions for the project
 import os
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import re
 import pickle
 from typing import List, Tuple
-import json
-import spacy
-import nltk
 import statistics
+import math
 import pandas as pd
-from transformers import pipeline
-from sentence_transformers import SentenceTransformer
-from collections import Counter
+from collections import Counter, OrderedDict
 from dotenv import load_dotenv
-# from langchain_community.chat_models import ChatOpenAI
-from langchain_openai import ChatOpenAI
-import json
 from datetime import datetime
+import threading
+import heapq
+import time
+import logging
+from contextlib import contextmanager
+
+# Les bibliothèques lourdes (spacy, transformers, sentence_transformers,
+# langchain_openai, nltk, matplotlib) sont importées au premier usage,
+# voir ModelRegistry.
+
+# Infrastructure (registre, cache, comptabilité, ordonnanceur, stores, index,
+# batch jobs) : modules voisins du package src.generation, ré-exportés ici pour
+# les appelants existants (utils.BatchJob, utils.RequestScheduler, ...).
+from .model_registry import ModelRegistry  # noqa: F401
+from .llm_cache import LLMResponseCache, _cached_message, _serialize_messages, chat_model_name  # noqa: F401
+from .llm_client import CachedChatModel  # noqa: F401
+from .llm_accounting import (  # noqa: F401
+    BudgetExceeded, LLMUsageLedger, TokenBudget, estimate_tokens, response_tokens
+)
+from .pipeline_metrics import PipelineMetrics, record_llm_usage  # noqa: F401
+from .request_scheduler import RETRYABLE_STATUS_CODES, CircuitOpen, RequestScheduler  # noqa: F401
+from .style_stores import (  # noqa: F401
+    STYLE_EMBEDDING_BATCH_SIZE, STYLE_EMBEDDING_MODEL, StyleEmbeddingStore, StyleProfileStore, email_hash,
+    email_set_hash
+)
+from .vector_index import StyleVectorIndex  # noqa: F401
+from .llm_batch import (  # noqa: F401
+    BATCH_JOBS_DIR, BATCH_TERMINAL_STATUSES, LANGCHAIN_ROLES, OPENAI_ROLES, BatchJob, LocalBatchBackend,
+    OpenAIBatchBackend, batch_request_line, batch_request_messages, parse_batch_output_line
+)
 
 ############################################
 # Configuration
 ############################################
 
-# Télécharge les ressources NLTK
-nltk.download('punkt')
-nltk.download('stopwords')
-from nltk.corpus import stopwords
+# Ressources NLTK : téléchargées seulement si absentes
+NLTK_RESOURCES = {
+    "punkt": "tokenizers/punkt",
+    "stopwords": "corpora/stopwords",
+}
 
-# Charge SpaCy
-nlp = spacy.load("en_core_web_lg")
+def ensure_nltk_resources():
+    """
+    Télécharge les ressources NLTK manquantes (aucun appel réseau si elles sont présentes).
+    """
+    import nltk
+    for package, resource_path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(resource_path)
+        except LookupError:
+            nltk.download(package)
+    return nltk
+
+def _load_nlp():
+    import spacy
+    return spacy.load("en_core_web_lg")
+
+def _load_sentiment_classifier():
+    from transformers import pipeline
+    return pipeline(
+        "sentiment-analysis",
+        model="nlptown/bert-base-multilingual-uncased-sentiment"
+    )
 
-# Pipeline de sentiment (exemple)
-sentiment_classifier = pipeline(
-    "sentiment-analysis",
-    model="nlptown/bert-base-multilingual-uncased-sentiment"
-)
+def _load_style_embedding_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(STYLE_EMBEDDING_MODEL)
+
+def _load_chat_model():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        api_key=api_key,
+        temperature=0.0,
+        # Usage (tokens) renvoyé aussi en mode streaming
+        stream_usage=True,
+        # Les retries sont gérés par llm_scheduler
+        max_retries=0
+    )
+
+def _load_stopwords():
+    ensure_nltk_resources()
+    from nltk.corpus import stopwords
+    return set(stopwords.words("english"))
 
+models = ModelRegistry()
+# Charge SpaCy
+models.register("nlp", _load_nlp)
+# Pipeline de sentiment (exemple)
+models.register("sentiment_classifier", _load_sentiment_classifier)
 # Embeddings
-style_embedding_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+models.register("style_embedding_model", _load_style_embedding_model)
+# LLM
+models.register("chat_model", _load_chat_model)
+models.register("stopwords", _load_stopwords)
+
+def get_nlp():
+    return models.get("nlp")
+
+def get_sentiment_classifier():
+    return models.get("sentiment_classifier")
+
+def get_style_embedding_model():
+    return models.get("style_embedding_model")
+
+def __getattr__(name):
+    # Compatibilité : generation_utils.nlp, .sentiment_classifier, ...
+    if name in ("nlp", "sentiment_classifier", "style_embedding_model", "stopwords"):
+        return models.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Composants SpaCy réellement utilisés par chaque mesure
+# (tok2vec est conservé dès qu'un composant entraîné est nécessaire)
+MEASURE_COMPONENTS = {
+    "anonymize": {"ner"},
+    "attitude": set(),
+    "vocabulary": set(),
+    "syntax": {"parser"},
+    "recurrence": set(),
+    "rhythm": {"parser"},
+}
+
+# Paramètres par défaut de nlp.pipe
+SPACY_BATCH_SIZE = 64
+SPACY_N_PROCESS = 1
 
 # Chargement variables d’environnement
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 
-# Configuration du LLM Llama-3
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    api_key=api_key,
-    temperature=0.0
+# Cache des réponses LLM (LLM_CACHE_BYPASS=1 pour le désactiver)
+llm_cache = LLMResponseCache(
+    os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache.sqlite")),
+    bypass=os.getenv("LLM_CACHE_BYPASS", "0") == "1"
 )
 
+# Comptabilité des tokens (LLM_USAGE_LOG : fichier JSONL optionnel)
+llm_usage = LLMUsageLedger(os.getenv("LLM_USAGE_LOG"))
+
+# Ordonnanceurs des requêtes OpenAI, un par limite de débit (chat, embeddings)
+llm_scheduler = RequestScheduler("chat", max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")))
+embedding_scheduler = RequestScheduler("embeddings", max_concurrency=int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "16")))
+
+# Configuration du LLM Llama-3 (ChatOpenAI construit au premier appel)
+llm = CachedChatModel(lambda: models.get("chat_model"), llm_cache, ledger=llm_usage, scheduler=llm_scheduler)
+
 
 ############################################
 # EDA Functions
@@ -76,6 +181,8 @@ def plot_na(data:pd.DataFrame) -> None:
     Returns:
         None
     """
+    import matplotlib.pyplot as plt
+
     missing_percentage = data.isnull().mean() * 100  
     missing_count = data.isnull().sum()
 
@@ -138,43 +245,153 @@ def keep_valid_senders(X) -> Tuple[List[str], List[str]]:
 # 1. Tone Classification (Formality, Emotion, Attitude)
 ########################################################################
 
-def classify_formality_llama(text):
-    """
-    Detects whether the text is FORMAL or INFORMAL using Llama-3.
-    """
-    system_prompt = """You are an expert linguist.
+FORMALITY_SYSTEM_PROMPT = """You are an expert linguist.
     Classify an email as either "FORMAL" or "INFORMAL" based on:
     - FORMAL: Polite, professional, no slang, well-structured.
     - INFORMAL: Casual language, slang, contractions, personal style.
     Respond ONLY with "FORMAL" or "INFORMAL".
     """
-    user_prompt = f"Email:\n{text}\n"
 
-    response = llm.invoke([
-        ("system", system_prompt),
+# Nombre maximal de requêtes de formalité envoyées en parallèle
+FORMALITY_MAX_CONCURRENCY = 8
+
+# Troncature des emails envoyés au LLM (FORMALITY_MIN_CHARS : plancher
+# quand le budget de tokens impose de tronquer davantage)
+FORMALITY_MAX_CHARS = 2000
+FORMALITY_MIN_CHARS = 300
+
+def formality_messages(text):
+    """
+    Construit les messages envoyés au LLM pour classer un email.
+    """
+    user_prompt = f"Email:\n{text}\n"
+    return [
+        ("system", FORMALITY_SYSTEM_PROMPT),
         ("human", user_prompt)
-    ])
-    label = response.content.strip().upper()
+    ]
+
+def parse_formality_label(content):
+    """
+    Normalise la réponse du LLM, FORMAL par défaut si elle est inattendue.
+    """
+    label = content.strip().upper()
     if label not in ["FORMAL", "INFORMAL"]:
         label = "FORMAL"
     return label
 
-def detect_emotion(text):
+def classify_formality_llama(text):
     """
-    'emotional' si sentiment extrême (1 star / 5 stars), sinon 'neutral'.
+    Detects whether the text is FORMAL or INFORMAL using Llama-3.
+    """
+    response = llm.invoke(formality_messages(text))
+    return parse_formality_label(response.content)
+
+def formality_cost(text):
+    """
+    Tokens estimés d'un appel de classification (prompt + réponse).
+    """
+    return sum(estimate_tokens(content) for _, content in formality_messages(text)) + 4
+
+def classify_formality_batch(texts, max_concurrency=FORMALITY_MAX_CONCURRENCY, metrics=None, budget=None):
+    """
+    Classe plusieurs emails en parallèle via llm.batch.
+
+    Params:
+        texts (List[str]): emails (déjà tronqués si besoin)
+        max_concurrency (int): nombre maximal d'appels simultanés
+        metrics (PipelineMetrics): si fourni, reçoit appels LLM et tokens
+        budget (TokenBudget): si fourni, les appels sont vérifiés et imputés
+            sur ce budget (voir CachedChatModel)
+
+    Returns:
+        List[str]: "FORMAL" / "INFORMAL" pour chaque email, dans le même ordre
     """
-    result = sentiment_classifier(text[:512])[0]
-    label = result['label']  # e.g., "1 star", "2 stars", ...
+    if not texts:
+        return []
+    inputs = [formality_messages(text) for text in texts]
+    responses = llm.batch(inputs, config={"max_concurrency": max_concurrency}, call_site="formality", budget=budget)
+    record_llm_usage(metrics, responses)
+    return [parse_formality_label(response.content) for response in responses]
+
+# Paramètres par défaut de l'inférence de sentiment
+SENTIMENT_BATCH_SIZE = 16
+SENTIMENT_MAX_TOKENS = 512
+
+def _emotion_from_label(label):
+    # label e.g., "1 star", "2 stars", ...
     if label in ["1 star", "5 stars"]:
         return "emotional"
     else:
         return "neutral"
 
-def detect_attitude(text):
+def detect_emotion(text):
+    """
+    'emotional' si sentiment extrême (1 star / 5 stars), sinon 'neutral'.
+    """
+    return detect_emotions([text])[0]
+
+@contextmanager
+def torch_num_threads(num_threads):
+    """
+    Fixe le nombre de threads torch (CPU) le temps du bloc, puis remet la
+    valeur précédente : le réglage est global au processus.
+    """
+    if num_threads is None:
+        yield
+        return
+    import torch
+    previous = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+def detect_emotions(texts, batch_size=SENTIMENT_BATCH_SIZE, num_threads=None, metrics=None):
+    """
+    Version par lots de detect_emotion.
+
+    Les emails sont triés par longueur pour limiter le padding, passés au
+    pipeline par lots et tronqués par le tokenizer (SENTIMENT_MAX_TOKENS).
+
+    Params:
+        texts (List[str]): emails
+        batch_size (int): taille des lots envoyés au modèle
+        num_threads (int): si fourni, nombre de threads torch (CPU) pendant l'inférence
+        metrics (PipelineMetrics): si fourni, reçoit le nombre de lots
+
+    Returns:
+        List[str]: 'emotional' / 'neutral' pour chaque email, dans le même ordre
+    """
+    if not texts:
+        return []
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    start = time.perf_counter()
+    with torch_num_threads(num_threads):
+        results = get_sentiment_classifier()(
+            [texts[i] for i in order],
+            batch_size=batch_size,
+            padding=True,
+            truncation=True,
+            max_length=SENTIMENT_MAX_TOKENS
+        )
+    elapsed = time.perf_counter() - start
+    if metrics is not None:
+        metrics.incr("sentiment_batches", math.ceil(len(texts) / batch_size))
+    logging.info(f"detect_emotions: {len(texts)} emails, {len(texts) / (elapsed + 1e-9):.1f} emails/s")
+
+    emotions = [None] * len(texts)
+    for i, result in zip(order, results):
+        emotions[i] = _emotion_from_label(result['label'])
+    return emotions
+
+def detect_attitude(text, doc=None):
     """
     'assertive' vs 'attenuated' selon la fréquence de modaux comme could/would.
+    Accepte un Doc SpaCy déjà parsé pour éviter de re-parser le texte.
     """
-    doc = nlp(text)
+    if doc is None:
+        doc = get_nlp()(text, disable=components_to_disable(["attitude"]))
     modals = {"could", "would", "might", "maybe", "perhaps"}
     modal_count = sum(1 for token in doc if token.text.lower() in modals)
 
@@ -184,300 +401,1555 @@ def detect_attitude(text):
     else:
         return "assertive"
 
+class ToneAccumulator:
+    """
+    Compteurs de formalité, d'émotion et d'attitude.
+
+    Un label de formalité None (email non classé, budget de tokens) n'entre
+    pas dans le ratio de formalité.
+    """
+
+    def __init__(self):
+        self.formal_count = 0
+        self.formality_total = 0
+        self.total_emails = 0
+        self.emotions = Counter()
+        self.attitudes = Counter()
+
+    def add(self, form_label, emotion, attitude):
+        if form_label == "FORMAL":
+            self.formal_count += 1
+        if form_label is not None:
+            self.formality_total += 1
+        self.total_emails += 1
+        self.emotions[emotion] += 1
+        self.attitudes[attitude] += 1
+
+    def merge(self, other):
+        self.formal_count += other.formal_count
+        self.formality_total += other.formality_total
+        self.total_emails += other.total_emails
+        self.emotions.update(other.emotions)
+        self.attitudes.update(other.attitudes)
+        return self
+
+    def finalize(self):
+        ratio_formal = self.formal_count / (self.formality_total + 1e-9)
+        if ratio_formal > 0.7:
+            formality_degree = "mostly_formal"
+        elif ratio_formal < 0.3:
+            formality_degree = "mostly_informal"
+        else:
+            formality_degree = "mixed"
+
+        if self.emotions:
+            main_emotion = self.emotions.most_common(1)[0][0]
+        else:
+            main_emotion = "neutral"
+
+        if self.attitudes:
+            main_attitude = self.attitudes.most_common(1)[0][0]
+        else:
+            main_attitude = "assertive"
+
+        return {
+            "formality_degree": formality_degree,
+            "emotional_expression": main_emotion,
+            "attitude": main_attitude
+        }
+
+    def to_dict(self):
+        return {
+            "formal_count": self.formal_count,
+            "formality_total": self.formality_total,
+            "total_emails": self.total_emails,
+            "emotions": list(self.emotions.items()),
+            "attitudes": list(self.attitudes.items())
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls()
+        acc.formal_count = data["formal_count"]
+        acc.total_emails = data["total_emails"]
+        acc.formality_total = data.get("formality_total", data["total_emails"])
+        acc.emotions = Counter(dict(data["emotions"]))
+        acc.attitudes = Counter(dict(data["attitudes"]))
+        return acc
+
 ########################################################################
-# 2. Vocabulary
+# 1 bis. Tiered formality classifier (local model + LLM fallback)
 ########################################################################
 
-def measure_vocabulary(emails):
+FORMALITY_FEATURES = [
+    "modal_ratio", "avg_word_length", "punctuation_ratio", "polite_words",
+    "closing_formula", "paragraph_segments", "logical_connectors",
+    "contraction_ratio", "exclamation_ratio", "lowercase_i_ratio", "log_length"
+]
+FORMALITY_MODEL_PATH = os.getenv(
+    "FORMALITY_MODEL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "formality_model.npz")
+)
+# Probabilité minimale pour que le modèle local décide sans le LLM
+FORMALITY_CONFIDENCE = 0.9
+
+def formality_features(text, doc):
     """
-    - Word type => 'sophisticated' vs 'common' (via avg word length)
-    - Lexical richness (TTR)
-    - Jargon presence
+    Caractéristiques d'un email pour le modèle local (voir FORMALITY_FEATURES).
+    Seuls les tokens du Doc sont utilisés (pas besoin du parser).
+    """
+    n_tokens = len(doc) + 1e-9
+    alpha = [t.text for t in doc if t.is_alpha]
+    lower_words = text.lower().split()
+    n_words = len(lower_words) + 1e-9
+    lines = text.lower().strip().split("\n")
+    return np.array([
+        sum(1 for t in doc if t.text.lower() in {"could", "would", "might", "maybe", "perhaps"}) / n_tokens,
+        sum(len(w) for w in alpha) / (len(alpha) + 1e-9),
+        len(PUNCTUATION_RE.findall(text)) / n_words,
+        sum(text.lower().count(w) for w in POLITE_WORDS),
+        float(any(c in lines[-1] for c in CLOSINGS)),
+        text.count("\n\n") + 1,
+        sum(1 for w in lower_words if w in CONNECTORS),
+        sum(1 for t in doc if t.text.startswith("'") or t.text.lower() == "n't") / n_tokens,
+        text.count("!") / n_words,
+        sum(1 for t in doc if t.text == "i") / n_tokens,
+        np.log1p(len(doc))
+    ], dtype=np.float64)
+
+class LocalFormalityModel:
+    """
+    Régression logistique (NumPy) FORMAL / INFORMAL sur FORMALITY_FEATURES,
+    entraînée sur les réponses passées du LLM.
     """
-    full_text = " ".join(emails)
-    doc = nlp(full_text)
-
-    # TTR
-    tokens = [t.text.lower() for t in doc if t.is_alpha]
-    vocab = set(tokens)
-    ttr = len(vocab) / (len(tokens) + 1e-9)
 
-    # Avg word length
-    avg_word_len = statistics.mean([len(t) for t in tokens]) if tokens else 0
+    def __init__(self, weights=None, bias=0.0, mean=None, std=None):
+        self.weights = weights
+        self.bias = bias
+        self.mean = mean
+        self.std = std
+
+    def fit(self, X, y, epochs=500, learning_rate=0.1, l2=1e-3):
+        self.mean = X.mean(axis=0)
+        self.std = X.std(axis=0) + 1e-9
+        Z = (X - self.mean) / self.std
+        self.weights = np.zeros(Z.shape[1])
+        self.bias = 0.0
+        for _ in range(epochs):
+            p = 1.0 / (1.0 + np.exp(-(Z @ self.weights + self.bias)))
+            self.weights -= learning_rate * (Z.T @ (p - y) / len(y) + l2 * self.weights)
+            self.bias -= learning_rate * float(np.mean(p - y))
+        return self
+
+    def predict_proba(self, X):
+        """
+        Probabilité que chaque email soit FORMAL.
+        """
+        Z = (np.atleast_2d(X) - self.mean) / self.std
+        return 1.0 / (1.0 + np.exp(-(Z @ self.weights + self.bias)))
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=self.bias, mean=self.mean, std=self.std)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["weights"], float(data["bias"]), data["mean"], data["std"])
+
+def _load_formality_model():
+    if not os.path.exists(FORMALITY_MODEL_PATH):
+        return None
+    return LocalFormalityModel.load(FORMALITY_MODEL_PATH)
+
+models.register("formality_model", _load_formality_model)
+
+def harvest_formality_labels(cache=None):
+    """
+    Récupère les couples (email, label) des classifications passées du LLM
+    stockées dans le cache de réponses.
+    """
+    cache = cache or llm_cache
+    examples = []
+    for _, messages, content in cache.iter_entries():
+        if len(messages) != 2 or messages[0] != ["system", FORMALITY_SYSTEM_PROMPT]:
+            continue
+        prompt = messages[1][1]
+        if prompt.startswith("Email:\n") and prompt.endswith("\n"):
+            examples.append((prompt[len("Email:\n"):-1], parse_formality_label(content)))
+    return examples
+
+def train_local_formality_model(examples=None, path=None, min_examples=50):
+    """
+    Entraîne et enregistre le modèle local à partir des labels du LLM.
 
-    # Heuristic
-    word_type = "sophisticated" if avg_word_len > 5.0 else "common"
+    Returns:
+        LocalFormalityModel ou None s'il n'y a pas assez d'exemples
+    """
+    examples = examples if examples is not None else harvest_formality_labels()
+    labels = {label for _, label in examples}
+    if len(examples) < min_examples or len(labels) < 2:
+        logging.warning(f"Not enough formality labels to train a local model ({len(examples)})")
+        return None
+    texts = [text for text, _ in examples]
+    docs = parse_emails(texts, measures=["attitude"])
+    X = np.vstack([formality_features(text, doc) for text, doc in zip(texts, docs)])
+    y = np.array([1.0 if label == "FORMAL" else 0.0 for _, label in examples])
+    model = LocalFormalityModel().fit(X, y)
+    accuracy = float(np.mean((model.predict_proba(X) >= 0.5) == (y == 1.0)))
+    logging.info(f"Local formality model: {len(examples)} examples, training accuracy {accuracy:.3f}")
+    model.save(path or FORMALITY_MODEL_PATH)
+    models.override("formality_model", model)
+    return model
+
+def classify_formality_tiered(texts, docs, model=None, confidence=FORMALITY_CONFIDENCE,
+                              max_concurrency=FORMALITY_MAX_CONCURRENCY, audit_rate=0.0, seed=0, metrics=None,
+                              budget=None):
+    """
+    Classe la formalité avec le modèle local et n'envoie au LLM que les
+    emails dont la probabilité est sous le seuil de confiance.
 
-    # Jargon detection
-    jargon_keywords = {"swap", "hedge", "futures", "synergy", "compliance", "litigation", "forex", "collateral"}
-    jargon_count = sum(1 for w in tokens if w in jargon_keywords)
-    if jargon_count > 10:
-        jargon_presence = "high"
-    else:
-        jargon_presence = "low"
+    Params:
+        texts (List[str]): emails (non tronqués)
+        docs (List[Doc]): Docs SpaCy des emails
+        model (LocalFormalityModel): modèle local (par défaut celui du registre)
+        confidence (float): probabilité minimale pour décider localement
+        audit_rate (float): part des emails décidés localement aussi envoyés
+            au LLM pour mesurer l'accord
+        seed (int): graine du tirage des emails audités
+        metrics (PipelineMetrics): si fourni, reçoit appels LLM et décisions locales
+        budget (TokenBudget): si fourni, les appels LLM passent par
+            classify_formality_budgeted
 
-    return {
-        "word_type": word_type,
-        "lexical_richness_TTR": ttr,
-        "jargon_presence": jargon_presence,
-        "avg_word_length": avg_word_len
+    Returns:
+        List[str]: labels FORMAL / INFORMAL
+        dict: rapport (taux d'escalade, accord local / LLM)
+    """
+    def ask_llm(indices):
+        if budget is not None:
+            return classify_formality_budgeted([texts[i] for i in indices], [docs[i] for i in indices], budget,
+                                               max_concurrency=max_concurrency, metrics=metrics)
+        return classify_formality_batch([texts[i][:FORMALITY_MAX_CHARS] for i in indices],
+                                        max_concurrency=max_concurrency, metrics=metrics)
+
+    model = model or models.get("formality_model")
+    if model is None or not texts:
+        labels = ask_llm(range(len(texts)))
+        return labels, {"n": len(texts), "escalated": len(texts), "escalation_rate": 1.0 if texts else 0.0,
+                        "audited": 0, "agreement": None}
+
+    X = np.vstack([formality_features(text, doc) for text, doc in zip(texts, docs)])
+    proba = model.predict_proba(X)
+    local_labels = ["FORMAL" if p >= 0.5 else "INFORMAL" for p in proba]
+    confident = np.maximum(proba, 1.0 - proba) >= confidence
+
+    rng = np.random.default_rng(seed)
+    escalated = [i for i in range(len(texts)) if not confident[i]]
+    audited = [i for i in range(len(texts)) if confident[i] and rng.random() < audit_rate]
+    to_llm = escalated + audited
+    # Un label None (email écarté par le budget) garde la décision locale
+    llm_labels = {i: label for i, label in zip(to_llm, ask_llm(to_llm)) if label is not None}
+    if metrics is not None:
+        metrics.incr("formality_local", len(texts) - len(escalated))
+
+    labels = [llm_labels[i] if i in llm_labels and not confident[i] else local_labels[i] for i in range(len(texts))]
+    agreement = (
+        sum(1 for i in llm_labels if llm_labels[i] == local_labels[i]) / len(llm_labels) if llm_labels else None
+    )
+    report = {
+        "n": len(texts),
+        "escalated": len(escalated),
+        "escalation_rate": len(escalated) / len(texts),
+        "audited": len(audited),
+        "agreement": agreement
     }
+    logging.info(
+        f"Tiered formality: {report['escalated']}/{report['n']} escalated "
+        f"({report['escalation_rate']:.1%}), agreement {agreement}"
+    )
+    return labels, report
+
+def classify_formality_budgeted(texts, docs, budget, max_concurrency=FORMALITY_MAX_CONCURRENCY, metrics=None,
+                                seed=0):
+    """
+    classify_formality_batch sous un budget de tokens.
+
+    Si les appels prévus (emails déjà en cache exclus) tiennent dans le
+    budget restant, ils sont faits tels quels. Sinon les stratégies de
+    budget.degrade sont essayées dans l'ordre :
+        - "truncate" : troncature plus courte, jusqu'à FORMALITY_MIN_CHARS
+        - "local" : modèle local de formalité, si un modèle est entraîné
+        - "sample" : seuls les emails qui tiennent dans le budget (tirés au
+          hasard) sont classés, les autres reçoivent None
+    Sans stratégie applicable, lève BudgetExceeded.
+
+    Returns:
+        List[str]: FORMAL / INFORMAL, ou None pour un email non classé
+    """
+    def costs(max_chars):
+        return [
+            0 if llm.is_cached(formality_messages(text[:max_chars])) else formality_cost(text[:max_chars])
+            for text in texts
+        ]
+
+    def degraded(strategy):
+        budget.degradations[strategy] += 1
+        if metrics is not None:
+            metrics.incr(f"budget_{strategy}")
+
+    if not texts or budget.fits(sum(costs(FORMALITY_MAX_CHARS))):
+        return classify_formality_batch([text[:FORMALITY_MAX_CHARS] for text in texts],
+                                        max_concurrency=max_concurrency, metrics=metrics, budget=budget)
+
+    for strategy in budget.degrade:
+        if strategy == "truncate":
+            max_chars = FORMALITY_MAX_CHARS // 2
+            while max_chars >= FORMALITY_MIN_CHARS:
+                if budget.fits(sum(costs(max_chars))):
+                    degraded("truncate")
+                    return classify_formality_batch([text[:max_chars] for text in texts],
+                                                    max_concurrency=max_concurrency, metrics=metrics, budget=budget)
+                max_chars //= 2
+        elif strategy == "local":
+            model = models.get("formality_model")
+            if model is not None:
+                degraded("local")
+                labels, _ = classify_formality_tiered(texts, docs, model=model, confidence=0.0, metrics=metrics)
+                return labels
+        elif strategy == "sample":
+            degraded("sample")
+            max_chars = FORMALITY_MIN_CHARS if "truncate" in budget.degrade else FORMALITY_MAX_CHARS
+            email_costs = costs(max_chars)
+            order = np.random.default_rng(seed).permutation(len(texts))
+            chosen, total = [], 0
+            for i in order:
+                if budget.fits(total + email_costs[i]):
+                    chosen.append(int(i))
+                    total += email_costs[i]
+            chosen.sort()
+            labels = [None] * len(texts)
+            for i, label in zip(chosen, classify_formality_batch(
+                [texts[i][:max_chars] for i in chosen], max_concurrency=max_concurrency, metrics=metrics,
+                budget=budget
+            )):
+                labels[i] = label
+            if metrics is not None:
+                metrics.incr("formality_skipped", len(texts) - len(chosen))
+            return labels
+
+    raise BudgetExceeded(
+        f"Formality classification of {len(texts)} emails needs ~{sum(costs(FORMALITY_MAX_CHARS))} tokens, "
+        f"{budget.remaining} left"
+    )
+
+########################################################################
+# 2. Vocabulary
+########################################################################
+
+JARGON_KEYWORDS = {"swap", "hedge", "futures", "synergy", "compliance", "litigation", "forex", "collateral"}
+
+class VocabularyAccumulator:
+    """
+    Statistiques suffisantes du vocabulaire : nombre de tokens, somme des
+    longueurs, nombre de termes de jargon et vocabulaire (ensemble exact).
+
+    Avec ttr_window, calcule aussi un TTR par fenêtres fixes de ttr_window
+    tokens (moyenne des TTR des fenêtres complètes, MSTTR), comparable entre
+    utilisateurs de volumes très différents.
+    """
+
+    def __init__(self, ttr_window=None):
+        self.n_tokens = 0
+        self.length_sum = 0
+        self.jargon_count = 0
+        self.vocab = set()
+        self.ttr_window = ttr_window
+        self.window_ttr_sum = 0.0
+        self.n_windows = 0
+        self.window = []
+
+    def _add_to_window(self, token):
+        self.window.append(token)
+        if len(self.window) == self.ttr_window:
+            self.window_ttr_sum += len(set(self.window)) / self.ttr_window
+            self.n_windows += 1
+            self.window = []
+
+    def add(self, email, doc):
+        for t in doc:
+            if t.is_alpha:
+                token = t.text.lower()
+                self.n_tokens += 1
+                self.length_sum += len(token)
+                self.vocab.add(token)
+                if token in JARGON_KEYWORDS:
+                    self.jargon_count += 1
+                if self.ttr_window:
+                    self._add_to_window(token)
+
+    def merge(self, other):
+        self.n_tokens += other.n_tokens
+        self.length_sum += other.length_sum
+        self.jargon_count += other.jargon_count
+        self.vocab |= other.vocab
+        if self.ttr_window:
+            # Les fenêtres incomplètes des deux parts sont mises bout à bout
+            self.window_ttr_sum += other.window_ttr_sum
+            self.n_windows += other.n_windows
+            for token in other.window:
+                self._add_to_window(token)
+        return self
+
+    def windowed_ttr(self):
+        if self.n_windows:
+            return self.window_ttr_sum / self.n_windows
+        # Moins d'une fenêtre : TTR de la fenêtre partielle
+        return len(set(self.window)) / (len(self.window) + 1e-9)
+
+    def finalize(self):
+        # TTR
+        ttr = len(self.vocab) / (self.n_tokens + 1e-9)
+
+        # Avg word length (entier si la division tombe juste, comme statistics.mean)
+        if not self.n_tokens:
+            avg_word_len = 0
+        elif self.length_sum % self.n_tokens == 0:
+            avg_word_len = self.length_sum // self.n_tokens
+        else:
+            avg_word_len = self.length_sum / self.n_tokens
+
+        # Heuristic
+        word_type = "sophisticated" if avg_word_len > 5.0 else "common"
+
+        # Jargon detection
+        if self.jargon_count > 10:
+            jargon_presence = "high"
+        else:
+            jargon_presence = "low"
+
+        vocabulary = {
+            "word_type": word_type,
+            "lexical_richness_TTR": ttr,
+            "jargon_presence": jargon_presence,
+            "avg_word_length": avg_word_len
+        }
+        if self.ttr_window:
+            vocabulary["windowed_TTR"] = self.windowed_ttr()
+        return vocabulary
+
+    def to_dict(self):
+        return {
+            "n_tokens": self.n_tokens,
+            "length_sum": self.length_sum,
+            "jargon_count": self.jargon_count,
+            "vocab": sorted(self.vocab),
+            "ttr_window": self.ttr_window,
+            "window_ttr_sum": self.window_ttr_sum,
+            "n_windows": self.n_windows,
+            "window": self.window
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls(ttr_window=data.get("ttr_window"))
+        acc.n_tokens = data["n_tokens"]
+        acc.length_sum = data["length_sum"]
+        acc.jargon_count = data["jargon_count"]
+        acc.vocab = set(data["vocab"])
+        acc.window_ttr_sum = data.get("window_ttr_sum", 0.0)
+        acc.n_windows = data.get("n_windows", 0)
+        acc.window = data.get("window", [])
+        return acc
+
+def measure_vocabulary(emails, docs=None, ttr_window=None):
+    """
+    - Word type => 'sophisticated' vs 'common' (via avg word length)
+    - Lexical richness (TTR)
+    - Jargon presence
+    - windowed_TTR (optionnel) : TTR moyen sur des fenêtres de ttr_window tokens
+
+    Les emails sont traités un par un (jamais de Doc géant) : le tokenizer
+    SpaCy découpe d'abord sur les espaces, les tokens sont donc ceux du texte
+    " ".join(emails) et les valeurs identiques.
+    """
+    if docs is None:
+        docs = iter_parsed_emails(emails, measures=["vocabulary"])
+
+    acc = VocabularyAccumulator(ttr_window=ttr_window)
+    for email, doc in zip(emails, docs):
+        acc.add(email, doc)
+    return acc.finalize()
 
 ########################################################################
 # 3. Structure
 ########################################################################
 
-def measure_structure(emails):
+CONNECTORS = {"therefore", "however", "moreover", "thus", "consequently", "firstly", "secondly", "finally"}
+
+class StructureAccumulator:
     """
-    Mesure un 'internal_logic' (well_structured vs poorly_structured) 
-    via paragraphes et connecteurs.
+    Compteurs de paragraphes et de connecteurs logiques.
     """
-    connectors = {"therefore", "however", "moreover", "thus", "consequently", "firstly", "secondly", "finally"}
-    paragraphs_count = 0
-    connectors_count = 0
-    total_emails = len(emails)
 
-    for email in emails:
-        paragraphs_count += email.count("\n\n") + 1
+    def __init__(self):
+        self.paragraphs_count = 0
+        self.connectors_count = 0
+        self.total_emails = 0
+
+    def add(self, email, doc=None):
+        self.paragraphs_count += email.count("\n\n") + 1
         words = email.lower().split()
-        connectors_count += sum(1 for w in words if w in connectors)
+        self.connectors_count += sum(1 for w in words if w in CONNECTORS)
+        self.total_emails += 1
+
+    def merge(self, other):
+        self.paragraphs_count += other.paragraphs_count
+        self.connectors_count += other.connectors_count
+        self.total_emails += other.total_emails
+        return self
+
+    def finalize(self):
+        avg_paragraphs = self.paragraphs_count / (self.total_emails + 1e-9)
+        avg_connectors = self.connectors_count / (self.total_emails + 1e-9)
+
+        if avg_paragraphs > 2 and avg_connectors > 1:
+            internal_logic = "well_structured"
+        else:
+            internal_logic = "poorly_structured"
+
+        return {
+            "internal_logic": internal_logic,
+            "avg_paragraph_segments": avg_paragraphs,
+            "avg_logical_connectors": avg_connectors
+        }
 
-    avg_paragraphs = paragraphs_count / (total_emails + 1e-9)
-    avg_connectors = connectors_count / (total_emails + 1e-9)
+    def to_dict(self):
+        return dict(vars(self))
 
-    if avg_paragraphs > 2 and avg_connectors > 1:
-        internal_logic = "well_structured"
-    else:
-        internal_logic = "poorly_structured"
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls()
+        acc.__dict__.update(data)
+        return acc
 
-    return {
-        "internal_logic": internal_logic,
-        "avg_paragraph_segments": avg_paragraphs,
-        "avg_logical_connectors": avg_connectors
-    }
+def measure_structure(emails):
+    """
+    Mesure un 'internal_logic' (well_structured vs poorly_structured) 
+    via paragraphes et connecteurs.
+    """
+    acc = StructureAccumulator()
+    for email in emails:
+        acc.add(email)
+    return acc.finalize()
 
 ########################################################################
 # 4. Syntax
 ########################################################################
 
-def measure_syntax(emails):
+def _histogram_to_dict(histogram):
+    return {str(value): count for value, count in histogram.items()}
+
+def _histogram_from_dict(data):
+    return Counter({int(value): count for value, count in data.items()})
+
+def _histogram_pstdev(histogram):
+    # pstdev exact (statistics) sur les valeurs reconstituées de l'histogramme
+    return statistics.pstdev(list(histogram.elements()))
+
+class SyntaxAccumulator:
     """
-    - complexity: 'complex' or 'simple' (dépend du ratio de sub clauses)
-    - std_sentence_length
+    Histogramme des longueurs de phrases (d'où n, somme et somme des carrés)
+    et nombre de subordonnées.
     """
-    sentence_lens = []
-    sub_clause_count = 0
-    total_phrases = 0
 
-    for email in emails:
-        doc = nlp(email)
+    def __init__(self):
+        self.sentence_lens = Counter()
+        self.sub_clause_count = 0
+        self.total_phrases = 0
+
+    def add(self, email, doc):
         for sent in doc.sents:
             tokens = [t for t in sent if not t.is_space]
-            sentence_lens.append(len(tokens))
-            total_phrases += 1
-            sub_clause_count += sum(1 for t in sent if t.dep_ == "mark")
+            self.sentence_lens[len(tokens)] += 1
+            self.total_phrases += 1
+            self.sub_clause_count += sum(1 for t in sent if t.dep_ == "mark")
+
+    def merge(self, other):
+        self.sentence_lens.update(other.sentence_lens)
+        self.sub_clause_count += other.sub_clause_count
+        self.total_phrases += other.total_phrases
+        return self
+
+    def finalize(self):
+        ratio_sub = self.sub_clause_count / (self.total_phrases + 1e-9)
+        complexity = "complex" if ratio_sub > 0.5 else "simple"
+
+        if self.total_phrases > 1:
+            std_len = _histogram_pstdev(self.sentence_lens)
+        else:
+            std_len = 0.0
+
+        return {
+            "complexity": complexity,
+            "std_sentence_length": std_len
+        }
 
-    ratio_sub = sub_clause_count / (total_phrases + 1e-9)
-    complexity = "complex" if ratio_sub > 0.5 else "simple"
+    def to_dict(self):
+        return {
+            "sentence_lens": _histogram_to_dict(self.sentence_lens),
+            "sub_clause_count": self.sub_clause_count,
+            "total_phrases": self.total_phrases
+        }
 
-    if len(sentence_lens) > 1:
-        std_len = statistics.pstdev(sentence_lens)
-    else:
-        std_len = 0.0
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls()
+        acc.sentence_lens = _histogram_from_dict(data["sentence_lens"])
+        acc.sub_clause_count = data["sub_clause_count"]
+        acc.total_phrases = data["total_phrases"]
+        return acc
 
-    return {
-        "complexity": complexity,
-        "std_sentence_length": std_len
-    }
+def measure_syntax(emails, docs=None):
+    """
+    - complexity: 'complex' or 'simple' (dépend du ratio de sub clauses)
+    - std_sentence_length
+    """
+    if docs is None:
+        docs = iter_parsed_emails(emails, measures=["syntax"])
+
+    acc = SyntaxAccumulator()
+    for email, doc in zip(emails, docs):
+        acc.add(email, doc)
+    return acc.finalize()
 
 ########################################################################
 # 5. Recurrence of Patterns
 ########################################################################
 
-def measure_recurrence(emails, top_n=5):
+class SpaceSavingCounter:
     """
-    Frequent 1-grams et 2-grams (ex: top 5).
+    Comptage approché des éléments les plus fréquents à mémoire bornée
+    (algorithme Space-Saving) : au plus capacity éléments sont suivis, les
+    comptes sont des sur-estimations d'au plus errors[item].
+
+    Même interface que Counter pour update / most_common / items.
     """
-    all_tokens = []
-    for email in emails:
-        tokens = [t.text.lower() for t in nlp(email) if t.is_alpha]
-        all_tokens.extend(tokens)
 
-    freq_1 = Counter(all_tokens).most_common(top_n)
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # Tas (count, seq, item) avec entrées périmées, nettoyé périodiquement
+        self._heap = []
+        self._seq = 0
+
+    def _push(self, item):
+        heapq.heappush(self._heap, (self.counts[item], self._seq, item))
+        self._seq += 1
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, n, item) for n, (item, count) in enumerate(self.counts.items())]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, _, item = heapq.heappop(self._heap)
+            if self.counts.get(item) == count:
+                return item, count
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+        else:
+            min_item, min_count = self._pop_min()
+            del self.counts[min_item]
+            del self.errors[min_item]
+            self.counts[item] = min_count + count
+            self.errors[item] = min_count
+        self._push(item)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def _min_count(self):
+        # Compte maximal d'un élément non suivi (0 tant que le compteur n'est pas plein)
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other):
+        """
+        Fusion approchée : les comptes sont additionnés puis seuls les
+        capacity éléments les plus fréquents sont conservés.
+
+        Un élément absent de l'un des compteurs peut y avoir été évincé : il
+        reçoit le compte minimal de ce compteur, en compte et en erreur, pour
+        que les comptes restent des sur-estimations d'au plus errors[item].
+        """
+        self_min, other_min = self._min_count(), other._min_count()
+        counts, errors = {}, {}
+        for item in list(self.counts) + [item for item in other.counts if item not in self.counts]:
+            counts[item] = self.counts.get(item, self_min) + other.counts.get(item, other_min)
+            errors[item] = self.errors.get(item, self_min) + other.errors.get(item, other_min)
+        kept = sorted(counts, key=counts.get, reverse=True)[:self.capacity]
+        kept_set = set(kept)
+        self.counts = {item: counts[item] for item in counts if item in kept_set}
+        self.errors = {item: errors[item] for item in self.counts}
+        self._heap = [(count, n, item) for n, (item, count) in enumerate(self.counts.items())]
+        heapq.heapify(self._heap)
+        self._seq = len(self._heap)
+        return self
+
+    def items(self):
+        return self.counts.items()
+
+    def most_common(self, n):
+        return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+class RecurrenceAccumulator:
+    """
+    Comptes des 1-grams et 2-grams, mis à jour email par email.
 
-    all_2grams = []
-    for i in range(len(all_tokens) - 1):
-        two_gram = (all_tokens[i], all_tokens[i+1])
-        all_2grams.append(two_gram)
-    freq_2 = Counter(all_2grams).most_common(top_n)
+    Les 2-grams ne traversent pas les frontières entre emails. Avec
+    approx_capacity, les comptes utilisent SpaceSavingCounter (mémoire
+    bornée, top-k approché) au lieu de Counter (exact).
+    """
 
-    return {
-        "frequent_1grams": freq_1,
-        "frequent_2grams": freq_2
-    }
+    def __init__(self, approx_capacity=None):
+        self.approx_capacity = approx_capacity
+        self.counts_1 = self._new_counter()
+        self.counts_2 = self._new_counter()
+
+    def _new_counter(self):
+        if self.approx_capacity is None:
+            return Counter()
+        return SpaceSavingCounter(self.approx_capacity)
+
+    def add(self, email, doc):
+        tokens = [t.text.lower() for t in doc if t.is_alpha]
+        self.counts_1.update(tokens)
+        self.counts_2.update(zip(tokens, tokens[1:]))
+
+    def merge(self, other):
+        if self.approx_capacity is None:
+            self.counts_1.update(other.counts_1)
+            self.counts_2.update(other.counts_2)
+        else:
+            self.counts_1.merge(other.counts_1)
+            self.counts_2.merge(other.counts_2)
+        return self
+
+    def finalize(self, top_n=5):
+        return {
+            "frequent_1grams": self.counts_1.most_common(top_n),
+            "frequent_2grams": self.counts_2.most_common(top_n)
+        }
+
+    def to_dict(self):
+        # Listes ordonnées : l'ordre d'insertion départage les ex-aequo
+        data = {
+            "approx_capacity": self.approx_capacity,
+            "counts_1": list(self.counts_1.items()),
+            "counts_2": [[a, b, count] for (a, b), count in self.counts_2.items()]
+        }
+        if self.approx_capacity is not None:
+            data["errors_1"] = list(self.counts_1.errors.items())
+            data["errors_2"] = [[a, b, error] for (a, b), error in self.counts_2.errors.items()]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls(approx_capacity=data.get("approx_capacity"))
+        counts_1 = dict(data["counts_1"])
+        counts_2 = {(a, b): count for a, b, count in data["counts_2"]}
+        if acc.approx_capacity is None:
+            acc.counts_1 = Counter(counts_1)
+            acc.counts_2 = Counter(counts_2)
+        else:
+            acc.counts_1.merge(_space_saving_from(acc.approx_capacity, counts_1, dict(data["errors_1"])))
+            acc.counts_2.merge(_space_saving_from(
+                acc.approx_capacity, counts_2, {(a, b): error for a, b, error in data["errors_2"]}
+            ))
+        return acc
+
+def _space_saving_from(capacity, counts, errors):
+    counter = SpaceSavingCounter(capacity)
+    counter.counts = counts
+    counter.errors = errors
+    return counter
+
+def measure_recurrence(emails, top_n=5, docs=None, approx_capacity=None):
+    """
+    Frequent 1-grams et 2-grams (ex: top 5).
+
+    approx_capacity : si fourni, top-k approché à mémoire bornée.
+    """
+    if docs is None:
+        docs = iter_parsed_emails(emails, measures=["recurrence"])
+
+    acc = RecurrenceAccumulator(approx_capacity=approx_capacity)
+    for email, doc in zip(emails, docs):
+        acc.add(email, doc)
+    return acc.finalize(top_n=top_n)
 
 ########################################################################
 # 6. Politeness and Social Conventions
 ########################################################################
 
-def measure_politeness(emails):
+CLOSINGS = {"regards", "sincerely", "best"}
+POLITE_WORDS = {"please", "thank"}
+
+class PolitenessAccumulator:
     """
-    - closing_formulas_ratio
-    - politeness_score (count of 'please', 'thank', etc.)
+    Compteurs de formules de clôture et de mots de politesse.
     """
-    closings = {"regards", "sincerely", "best"}
-    closing_count = 0
-    total_emails = len(emails)
 
-    polite_words = {"please", "thank"}
-    polite_count = 0
+    def __init__(self):
+        self.closing_count = 0
+        self.polite_count = 0
+        self.total_emails = 0
 
-    for email in emails:
+    def add(self, email, doc=None):
         lower_e = email.lower()
         lines = lower_e.strip().split("\n")
         if lines:
             last_line = lines[-1].strip()
-            if any(c in last_line for c in closings):
-                closing_count += 1
-        
-        for w in polite_words:
-            polite_count += lower_e.count(w)
-
-    closing_ratio = closing_count / (total_emails + 1e-9)
-    politeness_score = polite_count / (total_emails + 1e-9)
-
-    return {
-        "closing_formulas_ratio": closing_ratio,
-        "politeness_score": politeness_score
-    }
+            if any(c in last_line for c in CLOSINGS):
+                self.closing_count += 1
+
+        for w in POLITE_WORDS:
+            self.polite_count += lower_e.count(w)
+        self.total_emails += 1
+
+    def merge(self, other):
+        self.closing_count += other.closing_count
+        self.polite_count += other.polite_count
+        self.total_emails += other.total_emails
+        return self
+
+    def finalize(self):
+        closing_ratio = self.closing_count / (self.total_emails + 1e-9)
+        politeness_score = self.polite_count / (self.total_emails + 1e-9)
+
+        return {
+            "closing_formulas_ratio": closing_ratio,
+            "politeness_score": politeness_score
+        }
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls()
+        acc.__dict__.update(data)
+        return acc
+
+def measure_politeness(emails):
+    """
+    - closing_formulas_ratio
+    - politeness_score (count of 'please', 'thank', etc.)
+    """
+    acc = PolitenessAccumulator()
+    for email in emails:
+        acc.add(email)
+    return acc.finalize()
 
 ########################################################################
 # 7. Rhythm and Cadence
 ########################################################################
 
-def measure_rhythm_cadence(emails):
+PUNCTUATION_MARKS = [".", ",", "?", "!", ";", ":"]
+PUNCTUATION_RE = re.compile("[" + re.escape("".join(PUNCTUATION_MARKS)) + "]")
+
+class RhythmAccumulator:
     """
-    - Variation (std) of sentence lengths
-    - punctuation_ratio
+    Histogramme des longueurs de phrases, ponctuation et nombre de mots.
     """
-    all_sentence_lens = []
-    punctuation_count = 0
-    word_count = 0
 
-    for email in emails:
-        doc = nlp(email)
+    def __init__(self):
+        self.sentence_lens = Counter()
+        self.punctuation_count = 0
+        self.word_count = 0
+
+    def add(self, email, doc):
         for sent in doc.sents:
             tokens = [t for t in sent if not t.is_space]
-            all_sentence_lens.append(len(tokens))
-        punctuation_count += sum(1 for t in email if t in [".", ",", "?", "!", ";", ":"])
-        word_count += len(email.split())
+            self.sentence_lens[len(tokens)] += 1
+        self.punctuation_count += len(PUNCTUATION_RE.findall(email))
+        self.word_count += len(email.split())
+
+    def merge(self, other):
+        self.sentence_lens.update(other.sentence_lens)
+        self.punctuation_count += other.punctuation_count
+        self.word_count += other.word_count
+        return self
+
+    def finalize(self):
+        if sum(self.sentence_lens.values()) > 1:
+            std_len = _histogram_pstdev(self.sentence_lens)
+        else:
+            std_len = 0
+
+        punctuation_ratio = self.punctuation_count / (self.word_count + 1e-9)
+
+        return {
+            "std_sentence_length_variation": std_len,
+            "punctuation_ratio": punctuation_ratio
+        }
 
-    if len(all_sentence_lens) > 1:
-        std_len = statistics.pstdev(all_sentence_lens)
-    else:
-        std_len = 0
+    def to_dict(self):
+        return {
+            "sentence_lens": _histogram_to_dict(self.sentence_lens),
+            "punctuation_count": self.punctuation_count,
+            "word_count": self.word_count
+        }
 
-    punctuation_ratio = punctuation_count / (word_count + 1e-9)
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls()
+        acc.sentence_lens = _histogram_from_dict(data["sentence_lens"])
+        acc.punctuation_count = data["punctuation_count"]
+        acc.word_count = data["word_count"]
+        return acc
 
-    return {
-        "std_sentence_length_variation": std_len,
-        "punctuation_ratio": punctuation_ratio
-    }
+def measure_rhythm_cadence(emails, docs=None):
+    """
+    - Variation (std) of sentence lengths
+    - punctuation_ratio
+    """
+    if docs is None:
+        docs = iter_parsed_emails(emails, measures=["rhythm"])
+
+    acc = RhythmAccumulator()
+    for email, doc in zip(emails, docs):
+        acc.add(email, doc)
+    return acc.finalize()
 
 ########################################################################
 # Utility Functions
 ########################################################################
 
-def anonymize_text(text):
-    doc = nlp(text)
-    new_text = text
-    for ent in reversed(doc.ents):
-        if ent.label_ in ["PERSON", "ORG"]:
-            new_text = new_text[:ent.start_char] + ent.label_ + new_text[ent.end_char:]
-    return new_text
+def components_to_disable(measures):
+    """
+    Liste les composants SpaCy inutiles pour un ensemble de mesures.
+
+    Params:
+        measures (List[str]): clés de MEASURE_COMPONENTS
 
-def load_enron_emails_from_csv(csv_path):
+    Returns:
+        List[str]: composants du pipeline à désactiver
+    """
+    needed = set()
+    for measure in measures:
+        needed |= MEASURE_COMPONENTS[measure]
+    if needed:
+        needed.add("tok2vec")
+    return [name for name in get_nlp().pipe_names if name not in needed]
+
+def iter_parsed_emails(emails, batch_size=SPACY_BATCH_SIZE, n_process=SPACY_N_PROCESS, measures=None):
+    """
+    Générateur de Docs SpaCy (nlp.pipe) : seul le lot en cours est en mémoire.
+
+    Params:
+        emails (Iterable[str]): textes des emails
+        batch_size (int): nombre d'emails par lot
+        n_process (int): nombre de processus (-1 pour tous les coeurs)
+        measures (List[str]): si fourni, désactive les composants dont ces
+            mesures n'ont pas besoin (voir MEASURE_COMPONENTS)
+    """
+    disable = components_to_disable(measures) if measures is not None else []
+    return get_nlp().pipe(emails, batch_size=batch_size, n_process=n_process, disable=disable)
+
+def parse_emails(emails, batch_size=SPACY_BATCH_SIZE, n_process=SPACY_N_PROCESS, measures=None, metrics=None):
+    """
+    Parse chaque email une seule fois avec SpaCy, par lots via nlp.pipe.
+
+    Si metrics est fourni, il reçoit le nombre de Docs et de lots.
+
+    Returns:
+        List[spacy.tokens.Doc]: un Doc par email, dans le même ordre
+    """
+    docs = list(iter_parsed_emails(emails, batch_size=batch_size, n_process=n_process, measures=measures))
+    if metrics is not None:
+        metrics.incr("spacy_docs", len(docs))
+        metrics.incr("spacy_batches", math.ceil(len(docs) / batch_size))
+    return docs
+
+ANONYMIZED_LABELS = {"PERSON", "ORG"}
+
+# Cache LRU des emails anonymisés, indexé par hash du contenu
+ANONYMIZATION_CACHE_SIZE = 100000
+_anonymization_cache = OrderedDict()
+_anonymization_lock = threading.Lock()
+
+def anonymize_text(text, doc=None):
+    """
+    Remplace les entités PERSON / ORG par leur label.
+    Accepte un Doc SpaCy déjà parsé pour éviter de re-parser le texte.
+
+    Le texte est reconstruit en une passe (entités triées, sans chevauchement).
+    """
+    if doc is None:
+        doc = get_nlp()(text, disable=components_to_disable(["anonymize"]))
+    parts = []
+    last_end = 0
+    for ent in doc.ents:
+        if ent.label_ in ANONYMIZED_LABELS:
+            parts.append(text[last_end:ent.start_char])
+            parts.append(ent.label_)
+            last_end = ent.end_char
+    parts.append(text[last_end:])
+    return "".join(parts)
+
+def anonymize_emails(emails, batch_size=SPACY_BATCH_SIZE, n_process=SPACY_N_PROCESS, metrics=None):
+    """
+    Anonymise une liste d'emails par lots.
+
+    Seuls le tokenizer et le NER tournent (nlp.pipe), chaque email distinct
+    n'est parsé qu'une fois et les résultats sont mis en cache par hash.
+    Si metrics est fourni, il reçoit les Docs parsés et les hits du cache.
+
+    Returns:
+        List[str]: emails anonymisés, dans le même ordre
+    """
+    digests = [email_hash(email) for email in emails]
+    results = {}
+    with _anonymization_lock:
+        for digest in digests:
+            if digest in _anonymization_cache:
+                _anonymization_cache.move_to_end(digest)
+                results[digest] = _anonymization_cache[digest]
+
+    missing = {}
+    for digest, email in zip(digests, emails):
+        if digest not in results:
+            missing.setdefault(digest, email)
+
+    if missing:
+        docs = parse_emails(list(missing.values()), batch_size=batch_size, n_process=n_process, measures=["anonymize"],
+                            metrics=metrics)
+        with _anonymization_lock:
+            for (digest, email), doc in zip(missing.items(), docs):
+                results[digest] = anonymize_text(email, doc=doc)
+                _anonymization_cache[digest] = results[digest]
+            while len(_anonymization_cache) > ANONYMIZATION_CACHE_SIZE:
+                _anonymization_cache.popitem(last=False)
+
+    if metrics is not None:
+        metrics.incr("anonymization_cache_hits", len(digests) - len(missing))
+    return [results[digest] for digest in digests]
+
+def load_enron_emails_from_csv(csv_path, user_column="Full_Name", body_column="body"):
     df = pd.read_csv(csv_path)
     user_emails = {}
-    for user, group in df.groupby("Full_Name"):
-        bodies = group["body"].dropna().tolist()
+    for user, group in df.groupby(user_column):
+        bodies = group[body_column].dropna().tolist()
         cleaned_bodies = [b for b in bodies if isinstance(b, str) and b.strip()]
         if cleaned_bodies:
             user_emails[user] = cleaned_bodies
     return user_emails
 
+def load_email_strata_from_csv(csv_path, strata_column, user_column="Full_Name", body_column="body"):
+    """
+    Strate (dossier, date, ...) de chaque email, alignée sur les listes
+    renvoyées par load_enron_emails_from_csv.
+    """
+    df = pd.read_csv(csv_path)
+    user_strata = {}
+    for user, group in df.groupby(user_column):
+        valid = group[group[body_column].apply(lambda b: isinstance(b, str) and bool(b.strip()))]
+        if len(valid):
+            user_strata[user] = valid[strata_column].astype(str).tolist()
+    return user_strata
+
 ########################################################################
 # 8. Construction du style profile
 ########################################################################
 
-def build_user_style_profile(user_id, emails):
+class StyleProfileAccumulator:
+    """
+    Regroupe les accumulateurs des sept dimensions du profil.
+
+    Deux accumulateurs (nouveaux emails, shards calculés sur d'autres
+    workers) se combinent avec merge. finalize produit le JSON style_profile.
+    """
+
+    def __init__(self, top_n=5, recurrence_capacity=None, ttr_window=None):
+        self.top_n = top_n
+        self.tone = ToneAccumulator()
+        self.vocabulary = VocabularyAccumulator(ttr_window=ttr_window)
+        self.structure = StructureAccumulator()
+        self.syntax = SyntaxAccumulator()
+        self.patterns = RecurrenceAccumulator(approx_capacity=recurrence_capacity)
+        self.politeness = PolitenessAccumulator()
+        self.rhythm = RhythmAccumulator()
+
+    def _parts(self):
+        return {
+            "tone": self.tone,
+            "vocabulary": self.vocabulary,
+            "structure": self.structure,
+            "syntax": self.syntax,
+            "recurrence_of_patterns": self.patterns,
+            "politeness_and_social_conventions": self.politeness,
+            "rhythm_and_cadence": self.rhythm
+        }
+
+    def add_emails(self, emails, docs, form_labels, emotions, metrics=None):
+        """
+        Ajoute des emails anonymisés, leurs Docs, labels de formalité et émotions.
+
+        Chaque dimension parcourt la tranche à son tour ; si metrics est
+        fourni, son temps est compté dans le span "measure.<dimension>".
+        """
+        metrics = metrics or PipelineMetrics()
+        with metrics.span("measure.tone"):
+            for email, doc, form_label, emotion in zip(emails, docs, form_labels, emotions):
+                self.tone.add(form_label, emotion, detect_attitude(email, doc=doc))
+        with metrics.span("measure.vocabulary"):
+            for email, doc in zip(emails, docs):
+                self.vocabulary.add(email, doc)
+        with metrics.span("measure.structure"):
+            for email in emails:
+                self.structure.add(email)
+        with metrics.span("measure.syntax"):
+            for email, doc in zip(emails, docs):
+                self.syntax.add(email, doc)
+        with metrics.span("measure.recurrence"):
+            for email, doc in zip(emails, docs):
+                self.patterns.add(email, doc)
+        with metrics.span("measure.politeness"):
+            for email in emails:
+                self.politeness.add(email)
+        with metrics.span("measure.rhythm"):
+            for email, doc in zip(emails, docs):
+                self.rhythm.add(email, doc)
+        return self
+
+    def merge(self, other):
+        for name, part in self._parts().items():
+            part.merge(other._parts()[name])
+        return self
+
+    def finalize(self, user_id):
+        style_profile = {}
+        for name, part in self._parts().items():
+            if name == "recurrence_of_patterns":
+                style_profile[name] = part.finalize(top_n=self.top_n)
+            else:
+                style_profile[name] = part.finalize()
+        return {
+            "user_id": user_id,
+            "style_profile": style_profile
+        }
+
+    def to_dict(self):
+        data = {name: part.to_dict() for name, part in self._parts().items()}
+        data["top_n"] = self.top_n
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        acc = cls(
+            top_n=data["top_n"],
+            recurrence_capacity=data["recurrence_of_patterns"].get("approx_capacity"),
+            ttr_window=data["vocabulary"].get("ttr_window")
+        )
+        acc.tone = ToneAccumulator.from_dict(data["tone"])
+        acc.vocabulary = VocabularyAccumulator.from_dict(data["vocabulary"])
+        acc.structure = StructureAccumulator.from_dict(data["structure"])
+        acc.syntax = SyntaxAccumulator.from_dict(data["syntax"])
+        acc.patterns = RecurrenceAccumulator.from_dict(data["recurrence_of_patterns"])
+        acc.politeness = PolitenessAccumulator.from_dict(data["politeness_and_social_conventions"])
+        acc.rhythm = RhythmAccumulator.from_dict(data["rhythm_and_cadence"])
+        return acc
+
+# Nombre d'emails traités ensemble par accumulate_style_statistics
+PROFILE_CHUNK_SIZE = 500
+
+def accumulate_style_statistics(emails, accumulator=None, batch_size=SPACY_BATCH_SIZE, n_process=SPACY_N_PROCESS,
+                                max_concurrency=FORMALITY_MAX_CONCURRENCY,
+                                sentiment_batch_size=SENTIMENT_BATCH_SIZE, torch_threads=None,
+                                recurrence_capacity=None, ttr_window=None, formality_mode="llm",
+                                on_chunk=None, metrics=None, budget=None):
+    """
+    Calcule les statistiques suffisantes du profil pour une liste d'emails.
+
+    Si accumulator est fourni, les emails y sont ajoutés (à la suite des
+    emails déjà vus), sinon un nouvel accumulateur est créé.
+    formality_mode : "llm" (un appel par email) ou "tiered" (modèle local,
+    LLM pour les cas incertains).
+    on_chunk(emails, docs, form_labels, emotions) est appelé après chaque
+    tranche (emails anonymisés) pour exploiter les valeurs par email.
+    metrics (PipelineMetrics) reçoit le temps de chaque étape et les compteurs.
+    budget (TokenBudget) borne les tokens LLM de la formalité (voir
+    classify_formality_budgeted).
+    """
+    metrics = metrics or PipelineMetrics()
+    if accumulator is None:
+        accumulator = StyleProfileAccumulator(recurrence_capacity=recurrence_capacity, ttr_window=ttr_window)
+
+    # Traitement par tranches : seuls les Docs d'une tranche sont en mémoire
+    for start in range(0, len(emails), PROFILE_CHUNK_SIZE):
+        chunk = emails[start:start + PROFILE_CHUNK_SIZE]
+
+        metrics.incr("emails", len(chunk))
+        metrics.incr("chunks")
+
+        # Anonymisation (NER seulement, mise en cache par email)
+        with metrics.span("anonymize"):
+            chunk = anonymize_emails(chunk, batch_size=batch_size, n_process=n_process, metrics=metrics)
+
+        # Chaque email anonymisé est parsé une seule fois, les Docs sont
+        # partagés par toutes les mesures
+        with metrics.span("parse"):
+            docs = parse_emails(
+                chunk, batch_size=batch_size, n_process=n_process,
+                measures=["attitude", "vocabulary", "syntax", "recurrence", "rhythm"], metrics=metrics
+            )
+
+        # Ton : tronque pour éviter de trop longs prompts
+        with metrics.span("formality"):
+            if formality_mode == "tiered":
+                form_labels, _ = classify_formality_tiered(chunk, docs, max_concurrency=max_concurrency,
+                                                           metrics=metrics, budget=budget)
+            elif budget is not None:
+                form_labels = classify_formality_budgeted(chunk, docs, budget, max_concurrency=max_concurrency,
+                                                          metrics=metrics)
+            else:
+                form_labels = classify_formality_batch([email[:FORMALITY_MAX_CHARS] for email in chunk],
+                                                       max_concurrency=max_concurrency, metrics=metrics)
+        with metrics.span("sentiment"):
+            emotions = detect_emotions(chunk, batch_size=sentiment_batch_size, num_threads=torch_threads,
+                                       metrics=metrics)
+
+        accumulator.add_emails(chunk, docs, form_labels, emotions, metrics=metrics)
+        if on_chunk is not None:
+            on_chunk(chunk, docs, form_labels, emotions)
+
+    return accumulator
+
+def build_user_style_profile(user_id, emails, batch_size=SPACY_BATCH_SIZE, n_process=SPACY_N_PROCESS,
+                             max_concurrency=FORMALITY_MAX_CONCURRENCY,
+                             sentiment_batch_size=SENTIMENT_BATCH_SIZE, torch_threads=None,
+                             recurrence_capacity=None, ttr_window=None, formality_mode="llm",
+                             metrics=None, return_metrics=False, log_metrics=False, budget=None):
     """
     Construit le profil stylistique global pour un utilisateur.
+
+    batch_size et n_process sont transmis à nlp.pipe, max_concurrency borne
+    le nombre d'appels LLM de formalité simultanés, sentiment_batch_size et
+    torch_threads règlent l'inférence de sentiment. recurrence_capacity
+    active le comptage approché des n-grams (mémoire bornée), ttr_window
+    ajoute le TTR par fenêtres fixes et formality_mode="tiered" utilise le
+    modèle local de formalité.
+
+    Les temps par étape et les compteurs sont relevés dans metrics (un
+    PipelineMetrics neuf par défaut) ; return_metrics=True renvoie
+    (profil, metrics) et log_metrics=True les écrit dans les logs.
+    budget (TokenBudget) borne les tokens LLM du profil.
     """
-    # Anonymisation
-    emails = [anonymize_text(e) for e in emails]
+    metrics = metrics or PipelineMetrics()
+    with metrics.span("total"):
+        accumulator = accumulate_style_statistics(
+            emails, batch_size=batch_size, n_process=n_process, max_concurrency=max_concurrency,
+            sentiment_batch_size=sentiment_batch_size, torch_threads=torch_threads,
+            recurrence_capacity=recurrence_capacity, ttr_window=ttr_window, formality_mode=formality_mode,
+            metrics=metrics, budget=budget
+        )
+        with metrics.span("finalize"):
+            profile = accumulator.finalize(user_id)
+    if log_metrics:
+        metrics.log(prefix=f"profile {user_id}")
+    if return_metrics:
+        return profile, metrics
+    return profile
+
+def update_user_style_profile(user_id, state, new_emails, **kwargs):
+    """
+    Ajoute de nouveaux emails à un profil existant sans retraiter les anciens.
 
-    # Ton
-    formal_count = 0
-    total_emails = len(emails)
-    emotion_list = []
-    attitude_list = []
-    for email in emails:
-        form_label = classify_formality_llama(email[:2000])  # Tronque pour éviter de trop longs prompts
-        if form_label == "FORMAL":
-            formal_count += 1
-        emotion_list.append(detect_emotion(email))
-        attitude_list.append(detect_attitude(email))
-    
+    Params:
+        user_id (str): identifiant de l'utilisateur
+        state (dict): StyleProfileAccumulator.to_dict() du profil existant
+        new_emails (List[str]): emails à ajouter
+
+    Returns:
+        dict: le profil mis à jour
+        dict: le nouvel état (à conserver pour la prochaine mise à jour)
+    """
+    accumulator = accumulate_style_statistics(
+        new_emails, accumulator=StyleProfileAccumulator.from_dict(state), **kwargs
+    )
+    return accumulator.finalize(user_id), accumulator.to_dict()
+
+########################################################################
+# 8 bis. Sampling mode for very large mailboxes
+########################################################################
+
+def _normal_cdf(x):
+    return 0.5 * (1.0 + math.erf(x / math.sqrt(2.0)))
+
+def _length_buckets(emails, n_buckets=3):
+    """
+    Tranche de longueur (quantiles) de chaque email.
+    """
+    lengths = np.array([len(email) for email in emails])
+    edges = np.quantile(lengths, np.linspace(0, 1, n_buckets + 1)[1:-1]) if len(emails) else []
+    return np.searchsorted(edges, lengths, side="right").tolist()
+
+def stratified_sample_order(emails, strata=None, seed=0):
+    """
+    Ordre de tirage stratifié des emails : tout préfixe de cet ordre est un
+    échantillon à allocation proportionnelle.
 
-    ratio_formal = formal_count / (total_emails + 1e-9)
+    Les strates croisent strata (dossier, mois, ... si fourni) et la tranche
+    de longueur de l'email.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = _length_buckets(emails)
+    keys = [(strata[i] if strata is not None else None, lengths[i]) for i in range(len(emails))]
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key, []).append(i)
+    positions = np.empty(len(emails))
+    for members in groups.values():
+        members = np.array(members)
+        ranks = rng.permutation(len(members))
+        positions[members] = (ranks + rng.random(len(members))) / len(members)
+    return np.argsort(positions, kind="stable").tolist()
+
+def _proportion_confidence(successes, n, population, lower, upper):
+    """
+    Probabilité (approximation normale, correction de population finie) que
+    la vraie proportion soit dans ]lower, upper].
+    """
+    p = successes / n
+    p_adj = (successes + 1) / (n + 2)
+    fpc = (population - n) / (population - 1) if population > 1 else 0.0
+    se = math.sqrt(p_adj * (1 - p_adj) / n * fpc)
+    if se == 0:
+        return 1.0
+    return _normal_cdf((upper - p) / se) - _normal_cdf((lower - p) / se)
+
+def _ratio_confidence(numerators, denominators, population, threshold):
+    """
+    Probabilité que le ratio Σnum / Σden soit du même côté de threshold que
+    son estimation (estimateur par linéarisation).
+    """
+    num = np.array(numerators, dtype=float)
+    den = np.array(denominators, dtype=float)
+    n = len(num)
+    if n < 2 or den.sum() == 0:
+        return 0.0
+    ratio = num.sum() / den.sum()
+    fpc = (population - n) / (population - 1) if population > 1 else 0.0
+    residuals = num - ratio * den
+    se = math.sqrt(fpc * residuals.var(ddof=1) / n) / den.mean()
+    if se == 0:
+        return 1.0
+    return _normal_cdf(abs(ratio - threshold) / se)
+
+def _sampled_decisions(observations, population):
+    """
+    Décisions catégorielles du profil et leur confiance sur l'échantillon.
+    """
+    # Emails non classés (budget de tokens) absents de "formal"
+    n_formal = len(observations["formal"])
+    n = len(observations["emotional"])
+    formal = sum(observations["formal"])
+    ratio_formal = formal / n_formal if n_formal else 0.0
     if ratio_formal > 0.7:
-        formality_degree = "mostly_formal"
+        formality, band = "mostly_formal", (0.7, 1.0)
     elif ratio_formal < 0.3:
-        formality_degree = "mostly_informal"
+        formality, band = "mostly_informal", (-1e-9, 0.3)
     else:
-        formality_degree = "mixed"
+        formality, band = "mixed", (0.3, 0.7)
 
-    from collections import Counter
-    emo_counts = Counter(emotion_list)
-    if emo_counts:
-        main_emotion = emo_counts.most_common(1)[0][0]
-    else:
-        main_emotion = "neutral"
-
-    att_counts = Counter(attitude_list)
-    if att_counts:
-        main_attitude = att_counts.most_common(1)[0][0]
-    else:
-        main_attitude = "assertive"
+    decisions = {
+        "formality_degree": {
+            "value": formality,
+            "estimate": ratio_formal,
+            "confidence": _proportion_confidence(formal, n_formal, population, *band) if n_formal else 0.0
+        }
+    }
+    for name, key, positive, negative in [
+        ("emotional_expression", "emotional", "emotional", "neutral"),
+        ("attitude", "attenuated", "attenuated", "assertive"),
+    ]:
+        count = sum(observations[key])
+        share = count / n
+        above = share > 0.5
+        decisions[name] = {
+            "value": positive if above else negative,
+            "estimate": share,
+            "confidence": _proportion_confidence(count, n, population, *((0.5, 1.0) if above else (-1e-9, 0.5)))
+        }
 
-    tone = {
-        "formality_degree": formality_degree,
-        "emotional_expression": main_emotion,
-        "attitude": main_attitude
+    length_sum = sum(observations["length_sum"])
+    n_tokens = sum(observations["n_tokens"])
+    avg_word_len = length_sum / n_tokens if n_tokens else 0
+    decisions["word_type"] = {
+        "value": "sophisticated" if avg_word_len > 5.0 else "common",
+        "estimate": avg_word_len,
+        "confidence": _ratio_confidence(observations["length_sum"], observations["n_tokens"], population, 5.0)
     }
+    return decisions
 
-    # Autres dimensions
-    vocabulary = measure_vocabulary(emails)
-    structure = measure_structure(emails)
-    syntax = measure_syntax(emails)
-    patterns = measure_recurrence(emails, top_n=5)
-    politeness = measure_politeness(emails)
-    rhythm = measure_rhythm_cadence(emails)
-
-    style_profile = {
-        "user_id": user_id,
-        "style_profile": {
-            "tone": tone,
-            "vocabulary": vocabulary,
-            "structure": structure,
-            "syntax": syntax,
-            "recurrence_of_patterns": patterns,
-            "politeness_and_social_conventions": politeness,
-            "rhythm_and_cadence": rhythm
-        }
+def build_user_style_profile_sampled(user_id, emails, strata=None, initial_size=50, step=50, max_size=None,
+                                     confidence=0.95, patience=2, seed=0, **kwargs):
+    """
+    Profil stylistique à coût borné pour les très grosses boîtes mail.
+
+    Les emails sont tirés par échantillonnage stratifié (strata + longueur)
+    et ajoutés par tours de step emails. Le tirage s'arrête quand les
+    décisions catégorielles (bandes de formalité, émotion, attitude,
+    avg_word_len > 5.0) sont stables depuis patience tours et toutes
+    atteignent le niveau de confiance demandé, ou à max_size emails.
+
+    Params:
+        user_id (str): identifiant de l'utilisateur
+        emails (List[str]): tous les emails de l'utilisateur
+        strata (List): strate de chaque email (dossier, date, ...), optionnel
+        kwargs: transmis à accumulate_style_statistics
+
+    Returns:
+        dict: profil (même format que build_user_style_profile) avec une clé
+        "sampling" : taille d'échantillon, raison de l'arrêt (stop_reason :
+        "converged", "max_size" ou "population") et confiance de chaque décision.
+        stopped_early n'est vrai que si les décisions ont convergé.
+    """
+    population = len(emails)
+    max_size = min(max_size or population, population)
+    order = stratified_sample_order(emails, strata=strata, seed=seed)
+
+    observations = {"formal": [], "emotional": [], "attenuated": [], "length_sum": [], "n_tokens": []}
+
+    def observe(chunk, docs, form_labels, emotions):
+        for email, doc, form_label, emotion in zip(chunk, docs, form_labels, emotions):
+            alpha = [t.text for t in doc if t.is_alpha]
+            if form_label is not None:
+                observations["formal"].append(form_label == "FORMAL")
+            observations["emotional"].append(emotion == "emotional")
+            observations["attenuated"].append(detect_attitude(email, doc=doc) == "attenuated")
+            observations["length_sum"].append(sum(len(t) for t in alpha))
+            observations["n_tokens"].append(len(alpha))
+
+    accumulator = None
+    sampled = 0
+    rounds = 0
+    stable_rounds = 0
+    previous = None
+    decisions = {}
+    converged = False
+    while sampled < max_size:
+        size = initial_size if sampled == 0 else step
+        batch = [emails[i] for i in order[sampled:min(sampled + size, max_size)]]
+        accumulator = accumulate_style_statistics(batch, accumulator=accumulator, on_chunk=observe, **kwargs)
+        sampled += len(batch)
+        rounds += 1
+
+        decisions = _sampled_decisions(observations, population)
+        values = {name: decision["value"] for name, decision in decisions.items()}
+        stable_rounds = stable_rounds + 1 if values == previous else 0
+        previous = values
+        confident = all(decision["confidence"] >= confidence for decision in decisions.values())
+        if confident and stable_rounds >= patience:
+            converged = True
+            break
+
+    profile = (accumulator or StyleProfileAccumulator()).finalize(user_id)
+    profile["sampling"] = {
+        "sample_size": sampled,
+        "population_size": population,
+        "rounds": rounds,
+        "stopped_early": converged,
+        "stop_reason": "converged" if converged else ("max_size" if sampled < population else "population"),
+        "decisions": decisions
     }
-    return style_profile
+    return profile
+
+########################################################################
+# 9. Style profile store
+########################################################################
+
+# À incrémenter dès qu'une mesure change : les profils stockés sous une
+# autre version ne sont plus servis
+PROFILER_VERSION = "3"
+
+# Vecteurs de style des emails, partagés par profile_store et l'index (section 11)
+style_embeddings = StyleEmbeddingStore(
+    os.getenv("STYLE_EMBEDDING_STORE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".style_embeddings")),
+    get_style_embedding_model
+)
+
+profile_store = StyleProfileStore(
+    os.getenv("STYLE_PROFILE_STORE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".profile_store")),
+    accumulate_style_statistics,
+    update_user_style_profile,
+    PROFILER_VERSION,
+    embeddings=style_embeddings
+)
+
+########################################################################
+# 10. Corpus-level cheap metrics (pandas)
+########################################################################
+
+CONNECTORS_RE = re.compile(r"(?<!\S)(?:" + "|".join(sorted(CONNECTORS)) + r")(?!\S)")
+CLOSINGS_RE = re.compile("|".join(sorted(CLOSINGS)))
+
+def compute_cheap_style_metrics(df, user_column="Full_Name", body_column="body"):
+    """
+    Structure, politesse et ponctuation pour tous les utilisateurs d'un DataFrame.
+
+    Version vectorisée (méthodes str de pandas, regex compilées) de
+    measure_structure, measure_politeness et de la partie ponctuation de
+    measure_rhythm_cadence, sans SpaCy. Les valeurs sont identiques à
+    celles des mesures appliquées aux emails de load_enron_emails_from_csv.
+
+    Params:
+        df (pd.DataFrame): un email par ligne
+        user_column (str): colonne de l'expéditeur
+        body_column (str): colonne du corps de l'email
+
+    Returns:
+        pd.DataFrame: une ligne par utilisateur
+    """
+    bodies = df[body_column]
+    mask = bodies.map(lambda b: isinstance(b, str) and bool(b.strip()))
+    bodies = bodies[mask]
+    lower = bodies.str.lower()
+    last_lines = lower.str.strip().str.split("\n").str[-1].str.strip()
+
+    per_email = pd.DataFrame({
+        "user": df.loc[mask, user_column],
+        "n_emails": 1,
+        # Structure
+        "paragraphs": bodies.str.count("\n\n") + 1,
+        "connectors": lower.str.count(CONNECTORS_RE.pattern),
+        # Politesse
+        "closings": last_lines.str.contains(CLOSINGS_RE.pattern).astype(int),
+        "polite": sum(lower.str.count(re.escape(w)) for w in POLITE_WORDS),
+        # Ponctuation
+        "punctuation": bodies.str.count(PUNCTUATION_RE.pattern),
+        "words": bodies.str.count(r"\S+"),
+    })
+    totals = per_email.groupby("user").sum()
+
+    metrics = pd.DataFrame(index=totals.index)
+    metrics["n_emails"] = totals["n_emails"]
+    metrics["avg_paragraph_segments"] = totals["paragraphs"] / (totals["n_emails"] + 1e-9)
+    metrics["avg_logical_connectors"] = totals["connectors"] / (totals["n_emails"] + 1e-9)
+    metrics["internal_logic"] = np.where(
+        (metrics["avg_paragraph_segments"] > 2) & (metrics["avg_logical_connectors"] > 1),
+        "well_structured",
+        "poorly_structured"
+    )
+    metrics["closing_formulas_ratio"] = totals["closings"] / (totals["n_emails"] + 1e-9)
+    metrics["politeness_score"] = totals["polite"] / (totals["n_emails"] + 1e-9)
+    metrics["punctuation_ratio"] = totals["punctuation"] / (totals["words"] + 1e-9)
+    return metrics
 
 def style_profile_to_instructions(style_profile_json):
     """
@@ -629,6 +2101,126 @@ Use punctuation (commas, dashes) effectively to structure ideas and improve read
 
     return instructions
 
+########################################################################
+# 11. Style embeddings
+########################################################################
+
+STYLE_INDEX_PATH = os.getenv(
+    "STYLE_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".style_embeddings", "user_index.npz")
+)
+
+def build_style_index(user_emails, path=STYLE_INDEX_PATH, store=None):
+    """
+    Charge l'index des vecteurs de style et y ajoute les utilisateurs absents.
+
+    Les vecteurs moyens viennent de store.centroid (profile_store par défaut) :
+    seuls les emails jamais encodés passent par le modèle.
+    """
+    store = store or profile_store
+    index = StyleVectorIndex.load_or_create(path)
+    added = 0
+    for user_id, emails in user_emails.items():
+        if user_id not in index:
+            vector = store.centroid(user_id, emails)
+            if vector is not None:
+                index.add(user_id, vector)
+                added += 1
+    if added:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index.save(path)
+    return index
+
+########################################################################
+# 12. Email generation prompts
+########################################################################
+
+def user_style_email_messages(style_instructions, facts):
+    """
+    Messages pour générer un email dans le style d'un utilisateur.
+    """
+    system_prompt = f"""
+    You are a professional AI writing assistant.
+    You will receive some style instructions and some facts.
+    Your task is to produce an email in the style described by the instructions.
+
+    Style Instructions:
+    {style_instructions}
+
+    Constraints:
+    1. Follow the style instructions carefully.
+    2. Use the facts provided to shape the content of the email.
+    3. Write in English.
+    """
+
+    user_prompt = f"""
+    Please write an email using the following facts:
+
+    {facts}
+    """
+    return [("system", system_prompt), ("human", user_prompt)]
+
+def legal_email_messages(facts, instructions=None):
+    """
+    Messages pour générer un email juridique (style_juridique() par défaut).
+    """
+    system_prompt_legal = f"""
+    You are an AI assistant specialized in drafting legal emails.
+
+    Below are the defining characteristics of a proper legal-style email:
+    {instructions or style_juridique()}
+
+    Constraints:
+    1. Carefully follow the listed characteristics for a legal email.
+    2. Use the facts provided below to shape the content of the email.
+    3. Write the email in English, in a formal and professional tone.
+    """
+
+    user_prompt_legal = f"""
+    Here are the facts to include in the legal email:
+
+    {facts}
+    """
+    return [("system", system_prompt_legal), ("human", user_prompt_legal)]
+
+def generate_emails_concurrently(variants, max_workers=None, use_cache=True):
+    """
+    Génère plusieurs emails en parallèle (un thread par variante) et les
+    renvoie dans l'ordre où ils se terminent.
+
+    L'échec d'une variante n'interrompt pas les autres : son exception est
+    renvoyée à la place du texte.
+
+    Params:
+        variants (dict): nom -> (messages, call_site)
+        max_workers (int): nombre maximal d'appels simultanés (toutes par défaut)
+        use_cache (bool): False pour forcer un nouvel appel au modèle (régénération)
+
+    Yields:
+        Tuple[str, AIMessage, Exception, float]: (nom, réponse ou None, erreur ou None, durée en s) ;
+            response_metadata["cached"] indique une réponse servie par le cache
+    """
+    if not variants:
+        return
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    def generate(messages, call_site):
+        start = time.perf_counter()
+        try:
+            return llm.invoke(messages, use_cache=use_cache, call_site=call_site), None, time.perf_counter() - start
+        except Exception as e:
+            logging.exception(f"Generation failed ({call_site})")
+            return None, e, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(variants)) as executor:
+        futures = {
+            executor.submit(generate, messages, call_site): name
+            for name, (messages, call_site) in variants.items()
+        }
+        for future in as_completed(futures):
+            response, error, elapsed = future.result()
+            yield futures[future], response, error, elapsed
+
 ################################################
 # Graph Parsing to get the facts of a user
 ################################################
@@ -655,3 +2247,9 @@ def get_user_descriptions_by_date(json_data, user_email):
     )
 
     return [event['description'] for event in sorted_events]
+
+def format_fact_timeline(descriptions):
+    """
+    Timeline de faits (get_user_descriptions_by_date) sous forme de liste numérotée.
+    """
+    return "\n".join(f"* {i + 1}. {description}" for i, description in enumerate(descriptions))
@@ -3,7 +3,10 @@ from neo4j_graphrag.indexes import create_vector_index, upsert_vector
 from neo4j_graphrag.embeddings import OpenAIEmbeddings
 from dotenv import load_dotenv
 import os
+import sys
 load_dotenv()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from src.generation.utils import embedding_scheduler
 from openai import OpenAI
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 # --- Configuration ---
@@ -30,7 +33,8 @@ print("Vector index created.")
 
 # --- Initialize the Embedder ---
 # Using OpenAI embeddings; ensure your OPENAI_API_KEY is set in your environment.
-embedder = OpenAIEmbeddings(model="text-embedding-3-large")
+# Retries on rate limits (429) are handled by embedding_scheduler.
+embedder = OpenAIEmbeddings(model="text-embedding-3-large", max_retries=0)
 
 # --- Retrieve Existing Nodes from the Database ---
 def get_chunks():
@@ -51,7 +55,7 @@ for chunk in chunks:
     text = chunk
     if text:
         print(f"Embedding node id {chunk.id}...")
-        vector = embedder.embed_query(text)
+        vector = embedding_scheduler.call(embedder.embed_query, text)
         # Use the node's internal id (or any unique identifier) as the node_id
         node_id = chunk.id  
         upsert_vector(
@@ -66,4 +70,5 @@ for chunk in chunks:
 
 # --- Close the Connection ---
 driver.close()
+print(f"Embedding requests: {embedding_scheduler.stats()}")
 print("Vector index creation and population complete.")
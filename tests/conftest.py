@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Les modules de src/generation s'importent comme package (from src.generation import utils) ;
+# ceux de benchmarks à plat (faux serveur OpenAI de rate_limits.py)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+
+@pytest.fixture(autouse=True)
+def llm_cache(tmp_path, monkeypatch):
+    """
+    Cache LLM partagé du pipeline (utils.llm_cache, utilisé par utils.llm) dans tmp_path.
+    """
+    from src.generation import utils
+    from src.generation.llm_cache import LLMResponseCache
+
+    cache = LLMResponseCache(str(tmp_path / "llm_cache.sqlite"))
+    monkeypatch.setattr(utils, "llm_cache", cache)
+    monkeypatch.setattr(utils.llm, "cache", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def style_stores(tmp_path, monkeypatch):
+    """
+    Stores partagés des vecteurs de style et des profils (utils.style_embeddings,
+    utils.profile_store) dans tmp_path.
+    """
+    from src.generation import utils
+    from src.generation.style_stores import StyleEmbeddingStore, StyleProfileStore
+
+    embeddings = StyleEmbeddingStore(str(tmp_path / "style_embeddings"), utils.get_style_embedding_model)
+    profiles = StyleProfileStore(str(tmp_path / "profile_store"), utils.accumulate_style_statistics,
+                                 utils.update_user_style_profile, utils.PROFILER_VERSION, embeddings=embeddings)
+    monkeypatch.setattr(utils, "style_embeddings", embeddings)
+    monkeypatch.setattr(utils, "profile_store", profiles)
+    return embeddings, profiles
@@ -0,0 +1,174 @@
+import os
+import threading
+
+import pytest
+from langchain_core.messages import AIMessage
+
+from src.generation import utils
+
+
+class StubChatModel:
+    """
+    Chat model déterministe : répond "FORMAL" et compte ses appels.
+    """
+
+    model_name = "gpt-4o-mini"
+    temperature = 0.0
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, messages, config=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+        return AIMessage(content="FORMAL", usage_metadata={"input_tokens": 10, "output_tokens": 1, "total_tokens": 11})
+
+
+def make_backend(tmp_path, model):
+    return utils.LocalBatchBackend(lambda: model, root=str(tmp_path / "backend"),
+                                   scheduler=utils.RequestScheduler("test"))
+
+
+def make_job(tmp_path, model, cache, backend=None, ledger=None):
+    return utils.BatchJob(str(tmp_path / "job"), backend or make_backend(tmp_path, model), chunk_size=2,
+                          cache=cache, ledger=ledger or utils.LLMUsageLedger())
+
+
+def test_merged_batch_result_is_a_cache_hit(tmp_path):
+    model = StubChatModel()
+    cache = utils.LLMResponseCache(str(tmp_path / "cache.sqlite"))
+    messages = utils.formality_messages("Dear Sir, please find the contract attached.")
+
+    job = make_job(tmp_path, model, cache)
+    job.add({"email": messages})
+    assert job.run(poll_interval=0) == {"email": "FORMAL"}
+    assert model.calls == 1
+
+    llm = utils.CachedChatModel(lambda: model, cache)
+    response = llm.invoke(messages)
+    assert response.content == "FORMAL"
+    assert response.response_metadata.get("cached")
+    assert model.calls == 1
+
+
+class FakeBatches:
+    """
+    Sous-ensemble de client.batches : list paginé (plus récent d'abord) et create.
+    """
+
+    class Page:
+        def __init__(self, batches, start, limit):
+            self.batches, self.start, self.limit = batches, start, limit
+            self.data = batches[start:start + limit]
+
+        def has_next_page(self):
+            return self.start + self.limit < len(self.batches)
+
+        def get_next_page(self):
+            return FakeBatches.Page(self.batches, self.start + self.limit, self.limit)
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.created = 0
+
+    def list(self, limit=20):
+        return self.Page(sorted(self.batches, key=lambda batch: -batch.created_at), 0, limit)
+
+    def create(self, **kwargs):
+        self.created += 1
+        raise AssertionError("the existing batch should have been found")
+
+
+def test_openai_backend_finds_a_submitted_batch_beyond_the_first_page(tmp_path):
+    from types import SimpleNamespace
+    # Le lot du job, suivi de 250 lots plus récents
+    batches = [SimpleNamespace(id="batch_job", created_at=1000, status="in_progress", metadata={"job_chunk": "job:0"})]
+    batches += [SimpleNamespace(id=f"batch_{i}", created_at=2000 + i, status="completed", metadata={})
+                for i in range(250)]
+    client = SimpleNamespace(batches=FakeBatches(batches))
+    backend = utils.OpenAIBatchBackend(client=client)
+
+    path = tmp_path / "chunk.jsonl"
+    path.write_text("")
+    assert backend.submit(str(path), "job:0", not_before=900) == "batch_job"
+    assert backend.find("job:0", not_before=1500) is None
+    assert client.batches.created == 0
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedBackend:
+    """
+    Backend dont le premier submit est interrompu, avant l'envoi du lot
+    (sent=False) ou après (sent=True, la réponse est perdue).
+    """
+
+    def __init__(self, backend, sent):
+        self.backend = backend
+        self.sent = sent
+        self.interrupted = False
+
+    def submit(self, path, key, not_before=None):
+        if not self.interrupted:
+            self.interrupted = True
+            if self.sent:
+                self.backend.submit(path, key, not_before)
+            raise Interrupted()
+        return self.backend.submit(path, key, not_before)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+def formality_requests(n):
+    return {f"email-{i}": utils.formality_messages(f"Email number {i}") for i in range(n)}
+
+
+@pytest.mark.parametrize("sent", [False, True])
+def test_restart_after_interrupted_submit_does_not_resubmit(tmp_path, sent):
+    model = StubChatModel()
+    cache = utils.LLMResponseCache(str(tmp_path / "cache.sqlite"))
+    backend = make_backend(tmp_path, model)
+
+    job = make_job(tmp_path, model, cache, backend=InterruptedBackend(backend, sent))
+    job.add(formality_requests(5))
+    with pytest.raises(Interrupted):
+        job.run(poll_interval=0)
+
+    # Nouveau processus : état relu depuis le disque
+    job = make_job(tmp_path, model, cache, backend=backend)
+    assert job.add(formality_requests(5)) == 0
+    assert len(job.run(poll_interval=0)) == 5
+    # 3 lots de 2 requêtes au plus, chacun soumis et traité une seule fois
+    assert len(os.listdir(backend.root)) == 3
+    assert len(job.state["chunks"]) == 3
+    assert model.calls == 5
+
+
+def test_restart_after_interrupted_merge_does_not_merge_twice(tmp_path):
+    model = StubChatModel()
+    cache = utils.LLMResponseCache(str(tmp_path / "cache.sqlite"))
+    job = make_job(tmp_path, model, cache)
+    job.add(formality_requests(5))
+    job.run(poll_interval=0)
+
+    # Interruption après l'écriture des résultats, avant celle du statut "merged"
+    for chunk in job.state["chunks"]:
+        chunk["status"] = "submitted"
+    job._write_state()
+
+    ledger = utils.LLMUsageLedger()
+    budget = utils.TokenBudget(10000, degrade=())
+    job = utils.BatchJob(job.root, job.backend, chunk_size=2, cache=cache, ledger=ledger, budget=budget)
+    assert job.poll() == 0
+    assert job.submit() == 0
+
+    with open(os.path.join(job.root, "results.jsonl"), encoding="utf-8") as f:
+        assert len(f.readlines()) == 5
+    assert [chunk["merged"] for chunk in job.state["chunks"]] == [0, 0, 0]
+    assert ledger.total_tokens() == 0
+    assert budget.used == 0
+    assert model.calls == 5
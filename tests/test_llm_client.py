@@ -0,0 +1,102 @@
+import pytest
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from src.generation.llm_accounting import BudgetExceeded, LLMUsageLedger, TokenBudget
+from src.generation.llm_cache import LLMResponseCache
+from src.generation.llm_client import CachedChatModel
+
+
+class EchoChatModel:
+    """
+    Répond le dernier message en majuscules et garde la config de chaque appel.
+    """
+
+    model_name = "echo"
+    temperature = 0.0
+
+    def __init__(self):
+        self.configs = []
+
+    def invoke(self, messages, config=None, **kwargs):
+        self.configs.append(config)
+        return AIMessage(content=messages[-1][1].upper())
+
+
+def make_llm(tmp_path, model):
+    return CachedChatModel(lambda: model, LLMResponseCache(str(tmp_path / "cache.sqlite")), ledger=LLMUsageLedger())
+
+
+def test_batch_sends_duplicates_once_and_passes_config(tmp_path):
+    model = EchoChatModel()
+    llm = make_llm(tmp_path, model)
+    config = {"max_concurrency": 2, "tags": ["formality"]}
+
+    responses = llm.batch([[("human", "a")], [("human", "b")], [("human", "a")]], config=config)
+
+    assert [response.content for response in responses] == ["A", "B", "A"]
+    assert len(model.configs) == 2
+    assert all(call_config == config for call_config in model.configs)
+    assert responses[2].response_metadata.get("cached")
+
+
+def test_batch_serves_the_second_run_from_the_cache(tmp_path):
+    model = EchoChatModel()
+    llm = make_llm(tmp_path, model)
+    inputs = [[("human", "a")], [("human", "b")]]
+
+    llm.batch(inputs)
+    responses = llm.batch(inputs)
+
+    assert len(model.configs) == 2
+    assert all(response.response_metadata.get("cached") for response in responses)
+
+
+def test_cache_file_is_created_on_first_use(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    cache = LLMResponseCache(str(path))
+    assert not path.exists()
+
+    assert cache.get("missing") is None
+    assert path.exists()
+
+
+class UsageChatModel(EchoChatModel):
+    """
+    EchoChatModel qui renvoie un usage_metadata fixe (10 + 2 tokens).
+    """
+
+    def invoke(self, messages, config=None, **kwargs):
+        self.configs.append(config)
+        return AIMessage(content=messages[-1][1].upper(),
+                         usage_metadata={"input_tokens": 10, "output_tokens": 2, "total_tokens": 12})
+
+    def stream(self, messages, config=None, **kwargs):
+        self.configs.append(config)
+        yield AIMessageChunk(content=messages[-1][1].upper(),
+                             usage_metadata={"input_tokens": 10, "output_tokens": 2, "total_tokens": 12})
+
+
+def test_budget_is_charged_with_actual_usage_and_enforced(tmp_path):
+    model = UsageChatModel()
+    llm = make_llm(tmp_path, model)
+    budget = TokenBudget(30, degrade=())
+
+    llm.invoke([("human", "a")], budget=budget)
+    llm.batch([[("human", "b")], [("human", "a")]], budget=budget)
+    assert budget.used == 24
+    assert len(model.configs) == 2
+
+    with pytest.raises(BudgetExceeded):
+        llm.invoke([("human", "x" * 40)], budget=budget)
+    assert len(model.configs) == 2
+
+
+def test_default_budget_covers_every_call(tmp_path):
+    model = UsageChatModel()
+    llm = make_llm(tmp_path, model)
+    llm.budget = TokenBudget(12, degrade=())
+
+    assert "".join(llm.stream([("human", "a")])) == "A"
+    assert llm.budget.used == 12
+    with pytest.raises(BudgetExceeded):
+        llm.batch([[("human", "b")]])
@@ -0,0 +1,124 @@
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from rate_limits import FakeOpenAIServer, HTTPChatModel
+from src.generation.request_scheduler import CircuitOpen, RequestScheduler
+
+MESSAGES = [("human", "Please find the report attached.")]
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(rps=1000, max_concurrent=100, latency=0.0, retry_after=0.0, error_rate=0.0, outage=0.0):
+        server = FakeOpenAIServer(rps, max_concurrent, latency, retry_after, error_rate, outage)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+class RecordingSleep:
+    """
+    Remplace time.sleep : garde les délais demandés et n'attend que scale fois ce délai.
+    """
+
+    def __init__(self, scale=0.0):
+        self.delays = []
+        self.scale = scale
+
+    def __call__(self, delay):
+        self.delays.append(delay)
+        time.sleep(delay * self.scale)
+
+
+def test_throttled_calls_are_retried_after_retry_after(start_server):
+    server = start_server(max_concurrent=1, latency=0.02, retry_after=0.1)
+    model = HTTPChatModel(server.url)
+    sleep = RecordingSleep(scale=0.1)
+    scheduler = RequestScheduler("test", initial_concurrency=8, max_concurrency=8, sleep=sleep)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        responses = list(executor.map(lambda _: scheduler.call(model.invoke, MESSAGES), range(16)))
+
+    stats = scheduler.stats()
+    assert all(response.content in ("FORMAL", "INFORMAL") for response in responses)
+    assert server.counts["ok"] == 16
+    assert server.counts["429"] > 0
+    assert stats["throttled"] == server.counts["429"] == stats["retries"]
+    # Chaque retry attend au moins le retry-after du serveur
+    assert len(sleep.delays) == stats["retries"]
+    assert min(sleep.delays) >= 0.1
+    # AIMD : la limite a baissé sous la concurrence initiale
+    assert stats["limit"] < 8
+    assert stats["circuit"] == "closed"
+
+
+def test_transient_errors_back_off_exponentially_then_give_up(start_server):
+    server = start_server(error_rate=1.0)
+    model = HTTPChatModel(server.url)
+    sleep = RecordingSleep()
+    scheduler = RequestScheduler("test", max_retries=3, base_delay=0.1, failure_threshold=100, sleep=sleep)
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        scheduler.call(model.invoke, MESSAGES)
+
+    assert error.value.code == 503
+    assert server.counts["503"] == 4
+    assert len(sleep.delays) == 3
+    # Jitter complet : délai tiré dans [0, base_delay * 2^attempt]
+    for attempt, delay in enumerate(sleep.delays):
+        assert 0 <= delay <= 0.1 * 2 ** attempt
+    assert scheduler.stats()["failed"] == 4
+
+
+def test_client_errors_are_not_retried(start_server):
+    server = start_server()
+    model = HTTPChatModel(server.url + "/missing")
+    scheduler = RequestScheduler("test", sleep=RecordingSleep())
+
+    with pytest.raises(urllib.error.HTTPError):
+        scheduler.call(model.invoke, MESSAGES)
+
+    stats = scheduler.stats()
+    assert stats["errors"] == 1
+    assert stats["retries"] == 0
+    assert stats["circuit"] == "closed"
+
+
+def test_circuit_opens_after_consecutive_failures_and_closes_after_a_successful_probe(start_server):
+    server = start_server(outage=0.6)
+    model = HTTPChatModel(server.url)
+    scheduler = RequestScheduler("test", max_retries=0, failure_threshold=3, reset_timeout=0.3,
+                                 sleep=RecordingSleep())
+
+    for _ in range(3):
+        with pytest.raises(urllib.error.HTTPError):
+            scheduler.call(model.invoke, MESSAGES)
+    assert scheduler.stats()["circuit"] == "open"
+
+    # Circuit ouvert : rejet immédiat, sans requête au serveur
+    with pytest.raises(CircuitOpen):
+        scheduler.call(model.invoke, MESSAGES)
+    assert server.counts["503"] == 3
+    assert scheduler.stats()["rejected"] == 1
+
+    # Après reset_timeout, encore en panne : l'appel test échoue et le circuit se rouvre
+    time.sleep(0.35)
+    with pytest.raises(urllib.error.HTTPError):
+        scheduler.call(model.invoke, MESSAGES)
+    assert scheduler.stats()["circuit"] == "open"
+
+    # Panne terminée : l'appel test réussit et referme le circuit
+    time.sleep(0.45)
+    assert scheduler.call(model.invoke, MESSAGES).content in ("FORMAL", "INFORMAL")
+    assert scheduler.stats()["circuit"] == "closed"
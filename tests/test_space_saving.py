@@ -0,0 +1,50 @@
+import random
+from collections import Counter
+
+import pytest
+
+from src.generation import utils
+
+
+def zipf_stream(n, seed=0):
+    rng = random.Random(seed)
+    return [f"w{int(rng.paretovariate(1.1))}" for _ in range(n)]
+
+
+def assert_within_bounds(counter, stream):
+    true_counts = Counter(stream)
+    for item, count in counter.items():
+        # Sur-estimation d'au plus errors[item], elle-même au plus N / capacity
+        assert count - counter.errors[item] <= true_counts[item] <= count
+        assert counter.errors[item] <= len(stream) / counter.capacity
+    for item, true_count in true_counts.items():
+        if true_count > len(stream) / counter.capacity:
+            assert item in counter.counts
+
+
+def test_counts_are_exact_below_capacity():
+    stream = zipf_stream(2000)
+    counter = utils.SpaceSavingCounter(len(set(stream)))
+    counter.update(stream)
+    assert dict(counter.items()) == dict(Counter(stream))
+    assert not any(counter.errors.values())
+
+
+@pytest.mark.parametrize("capacity", [20, 50])
+def test_single_stream_stays_within_error_bound(capacity):
+    stream = zipf_stream(5000)
+    counter = utils.SpaceSavingCounter(capacity)
+    counter.update(stream)
+    assert len(set(stream)) > capacity
+    assert_within_bounds(counter, stream)
+
+
+@pytest.mark.parametrize("n_shards", [2, 5])
+def test_merged_shards_stay_within_error_bound(n_shards):
+    stream = zipf_stream(5000, seed=1)
+    merged = utils.SpaceSavingCounter(50)
+    for shard in range(n_shards):
+        counter = utils.SpaceSavingCounter(50)
+        counter.update(stream[shard::n_shards])
+        merged.merge(counter)
+    assert_within_bounds(merged, stream)
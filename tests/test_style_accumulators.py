@@ -0,0 +1,45 @@
+import json
+import random
+
+import spacy
+
+from src.generation import utils
+
+WORDS = ["contract", "swap", "please", "thank", "therefore", "however", "could", "would", "meeting", "report",
+         "hedge", "review", "attached", "deal", "compliance", "tomorrow", "the", "a", "we", "you"]
+
+
+def make_emails(n, seed=0):
+    rng = random.Random(seed)
+    emails = []
+    for _ in range(n):
+        paragraphs = [
+            " ".join(" ".join(rng.choices(WORDS, k=rng.randint(3, 12))).capitalize() + rng.choice(".!?")
+                     for _ in range(rng.randint(1, 3)))
+            for _ in range(rng.randint(1, 3))
+        ]
+        emails.append("\n\n".join(paragraphs) + rng.choice(["", "\n\nBest regards", "\n\nThanks"]))
+    return emails
+
+
+def test_merged_shards_match_a_single_pass():
+    # Tokens et phrases suffisent aux mesures (pas de modèle entraîné)
+    nlp = spacy.blank("en")
+    nlp.add_pipe("sentencizer")
+    emails = make_emails(60)
+    docs = list(nlp.pipe(emails))
+    rng = random.Random(1)
+    labels = [rng.choice(["FORMAL", "INFORMAL", None]) for _ in emails]
+    emotions = [rng.choice(["neutral", "positive", "negative"]) for _ in emails]
+
+    single = utils.StyleProfileAccumulator().add_emails(emails, docs, labels, emotions)
+
+    merged = utils.StyleProfileAccumulator()
+    for start, end in [(0, 17), (17, 40), (40, 60)]:
+        shard = utils.StyleProfileAccumulator().add_emails(emails[start:end], docs[start:end],
+                                                           labels[start:end], emotions[start:end])
+        # Comme un shard calculé par un autre worker ou relu depuis le store
+        merged.merge(utils.StyleProfileAccumulator.from_dict(json.loads(json.dumps(shard.to_dict()))))
+
+    assert merged.finalize("user") == single.finalize("user")
+    assert merged.to_dict() == single.to_dict()
@@ -0,0 +1,20 @@
+import numpy as np
+
+from src.generation.style_stores import StyleEmbeddingStore, StyleProfileStore
+
+
+class StubEmbeddingModel:
+    def encode(self, emails, **kwargs):
+        return np.array([[len(email), 1.0] for email in emails], dtype=np.float32)
+
+
+def test_directories_are_created_on_the_first_write(tmp_path):
+    embeddings = StyleEmbeddingStore(str(tmp_path / "embeddings"), StubEmbeddingModel)
+    profiles = StyleProfileStore(str(tmp_path / "profiles"), None, None, "1", embeddings=embeddings)
+    assert not list(tmp_path.iterdir())
+    assert profiles.latest("user") is None
+
+    profiles.save("user", ["Hello", "Thanks"], {"formality": 1.0})
+    assert profiles.latest("user") == {"formality": 1.0}
+    assert profiles.centroid("user", ["Hello", "Thanks"]) is not None
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["embeddings", "profiles"]
@@ -0,0 +1,59 @@
+import numpy as np
+
+from src.generation.vector_index import StyleVectorIndex
+
+
+def clustered_vectors(n, dim=64, clusters=100, noise=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(clusters, size=n)] + noise * rng.normal(size=(n, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def exact_neighbours(vectors, row, k):
+    scores = vectors @ vectors[row]
+    scores[row] = -np.inf
+    return set(np.argsort(-scores)[:k].tolist())
+
+
+def build_index(vectors, **kwargs):
+    index = StyleVectorIndex(**kwargs)
+    for row, vector in enumerate(vectors):
+        index.add(str(row), vector)
+    return index
+
+
+def recall(index, vectors, k=10, queries=100, seed=1):
+    rows = np.random.default_rng(seed).choice(len(vectors), size=queries, replace=False)
+    found = [{int(user) for user, _ in index.search_user(str(row), k=k)} for row in rows]
+    return np.mean([len(users & exact_neighbours(vectors, row, k)) / k for users, row in zip(found, rows)])
+
+
+def test_small_collections_use_exact_search():
+    vectors = clustered_vectors(3000)
+    index = build_index(vectors)
+    assert index.centers is None
+    assert recall(index, vectors) == 1.0
+
+
+def test_ivf_recall_against_brute_force():
+    vectors = clustered_vectors(12000)
+    index = build_index(vectors)
+    assert index.centers is not None
+    assert recall(index, vectors) >= 0.95
+
+
+def test_save_and_load_keep_the_results(tmp_path):
+    vectors = clustered_vectors(500)
+    index = build_index(vectors, min_train_size=200)
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+    loaded = StyleVectorIndex.load(path)
+    assert loaded.search_user("7") == index.search_user("7")
+
+
+def test_k_larger_than_the_index_returns_every_user():
+    vectors = clustered_vectors(5)
+    index = build_index(vectors)
+    assert len(index.search(vectors[0], k=10)) == 5
+    assert len(index.search_user("0", k=10)) == 4